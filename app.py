@@ -1,9 +1,10 @@
 import os
 import json
 import time
+import importlib
 import threading
 from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, send_from_directory
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 
@@ -15,6 +16,10 @@ from utils import (
     generate_job_id, save_uploaded_files, get_page_count_or_image_num,
     UPLOAD_FOLDER, INGESTED_DATA_FOLDER, get_file_list_for_ingestion
 )
+from job_store import create_job_store
+from worker_pool import WorkerPool, QueueFullError, PRIORITY_HIGH
+from job_pipeline import JobPipeline
+from view_model import VIEW_MODEL_FILENAME, ViewModelCache, build_view_model, save_view_model
 
 # --- Add ingestion suite to Python path ---
 import sys
@@ -24,38 +29,84 @@ csis_path = Path(__file__).parent / 'chrislocksendient_ingestion_suite'
 sys.path.insert(0, str(Path(__file__).parent))
 
 
-# Now import your ingestion functions
-# These will be the refactored versions
-from ingestion_suite.assignment_ingestion.new_assessment_ingestion_v2 import \
-    ingest_assignment as csis_ingest_assignment, \
-    save_results as csis_save_assignment_results_refactored # This needs to be the refactored version
-from ingestion_suite.mark_scheme_ingestion.ingest_mark_scheme import \
-    ingest_mark_scheme as csis_ingest_mark_scheme_refactored # This needs to be the refactored version
-from ingestion_suite.mark_scheme_ingestion.match_ms_to_question import \
-    main as csis_match_ms_to_question_refactored # This needs to be the refactored version
-# Note: csis_pdf_to_images is now part of the refactored ingest_mark_scheme logic or called by it.
+from ingestion_suite.assignment_ingestion.component_images import component_image_path, sweep_image_store
+
+# --- Ingestion entry points (imported lazily) ---
+# These modules pull in langchain, mistralai, the Azure AI Inference SDK, scipy, numpy,
+# rapidfuzz and the large prompt libraries. They are imported by the stage that needs them
+# (or earlier by the background warmup below), so importing app.py stays fast.
+# check_import_time.py fails if any of them becomes an eager import again.
+INGESTION_MODULES = (
+    'ingestion_suite.assignment_ingestion.new_assessment_ingestion_v2',
+    'ingestion_suite.mark_scheme_ingestion.ingest_mark_scheme',
+    'ingestion_suite.mark_scheme_ingestion.match_ms_to_question',
+)
+INGESTION_WARMUP = os.getenv('INGESTION_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+JOB_RECOVERY_ON_STARTUP = os.getenv('JOB_RECOVERY_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+def csis_ingest_assignment(*args, **kwargs):
+    from ingestion_suite.assignment_ingestion.new_assessment_ingestion_v2 import ingest_assignment
+    return ingest_assignment(*args, **kwargs)
+
+def csis_save_assignment_results_refactored(*args, **kwargs):
+    from ingestion_suite.assignment_ingestion.new_assessment_ingestion_v2 import save_results
+    return save_results(*args, **kwargs)
+
+def csis_clear_assignment_checkpoints(checkpoint_dir: Path):
+    from ingestion_suite.assignment_ingestion.checkpoints import StageCheckpoints
+    StageCheckpoints(checkpoint_dir).clear()
+
+def csis_ingest_mark_scheme_refactored(*args, **kwargs):
+    from ingestion_suite.mark_scheme_ingestion.ingest_mark_scheme import ingest_mark_scheme
+    return ingest_mark_scheme(*args, **kwargs)
+
+def csis_match_ms_to_question_refactored(*args, **kwargs):
+    from ingestion_suite.mark_scheme_ingestion.match_ms_to_question import main
+    return main(*args, **kwargs)
+
+def warm_up_ingestion_modules():
+    """Imports the ingestion modules off the request path, so the first job doesn't pay for it."""
+    started = time.perf_counter()
+    for module_name in INGESTION_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            # The stage itself will raise (and record) the same error when it runs
+            print(f"Warmup: could not import {module_name}: {e}")
+    print(f"Warmup: ingestion modules loaded in {time.perf_counter() - started:.1f}s")
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default_dev_secret_key_please_change')
 app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 app.config['INGESTED_DATA_FOLDER'] = str(INGESTED_DATA_FOLDER)
 
-# In-memory store for job statuses (for a real app, use a DB or Redis)
-job_statuses = {}
+# Durable job status store (SQLite by default, see JOB_STORE_BACKEND) shared by all worker processes
+job_store = create_job_store()
+# Bounded pool that runs ingestion/matching tasks; a full queue rejects new uploads
+worker_pool = WorkerPool()
+if INGESTION_WARMUP:
+    # Runs while the server binds and serves the first pages
+    threading.Thread(target=warm_up_ingestion_modules, name='ingestion-warmup', daemon=True).start()
+# Parsed view models, reused until the file changes
+view_model_cache = ViewModelCache()
+# Component images never change once written, so browsers may cache them for a long time
+COMPONENT_IMAGE_MAX_AGE = int(os.getenv('COMPONENT_IMAGE_MAX_AGE', str(365 * 24 * 3600)))
 
 # --- Helper for ingestion threads ---
 def run_assignment_ingestion_thread(job_id: str, assignment_files_for_ingestion: list[Path]):
     try:
-        job_statuses[job_id]['assignment_status'] = 'processing'
+        job_store.update(job_id, assignment_status='processing')
         job_output_dir = INGESTED_DATA_FOLDER / job_id
         job_output_dir.mkdir(parents=True, exist_ok=True)
 
         print(f"Job {job_id}: Starting assignment ingestion with files: {assignment_files_for_ingestion}")
 
         # Call the original ingest_assignment function
+        checkpoint_dir = job_output_dir / "checkpoints" # Lets a re-run resume from the failed stage
         modified_data, common_data = csis_ingest_assignment(
             files=assignment_files_for_ingestion,
-            llm_model=os.getenv("ASSIGNMENT_LLM_MODEL", "gpt-4.1") # Make model configurable
+            llm_model=os.getenv("ASSIGNMENT_LLM_MODEL", "gpt-4.1"), # Make model configurable
+            checkpoint_dir=checkpoint_dir
         )
 
         # Call the refactored save_results function
@@ -65,21 +116,29 @@ def run_assignment_ingestion_thread(job_id: str, assignment_files_for_ingestion:
             output_dir=job_output_dir
             # base_name is removed or made optional in refactored save_results
         )
-
-        job_statuses[job_id]['assignment_status'] = 'completed'
-        job_statuses[job_id]['assignment_output_path'] = str(job_output_dir / "modified_assessment.json")
-        job_statuses[job_id]['common_components_path'] = str(job_output_dir / "common_components.json")
+        # Results are saved; the OCR / markdown checkpoints and spilled images are no longer needed
+        try:
+            csis_clear_assignment_checkpoints(checkpoint_dir)
+        except OSError as e:
+            print(f"Job {job_id}: Could not remove assignment checkpoints: {e}")
+
+        job_store.update(
+            job_id,
+            assignment_status='completed',
+            assignment_output_path=str(job_output_dir / "modified_assessment.json"),
+            common_components_path=str(job_output_dir / "common_components.json")
+        )
         print(f"Job {job_id}: Assignment ingestion completed.")
 
     except Exception as e:
         print(f"Error in assignment ingestion for job {job_id}: {e}")
         import traceback
         traceback.print_exc()
-        job_statuses[job_id]['assignment_status'] = f'error: {str(e)}'
+        job_store.update(job_id, assignment_status=f'error: {str(e)}')
 
 def run_mark_scheme_ingestion_thread(job_id: str, mark_scheme_files_for_ingestion: list[Path]):
     try:
-        job_statuses[job_id]['mark_scheme_status'] = 'processing'
+        job_store.update(job_id, mark_scheme_status='processing')
         job_output_dir = INGESTED_DATA_FOLDER / job_id
         job_temp_image_dir = UPLOAD_FOLDER # Base for temp images within job folder
         job_output_dir.mkdir(parents=True, exist_ok=True)
@@ -96,23 +155,22 @@ def run_mark_scheme_ingestion_thread(job_id: str, mark_scheme_files_for_ingestio
             temp_image_base_path=job_temp_image_dir # Pass base path for its temp images
         )
 
-        job_statuses[job_id]['mark_scheme_status'] = 'completed'
-        job_statuses[job_id]['mark_scheme_output_path'] = str(ms_output_file_path)
+        job_store.update(job_id, mark_scheme_status='completed', mark_scheme_output_path=str(ms_output_file_path))
         print(f"Job {job_id}: Mark scheme ingestion completed. Output: {ms_output_file_path}")
 
     except Exception as e:
         print(f"Error in mark scheme ingestion for job {job_id}: {e}")
         import traceback
         traceback.print_exc()
-        job_statuses[job_id]['mark_scheme_status'] = f'error: {str(e)}'
+        job_store.update(job_id, mark_scheme_status=f'error: {str(e)}')
 
 def run_matching_process_thread(job_id: str):
     try:
-        job_statuses[job_id]['matching_status'] = 'processing'
+        job_info = job_store.update(job_id, matching_status='processing')
         job_output_dir = INGESTED_DATA_FOLDER / job_id
 
-        assessment_json_path_str = job_statuses[job_id].get('assignment_output_path')
-        mark_scheme_json_path_str = job_statuses[job_id].get('mark_scheme_output_path')
+        assessment_json_path_str = job_info.get('assignment_output_path')
+        mark_scheme_json_path_str = job_info.get('mark_scheme_output_path')
 
         if not assessment_json_path_str or not Path(assessment_json_path_str).exists():
             raise ValueError(f"Missing or invalid ingested assessment JSON path for job {job_id}: {assessment_json_path_str}")
@@ -132,17 +190,78 @@ def run_matching_process_thread(job_id: str):
         with open(matched_output_path, 'w', encoding='utf-8') as f:
             json.dump(matched_data, f, indent=4)
 
-        job_statuses[job_id]['matching_status'] = 'completed'
-        job_statuses[job_id]['matched_data_path'] = str(matched_output_path)
-        job_statuses[job_id]['status'] = 'completed' # Overall job status
+        job_store.update(
+            job_id,
+            matching_status='completed',
+            matched_data_path=str(matched_output_path)
+        )
         print(f"Job {job_id}: Matching process completed. Output: {matched_output_path}")
 
     except Exception as e:
         print(f"Error in matching for job {job_id}: {e}")
         import traceback
         traceback.print_exc()
-        job_statuses[job_id]['matching_status'] = f'error: {str(e)}'
-        job_statuses[job_id]['status'] = 'error'
+        job_store.update(job_id, matching_status=f'error: {str(e)}', status='error')
+
+def run_view_model_thread(job_id: str):
+    try:
+        job_info = job_store.update(job_id, view_model_status='processing')
+        view_model_path = INGESTED_DATA_FOLDER / job_id / VIEW_MODEL_FILENAME
+
+        # Join everything the results page needs once, instead of on every page view
+        view_model = build_view_model(
+            job_info.get('assignment_output_path'),
+            job_info.get('common_components_path'),
+            job_info.get('mark_scheme_output_path'),
+            job_info.get('matched_data_path')
+        )
+        save_view_model(view_model, view_model_path)
+        view_model_cache.invalidate(job_id)
+
+        job_store.update(
+            job_id,
+            view_model_status='completed',
+            view_model_path=str(view_model_path),
+            status='completed' # Overall job status
+        )
+        print(f"Job {job_id}: View model built. Output: {view_model_path}")
+
+    except Exception as e:
+        print(f"Error building view model for job {job_id}: {e}")
+        import traceback
+        traceback.print_exc()
+        job_store.update(job_id, view_model_status=f'error: {str(e)}', status='error')
+
+
+# Stage DAG: both ingestions feed matching, which starts as soon as they have completed,
+# then the results page's view model is built from all three outputs
+def _uploaded_files_args(*file_type_prefixes: str):
+    """resume_args for an ingestion stage: its uploaded files, or None if they are gone."""
+    def resume_args(job_id: str):
+        for prefix in file_type_prefixes:
+            files = get_file_list_for_ingestion(job_id, prefix)
+            if files:
+                return (files,)
+        return None
+    return resume_args
+
+
+pipeline = JobPipeline(job_store, worker_pool)
+pipeline.add_stage('assignment', run_assignment_ingestion_thread, status_field='assignment_status',
+                   resume_args=_uploaded_files_args('assignment_pdf', 'assignment_images'))
+pipeline.add_stage('mark_scheme', run_mark_scheme_ingestion_thread, status_field='mark_scheme_status',
+                   resume_args=_uploaded_files_args('mark_scheme_pdf', 'mark_scheme_images'))
+pipeline.add_stage('matching', run_matching_process_thread, status_field='matching_status',
+                   depends_on=('assignment', 'mark_scheme'), priority=PRIORITY_HIGH)
+pipeline.add_stage('view_model', run_view_model_thread, status_field='view_model_status',
+                   depends_on=('matching',), priority=PRIORITY_HIGH)
+
+if JOB_RECOVERY_ON_STARTUP:
+    # Jobs whose stages were running when the previous process stopped; assignment
+    # ingestion resumes from its stage checkpoints
+    threading.Thread(target=pipeline.recover_interrupted_jobs, name='job-recovery', daemon=True).start()
+# Frees stored component images of jobs whose output folders were deleted
+threading.Thread(target=sweep_image_store, name='image-store-sweep', daemon=True).start()
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -151,14 +270,16 @@ def index():
         job_id = generate_job_id()
         session['job_id'] = job_id # Store job_id in session for potential later use
 
-        job_statuses[job_id] = {
+        # Reject early when the queue can't take both ingestion tasks
+        if not worker_pool.can_accept(2):
+            return "The server is busy processing other uploads. Please try again in a few minutes.", 503
+
+        job_store.create(job_id, {
             'status': 'starting', # Initial overall status
-            'assignment_status': 'pending',
-            'mark_scheme_status': 'pending',
-            'matching_status': 'pending',
+            **pipeline.initial_statuses(), # '<stage>_status': 'pending' for every pipeline stage
             'assignment_units': 1, # Default to 1 to avoid div by zero
             'mark_scheme_units': 1
-        }
+        })
 
         # --- Handle Assignment Upload ---
         assignment_upload_type = request.form.get('assignment_upload_type')
@@ -173,11 +294,10 @@ def index():
                 saved_assignment_files = save_uploaded_files(assignment_image_files, job_id, 'assignment_images')
 
         if not saved_assignment_files:
-            job_statuses[job_id]['assignment_status'] = 'error: No assignment file uploaded or file type not allowed.'
-            job_statuses[job_id]['status'] = 'error'
+            job_store.update(job_id, assignment_status='error: No assignment file uploaded or file type not allowed.', status='error')
             return redirect(url_for('ingesting', job_id=job_id)) # Show error on ingesting page
 
-        job_statuses[job_id]['assignment_units'] = get_page_count_or_image_num(saved_assignment_files)
+        job_store.update(job_id, assignment_units=get_page_count_or_image_num(saved_assignment_files))
 
         # --- Handle Mark Scheme Upload ---
         mark_scheme_upload_type = request.form.get('mark_scheme_upload_type')
@@ -192,13 +312,14 @@ def index():
                 saved_mark_scheme_files = save_uploaded_files(mark_scheme_image_files, job_id, 'mark_scheme_images')
 
         if not saved_mark_scheme_files:
-            job_statuses[job_id]['mark_scheme_status'] = 'error: No mark scheme file uploaded or file type not allowed.'
-            job_statuses[job_id]['status'] = 'error'
+            job_store.update(job_id, mark_scheme_status='error: No mark scheme file uploaded or file type not allowed.', status='error')
             return redirect(url_for('ingesting', job_id=job_id))
 
-        job_statuses[job_id]['mark_scheme_units'] = get_page_count_or_image_num(saved_mark_scheme_files)
-
-        job_statuses[job_id]['status'] = 'processing' # Update overall status
+        job_store.update(
+            job_id,
+            mark_scheme_units=get_page_count_or_image_num(saved_mark_scheme_files),
+            status='processing' # Update overall status
+        )
 
         # Get the actual file paths from the utils function after saving
         # These paths are what your ingestion scripts will use
@@ -208,12 +329,15 @@ def index():
         mark_scheme_files_for_ingestion = get_file_list_for_ingestion(job_id, 'mark_scheme_pdf') or \
                                           get_file_list_for_ingestion(job_id, 'mark_scheme_images')
 
-        # Start ingestion in threads
-        ass_thread = threading.Thread(target=run_assignment_ingestion_thread, args=(job_id, assignment_files_for_ingestion))
-        ms_thread = threading.Thread(target=run_mark_scheme_ingestion_thread, args=(job_id, mark_scheme_files_for_ingestion))
-
-        ass_thread.start()
-        ms_thread.start()
+        # Queue both ingestions (both or neither); matching follows automatically once both complete
+        try:
+            pipeline.start(job_id, {
+                'assignment': (assignment_files_for_ingestion,),
+                'mark_scheme': (mark_scheme_files_for_ingestion,),
+            })
+        except QueueFullError as e:
+            job_store.update(job_id, status='error', assignment_status=f'error: {e}', mark_scheme_status=f'error: {e}')
+            return redirect(url_for('ingesting', job_id=job_id))
 
         return redirect(url_for('ingesting', job_id=job_id))
 
@@ -221,75 +345,48 @@ def index():
 
 @app.route('/ingesting/<job_id>')
 def ingesting(job_id):
-    if job_id not in job_statuses:
+    job_info = job_store.get(job_id)
+    if job_info is None:
         return "Job not found.", 404
     # Pass the whole job_info for the template to use
-    return render_template('ingesting.html', job_id=job_id, job_info=job_statuses[job_id])
+    return render_template('ingesting.html', job_id=job_id, job_info=job_info)
 
 @app.route('/status/<job_id>')
 def status(job_id):
-    if job_id not in job_statuses:
+    current_job_status_obj = job_store.get(job_id)
+    if current_job_status_obj is None:
         return jsonify({"status": "not_found", "message": "Job ID does not exist."}), 404
 
-    current_job_status_obj = job_statuses[job_id]
-
-    # Check if both ingestions are complete, then start matching
-    if current_job_status_obj.get('assignment_status') == 'completed' and \
-       current_job_status_obj.get('mark_scheme_status') == 'completed' and \
-       current_job_status_obj.get('matching_status') == 'pending': # Only start if pending
-
-        print(f"Job {job_id}: Both ingestions complete. Starting matching.")
-        current_job_status_obj['matching_status'] = 'queued' # Update status immediately
-        match_thread = threading.Thread(target=run_matching_process_thread, args=(job_id,))
-        match_thread.start()
-
+    # Read-only: stages are triggered by the pipeline, not by polling
     return jsonify(current_job_status_obj)
 
 
+def load_view_model(job_id: str, current_job: dict) -> dict:
+    """The job's view model, via the in-process cache. Raises FileNotFoundError / json.JSONDecodeError."""
+    view_model_path = Path(current_job.get('view_model_path') or INGESTED_DATA_FOLDER / job_id / VIEW_MODEL_FILENAME)
+    if not view_model_path.exists():
+        # Jobs completed before the view model stage existed: build it once now
+        print(f"Job {job_id}: View model missing, building it now.")
+        save_view_model(build_view_model(
+            current_job.get('assignment_output_path'),
+            current_job.get('common_components_path'),
+            current_job.get('mark_scheme_output_path'),
+            current_job.get('matched_data_path')
+        ), view_model_path)
+    return view_model_cache.get(job_id, view_model_path)
+
 @app.route('/assessment/<job_id>')
 def view_assessment(job_id):
-    if job_id not in job_statuses:
+    current_job = job_store.get(job_id)
+    if current_job is None:
          return "Job not found. Please start a new upload.", 404
 
-    current_job = job_statuses[job_id]
     if current_job.get('status') != 'completed':
         # Could redirect to ingesting page or show an error/wait message
         return redirect(url_for('ingesting', job_id=job_id))
 
-    data_dir = INGESTED_DATA_FOLDER / job_id
-    assessment_data = {}
-    common_components = {}
-    mark_scheme_data = {"mark_schemes": []}
-    matched_data = []
-
     try:
-        ass_path = current_job.get('assignment_output_path')
-        common_path = current_job.get('common_components_path')
-        ms_path = current_job.get('mark_scheme_output_path')
-        match_path = current_job.get('matched_data_path')
-
-        if not ass_path or not Path(ass_path).exists():
-            raise FileNotFoundError("Modified assessment file not found.")
-        with open(ass_path, 'r', encoding='utf-8') as f:
-            assessment_data = json.load(f)
-
-        if not common_path or not Path(common_path).exists():
-            raise FileNotFoundError("Common components file not found.")
-        with open(common_path, 'r', encoding='utf-8') as f:
-            common_components = json.load(f)
-
-        if ms_path and Path(ms_path).exists():
-             with open(ms_path, 'r', encoding='utf-8') as f:
-                mark_scheme_data = json.load(f)
-        else:
-            print(f"Warning: Mark scheme file not found or not specified for job {job_id}")
-            # Proceed without mark scheme data, or handle as error
-
-        if match_path and Path(match_path).exists():
-            with open(match_path, 'r', encoding='utf-8') as f:
-                matched_data = json.load(f) # This is a list of matches
-        else:
-            print(f"Warning: Matched data file not found or not specified for job {job_id}")
+        view_model = load_view_model(job_id, current_job)
 
     except FileNotFoundError as e:
         print(f"File not found error for job {job_id}: {e}")
@@ -303,40 +400,32 @@ def view_assessment(job_id):
         traceback.print_exc()
         return "An unexpected error occurred.", 500
 
-
-    # Create a lookup for mark schemes by their question_number for easier access in template
-    # The structure of mark_scheme_data is {"mark_schemes": [...]}
-    mark_schemes_list = mark_scheme_data.get('mark_schemes', [])
-    mark_schemes_lookup = {ms.get('question_number'): ms for ms in mark_schemes_list}
-
-    # Augment questions with their matched mark schemes
-    processed_questions = []
-    for q_data in assessment_data.get("questions", []):
-        q_id = q_data.get("question_id")
-        # Find the match for this question_id from the matched_data list
-        match_info = next((m for m in matched_data if m.get("question_id") == q_id), None)
-
-        q_data_copy = q_data.copy() # Work with a copy
-
-        if match_info and match_info.get("mark_scheme_question_number"):
-            ms_q_num = match_info.get("mark_scheme_question_number")
-            q_data_copy['matched_mark_scheme'] = mark_schemes_lookup.get(ms_q_num)
-            q_data_copy['match_score'] = match_info.get("score")
-        else:
-            q_data_copy['matched_mark_scheme'] = None
-            q_data_copy['match_score'] = match_info.get("score") if match_info else None
-            if match_info and match_info.get("note"):
-                 q_data_copy['match_note'] = match_info.get("note")
-
-        processed_questions.append(q_data_copy)
-
-    assessment_data["questions"] = processed_questions
-
     return render_template('assessment_view.html',
-                           assessment=assessment_data,
-                           common_components=common_components,
+                           assessment=view_model['assessment'],
+                           common_components=view_model['common_components'],
                            job_id=job_id)
 
+@app.route('/assessment/<job_id>/components/<component_id>')
+def component_image(job_id, component_id):
+    """
+    Image file of a common component (referenced by 'image_ref' in the view model).
+    send_from_directory answers conditional requests (ETag / Last-Modified) and Range requests.
+    """
+    current_job = job_store.get(job_id)
+    if current_job is None or current_job.get('status') != 'completed':
+        return "Component not found.", 404
+
+    try:
+        component = load_view_model(job_id, current_job)['common_components'].get(component_id)
+    except (FileNotFoundError, json.JSONDecodeError):
+        component = None
+    image_path = component_image_path(Path(current_job['common_components_path']).parent, component) if component else None
+    if image_path is None or not image_path.exists():
+        return "Component not found.", 404
+
+    # Resolved, since Flask would otherwise take a relative directory from the app root rather than the cwd
+    return send_from_directory(image_path.parent.resolve(), image_path.name, max_age=COMPONENT_IMAGE_MAX_AGE)
+
 if __name__ == '__main__':
     # Set a default Poppler path if running directly and it's needed,
     # though it's better to set it in .env
@@ -0,0 +1,82 @@
+"""
+Import-time check for app.py.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter (with the
+ingestion warmup disabled) and fails with exit code 1 if:
+  * importing app takes longer than the budget (IMPORT_TIME_BUDGET_MS, default 1500), or
+  * any of the heavy ingestion dependencies is imported eagerly.
+
+Usage:
+    python check_import_time.py [--budget-ms N] [--top N]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv('IMPORT_TIME_BUDGET_MS', '1500'))
+
+# Top-level packages that must only be imported by the ingestion stages
+LAZY_ONLY_PACKAGES = (
+    'langchain', 'langchain_core', 'langchain_openai', 'langchain_community',
+    'mistralai', 'azure', 'openai', 'scipy', 'numpy', 'rapidfuzz', 'tabulate', 'pdf2image',
+    'ingestion_suite.assignment_ingestion.new_assessment_ingestion_v2',
+    'ingestion_suite.assignment_ingestion.prompt_lib',
+    'ingestion_suite.mark_scheme_ingestion.ingest_mark_scheme',
+    'ingestion_suite.mark_scheme_ingestion.prompt_lib',
+    'ingestion_suite.mark_scheme_ingestion.match_ms_to_question',
+)
+
+# "import time: self [us] | cumulative | imported package"
+_LINE_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def measure(app_dir: Path):
+    """Returns [(module, self_us, cumulative_us, depth)] for `import app`."""
+    env = dict(os.environ, INGESTION_WARMUP='false', JOB_RECOVERY_ON_STARTUP='false')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=app_dir, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"'import app' failed with exit code {proc.returncode}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_TIME_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest top-level imports to list')
+    args = parser.parse_args()
+
+    rows = measure(Path(__file__).resolve().parent)
+    total_ms = next((cum for name, _, cum, _ in rows if name == 'app'), 0) / 1000
+    eager = sorted({name for name, _, _, _ in rows
+                    if any(name == pkg or name.startswith(pkg + '.') for pkg in LAZY_ONLY_PACKAGES)})
+
+    print(f"import app: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    print("Slowest imports (cumulative):")
+    for name, _, cum, depth in sorted((r for r in rows if r[3] <= 1), key=lambda r: -r[2])[:args.top]:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if eager:
+        print("FAIL: imported eagerly (should only load inside ingestion stages): " + ', '.join(eager))
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import time {total_ms:.0f} ms exceeds the {args.budget_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
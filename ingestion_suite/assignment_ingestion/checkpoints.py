@@ -0,0 +1,104 @@
+"""
+checkpoints.py
+--------------
+Stage checkpoints and a shared retry budget for assignment ingestion.
+
+* StageCheckpoints  – persists the output of each completed stage
+  (OCR pages, markdown + image map, structured JSON) under a job folder,
+  so a re-run resumes from the first stage without a checkpoint.
+* RetryBudget       – a retry allowance shared by every call it is passed to
+  (the OCR stage of a job, or one structuring chunk). Plugs into tenacity as a
+  `stop` condition, so a persistent failure costs at most `max_retries` extra
+  calls per budget instead of multiplying across nested @retry decorators.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from tenacity import Retrying, wait_exponential_jitter
+
+T = TypeVar("T")
+
+INGESTION_MAX_RETRIES = int(os.getenv("INGESTION_MAX_RETRIES", "2"))
+
+
+class RetryBudget:
+    def __init__(self, max_retries: int = INGESTION_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.remaining = max_retries
+        self._lock = threading.Lock()
+
+    def stop(self, retry_state) -> bool:
+        """tenacity stop callback: consume one retry, or stop once the budget is spent."""
+        with self._lock:
+            if self.remaining <= 0:
+                return True
+            self.remaining -= 1
+            return False
+
+    def run(self, stage: str, fn: Callable[[], T], initial_wait: float = 10, max_wait: float = 60, jitter: float = 5) -> T:
+        """Calls fn, retrying failures while the shared budget lasts. Re-raises the last error."""
+        def _log_retry(retry_state):
+            logging.warning(
+                "Stage '%s' failed (%s). Retrying; %d retries left in this job's budget.",
+                stage, retry_state.outcome.exception(), self.remaining,
+            )
+
+        retrying = Retrying(
+            stop=self.stop,
+            wait=wait_exponential_jitter(initial=initial_wait, max=max_wait, jitter=jitter),
+            before_sleep=_log_retry,
+            reraise=True,
+        )
+        return retrying(fn)
+
+
+class StageCheckpoints:
+    """
+    JSON checkpoint per stage under `checkpoint_dir`, plus `image_dir` for image files
+    the checkpoints refer to. With no directory, nothing is persisted.
+    """
+
+    def __init__(self, checkpoint_dir: Optional[Path] = None):
+        self.checkpoint_dir = Path(checkpoint_dir) if checkpoint_dir else None
+        self.image_dir = self.checkpoint_dir / "images" if self.checkpoint_dir else None
+
+    def _path(self, stage: str) -> Optional[Path]:
+        return self.checkpoint_dir / f"{stage}.json" if self.checkpoint_dir else None
+
+    def load(self, stage: str) -> Optional[Any]:
+        path = self._path(stage)
+        if not path or not path.exists():
+            return None
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning("Ignoring unreadable checkpoint %s: %s", path, e)
+            return None
+        logging.info("Resuming from checkpoint: %s", stage)
+        return data
+
+    def save(self, stage: str, data: Any) -> None:
+        path = self._path(stage)
+        if not path:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def clear(self) -> None:
+        """Deletes every checkpoint and spilled image; call once the job's results are saved."""
+        if self.checkpoint_dir and self.checkpoint_dir.exists():
+            for path in self.checkpoint_dir.glob("*.json"):
+                path.unlink(missing_ok=True)
+            shutil.rmtree(self.image_dir, ignore_errors=True)
+            try:
+                self.checkpoint_dir.rmdir()
+            except OSError:
+                pass  # something else lives there; leave it
@@ -0,0 +1,330 @@
+"""
+component_images.py
+-------------------
+File storage for IMAGE / CHART common components.
+
+The OCR step decodes every image once: `image_map` entries hold the bytes
+(`data`), or for large images only the path of a per-job spill file (`file`).
+Each image component is written to `<job_output_dir>/component_images/<cid>.<ext>`;
+the JSON entry keeps only `image_file` and `extension`, and the web app serves
+the file from its own (cacheable, Range-capable) route.
+
+Older `common_components.json` files with inline base64 are converted the same
+way the first time they are read.
+
+With the image store enabled (IMAGE_STORE_ENABLED, default on), the bytes live
+once in a content-addressed store shared by all jobs
+(`IMAGE_STORE_PATH/blobs/<digest[:2]>/<digest>.<ext>`), and the per-job file is
+a hard link to the stored blob (a copy where hard links aren't possible). The
+store counts references per job output directory. A blob is deleted once no job
+references it: when a re-run of a job no longer uses it, or when the job's output
+directory has been deleted (`sweep_image_store()`, run at app start-up).
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+COMPONENT_IMAGE_DIRNAME = "component_images"
+IMAGE_STORE_ENABLED = os.getenv("IMAGE_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Next to the app's ingested_data folder, independent of the working directory
+IMAGE_STORE_PATH = Path(os.getenv("IMAGE_STORE_PATH") or Path(__file__).resolve().parents[2] / "ingested_data" / "image_store")
+# OCR images at least this large are kept in per-job files instead of in memory
+IMAGE_SPILL_BYTES = int(os.getenv("IMAGE_SPILL_BYTES", str(256 * 1024)))
+
+_PAYLOAD_KEYS = frozenset({"base64", "data", "file", "size"})
+
+_SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+_SAFE_EXTENSION_RE = re.compile(r"[a-z0-9]{1,8}")
+
+
+def decode_image_payload(component: Dict[str, Any]) -> Optional[Tuple[bytes, str]]:
+    """
+    (image bytes, extension) of a component or image_map entry, or None if it has no
+    image data. Reads decoded bytes ("data"), spilled files ("file") and inline
+    base64 ("base64", the format of older checkpoints and common_components.json).
+    """
+    extension = _safe_extension(component.get("extension"))
+    data = component.get("data")
+    if data is not None:
+        return bytes(data), extension
+    spilled = component.get("file")
+    if spilled:
+        return Path(spilled).read_bytes(), extension
+    data = component.get("base64")
+    if not data:
+        return None
+    if data.startswith("data:"):  # unparsed data URI stored as-is by markdown_from_ocr's fallback
+        header, _, data = data.partition(",")
+        extension = _safe_extension(header[len("data:image/"):].split(";")[0] or extension)
+    return base64.b64decode(data), extension
+
+
+def _safe_extension(extension: Optional[str]) -> str:
+    extension = (extension or "png").lower()
+    return extension if _SAFE_EXTENSION_RE.fullmatch(extension) else "png"
+
+
+def make_image_entry(data: bytes, extension: str, spill_dir: Optional[Path] = None, name: str = "") -> Dict[str, Any]:
+    """
+    image_map entry for decoded image bytes. Images of IMAGE_SPILL_BYTES or more are
+    written to `spill_dir` (when given) and the entry keeps only their path.
+    """
+    extension = _safe_extension(extension)
+    if spill_dir is not None and len(data) >= IMAGE_SPILL_BYTES:
+        spill_dir = Path(spill_dir)
+        spill_dir.mkdir(parents=True, exist_ok=True)
+        path = spill_dir / f"{_SAFE_NAME_RE.sub('_', name or content_hash(data))}.{extension}"
+        _write_once(path, data)
+        return {"extension": extension, "file": str(path.resolve()), "size": len(data)}
+    return {"extension": extension, "data": data}
+
+
+def image_map_to_json(image_map: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """JSON-serialisable image_map: in-memory bytes as base64, spilled images as their file path."""
+    result = {}
+    for key, entry in image_map.items():
+        data = entry.get("data")
+        if data is None:
+            result[key] = entry
+        else:
+            result[key] = {"extension": entry.get("extension", "png"), "base64": base64.b64encode(data).decode("ascii")}
+    return result
+
+
+def image_map_from_json(entries: Dict[str, Dict[str, Any]], spill_dir: Optional[Path] = None) -> Dict[str, Dict[str, Any]]:
+    """Inverse of image_map_to_json; base64 entries (also from older checkpoints) are decoded once here."""
+    image_map = {}
+    for key, entry in entries.items():
+        try:
+            decoded = decode_image_payload(entry) if entry.get("base64") else None
+        except (ValueError, TypeError) as e:
+            logging.warning("Could not decode image %s from checkpoint: %s. Keeping it as base64.", key, e)
+            decoded = None
+        image_map[key] = make_image_entry(*decoded, spill_dir=spill_dir, name=key) if decoded else entry
+    return image_map
+
+
+def _write_once(path: Path, data: bytes) -> None:
+    """Writes data to path unless an identical file is already there."""
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return
+    except FileNotFoundError:
+        pass
+    tmp = path.with_suffix(f"{path.suffix}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class ContentAddressedImageStore:
+    """
+    Image bytes keyed by their BLAKE2b digest, with a SQLite table of which owners
+    (job output directories) reference each blob.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.root / "refs.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, extension TEXT NOT NULL, size INTEGER NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            " digest TEXT NOT NULL, owner TEXT NOT NULL, PRIMARY KEY (digest, owner))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS refs_owner ON refs (owner)")
+
+    def blob_path(self, digest: str, extension: str) -> Path:
+        return self.root / "blobs" / digest[:2] / f"{digest}.{extension}"
+
+    def put(self, data: bytes, extension: str, owner: str) -> Tuple[str, Path]:
+        """Stores data (if not already stored) and records owner's reference. Returns (digest, blob path)."""
+        digest = content_hash(data)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT extension FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                if row is not None:
+                    extension = row[0]  # same bytes stored earlier; keep the first extension
+                path = self.blob_path(digest, extension)
+                if row is None or not path.exists():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    _write_once(path, data)
+                    self._conn.execute("INSERT OR REPLACE INTO blobs (digest, extension, size) VALUES (?, ?, ?)", (digest, extension, len(data)))
+                self._conn.execute("INSERT OR IGNORE INTO refs (digest, owner) VALUES (?, ?)", (digest, owner))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return digest, path
+
+    def refcount(self, digest: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM refs WHERE digest = ?", (digest,)).fetchone()[0]
+
+    def retain(self, owner: str, digests: Iterable[str]) -> int:
+        """Drops owner's references to anything not in digests (e.g. after a re-run). Returns blobs deleted."""
+        keep = set(digests)
+        with self._lock:
+            held = [d for (d,) in self._conn.execute("SELECT digest FROM refs WHERE owner = ?", (owner,))]
+            stale = [d for d in held if d not in keep]
+            if not stale:
+                return 0
+            return self._drop_refs(owner, stale)
+
+    def release(self, owner: str) -> int:
+        """Drops all of owner's references (e.g. when a job is deleted). Returns blobs deleted."""
+        with self._lock:
+            held = [d for (d,) in self._conn.execute("SELECT digest FROM refs WHERE owner = ?", (owner,))]
+            return self._drop_refs(owner, held) if held else 0
+
+    def release_missing_owners(self) -> int:
+        """Releases every owner whose output directory no longer exists. Returns blobs deleted."""
+        with self._lock:
+            owners = [o for (o,) in self._conn.execute("SELECT DISTINCT owner FROM refs")]
+        return sum(self.release(owner) for owner in owners if not Path(owner).exists())
+
+    def _drop_refs(self, owner: str, digests: Iterable[str]) -> int:
+        deleted = 0
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            for digest in digests:
+                self._conn.execute("DELETE FROM refs WHERE digest = ? AND owner = ?", (digest, owner))
+                if self._conn.execute("SELECT 1 FROM refs WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                    continue
+                row = self._conn.execute("SELECT extension FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                self._conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                if row is not None:
+                    # Jobs hold hard links, so their files survive the blob being removed
+                    self.blob_path(digest, row[0]).unlink(missing_ok=True)
+                    deleted += 1
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return deleted
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            blobs, stored = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            refs, referenced = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM refs r JOIN blobs b ON b.digest = r.digest"
+            ).fetchone()
+        return {"blobs": blobs, "stored_bytes": stored, "references": refs, "referenced_bytes": referenced}
+
+
+_image_store: Optional[ContentAddressedImageStore] = None
+_image_store_lock = threading.Lock()
+
+
+def get_image_store() -> Optional[ContentAddressedImageStore]:
+    """The process-wide image store, or None if disabled or it can't be opened."""
+    global _image_store
+    if not IMAGE_STORE_ENABLED:
+        return None
+    if _image_store is None:
+        with _image_store_lock:
+            if _image_store is None:
+                try:
+                    _image_store = ContentAddressedImageStore(IMAGE_STORE_PATH)
+                except (OSError, sqlite3.Error) as e:
+                    logging.warning("Could not open the image store at %s: %s. Writing images per job.", IMAGE_STORE_PATH, e)
+                    return None
+    return _image_store
+
+
+def sweep_image_store() -> int:
+    """Frees the blobs of deleted jobs. Returns the number of blobs deleted."""
+    store = get_image_store()
+    if store is None:
+        return 0
+    try:
+        deleted = store.release_missing_owners()
+    except (OSError, sqlite3.Error) as e:
+        logging.warning("Image store sweep failed: %s", e)
+        return 0
+    if deleted:
+        logging.info("Deleted %d image(s) no longer referenced by any job.", deleted)
+    return deleted
+
+
+def _link_to_blob(blob: Path, dest: Path, data: bytes) -> None:
+    """Makes dest a hard link to blob, falling back to writing a copy."""
+    try:
+        if dest.exists() and os.path.samefile(blob, dest):
+            return
+        tmp = dest.with_suffix(f"{dest.suffix}.tmp")
+        tmp.unlink(missing_ok=True)
+        os.link(blob, tmp)
+        os.replace(tmp, dest)
+    except OSError:
+        _write_once(dest, data)
+
+
+def externalise_component_images(
+    common: Dict[str, Any],
+    output_dir: Path,
+    image_store: Optional[ContentAddressedImageStore] = None,
+) -> Dict[str, Any]:
+    """
+    Returns a copy of `common` in which every component carrying image data is
+    replaced by a reference to its image file under `output_dir`. Components
+    without image data are returned unchanged. Uses `get_image_store()` unless a
+    store is passed.
+    """
+    image_dir = Path(output_dir) / COMPONENT_IMAGE_DIRNAME
+    store = image_store or get_image_store()
+    owner = str(Path(output_dir).resolve())
+    stored_digests = set()
+    result: Dict[str, Any] = {}
+    for cid, component in common.items():
+        try:
+            decoded = decode_image_payload(component) if isinstance(component, dict) else None
+        except (ValueError, TypeError, OSError) as e:
+            logging.warning("Could not decode image data of component %s: %s. Keeping it inline.", cid, e)
+            decoded = None
+        if decoded is None:
+            if isinstance(component, dict) and component.get("content_hash"):
+                stored_digests.add(component["content_hash"])  # stored by an earlier call; still referenced
+            result[cid] = component
+            continue
+
+        image_bytes, extension = decoded
+        filename = f"{_SAFE_NAME_RE.sub('_', cid)}.{extension}"
+        image_dir.mkdir(parents=True, exist_ok=True)
+        ref = {k: v for k, v in component.items() if k not in _PAYLOAD_KEYS}
+        if store is not None:
+            digest, blob = store.put(image_bytes, extension, owner)
+            _link_to_blob(blob, image_dir / filename, image_bytes)
+            stored_digests.add(digest)
+            ref["content_hash"] = digest
+        else:
+            _write_once(image_dir / filename, image_bytes)
+
+        ref["extension"] = extension
+        ref["image_file"] = filename
+        result[cid] = ref
+    if store is not None:
+        # References of images this job no longer has (e.g. after a re-run) are dropped
+        store.retain(owner, stored_digests)
+    return result
+
+
+def component_image_path(output_dir: Path, component: Dict[str, Any]) -> Optional[Path]:
+    """Path of a component's image file, or None if the component has no stored image."""
+    filename = component.get("image_file")
+    if not filename:
+        return None
+    return Path(output_dir) / COMPONENT_IMAGE_DIRNAME / filename
@@ -0,0 +1,117 @@
+"""
+image_dedup.py
+--------------
+Content keys for IMAGE / CHART components, so `deduplicate_components` pools
+identical pictures (logos, headers, recurring figures) even when OCR returned
+them as separate images on different pages.
+
+Modes (IMAGE_DEDUP_MODE):
+  * "pixels" (default) – BLAKE2b of the decoded pixel data, so the same picture
+    re-encoded losslessly (different PNG settings, metadata) still matches.
+    Falls back to the byte digest if the image can't be decoded.
+  * "bytes"            – BLAKE2b of the decoded file bytes.
+  * "key"              – the image_map key, i.e. no content-based dedup.
+
+With IMAGE_DEDUP_PHASH_DISTANCE > 0, images whose 64-bit difference hash
+(dHash) is within that Hamming distance of an earlier image are also treated as
+the same picture, which catches lossy re-encodes and slight rescaling.
+"""
+
+import hashlib
+import io
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from .component_images import decode_image_payload
+
+IMAGE_DEDUP_MODE = os.getenv("IMAGE_DEDUP_MODE", "pixels").lower()
+IMAGE_DEDUP_PHASH_DISTANCE = int(os.getenv("IMAGE_DEDUP_PHASH_DISTANCE", "0"))
+
+
+def bytes_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def pixel_digest(data: bytes) -> str:
+    """Digest of the decoded RGBA pixels and image size; independent of the file encoding."""
+    with Image.open(io.BytesIO(data)) as image:
+        rgba = image.convert("RGBA")
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{rgba.width}x{rgba.height}:".encode("ascii"))
+        h.update(rgba.tobytes())
+        return h.hexdigest()
+
+
+def perceptual_hash(data: bytes, hash_size: int = 8) -> int:
+    """dHash: compares neighbouring pixels of a (hash_size+1) x hash_size grayscale thumbnail."""
+    with Image.open(io.BytesIO(data)) as image:
+        small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class ImageDedupIndex:
+    """
+    Maps image_map entries to dedup keys for one assessment. Keys are computed once
+    per image_map key; with perceptual matching on, a new image reuses the key of
+    the first earlier image within the distance threshold.
+    """
+
+    def __init__(self, mode: str = IMAGE_DEDUP_MODE, phash_distance: int = IMAGE_DEDUP_PHASH_DISTANCE):
+        self.mode = mode
+        self.phash_distance = phash_distance
+        self._keys: Dict[str, str] = {}
+        self._phashes: List[Tuple[int, str]] = []  # (dHash, dedup key) of every distinct image seen
+
+    def key_for(self, image_key: str, img_data: Optional[Dict[str, Any]]) -> str:
+        if image_key in self._keys:
+            return self._keys[image_key]
+        key = self._compute_key(image_key, img_data)
+        self._keys[image_key] = key
+        return key
+
+    def _compute_key(self, image_key: str, img_data: Optional[Dict[str, Any]]) -> str:
+        if self.mode == "key" or not img_data:
+            return f"key:{image_key}"
+        try:
+            decoded = decode_image_payload(img_data)
+        except (ValueError, TypeError, OSError):
+            decoded = None
+        if decoded is None:
+            return f"key:{image_key}"
+        data = decoded[0]
+
+        key = None
+        if self.mode == "pixels":
+            try:
+                key = f"pixels:{pixel_digest(data)}"
+            except Exception as e:  # undecodable image: fall back to the file bytes
+                logging.debug(f"Could not decode {image_key} for pixel hashing: {e}")
+        if key is None:
+            key = f"bytes:{bytes_digest(data)}"
+
+        if self.phash_distance > 0 and key not in (k for _, k in self._phashes):
+            try:
+                phash = perceptual_hash(data)
+            except Exception as e:
+                logging.debug(f"Could not compute perceptual hash for {image_key}: {e}")
+                return key
+            for other_hash, other_key in self._phashes:
+                if hamming_distance(phash, other_hash) <= self.phash_distance:
+                    logging.info(f"Image {image_key} is a near duplicate of an earlier image; pooling them.")
+                    return other_key
+            self._phashes.append((phash, key))
+        return key
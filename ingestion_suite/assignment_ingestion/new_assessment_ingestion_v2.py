@@ -23,10 +23,12 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
 )
 
-import base64, hashlib, json, mimetypes, os, re
+import base64, hashlib, io, json, mimetypes, os, re, threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Type
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Type
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 3rd-party
@@ -39,8 +41,6 @@ from langchain_core.messages import HumanMessage
 from langchain_community.callbacks.openai_info import OpenAICallbackHandler
 from pydantic import BaseModel
 
-from tenacity import retry, stop_after_attempt, wait_exponential_jitter
-
 
 log = structlog.get_logger()
 
@@ -69,12 +69,28 @@ except ImportError:
         "Dummy prompt {assignment_text}"
     )
 
+from .ocr_cache import ocr_cache, file_digest, OCR_CACHE_ENABLED
+from .checkpoints import INGESTION_MAX_RETRIES, RetryBudget, StageCheckpoints
+from .component_images import externalise_component_images, image_map_from_json, image_map_to_json, make_image_entry
+from .image_dedup import ImageDedupIndex
+from .text_dedup import TextDedupIndex
+from ..llm_cache import get_response_cache, make_cache_key
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Load environment variables. Flask app should handle this at its root.
 # load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env') # Example: if .env is three levels up
 # For simplicity, assume Flask app's load_dotenv covers this.
 
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+OCR_MODEL = os.getenv("MISTRAL_OCR_MODEL", "mistral-ocr-latest")
+# Max number of uploaded files OCR'd at once
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+
+# Chunked structuring: documents longer than STRUCTURING_CHUNK_CHARS are split at page
+# boundaries (with STRUCTURING_CHUNK_OVERLAP_PAGES pages of overlap) and structured in parallel.
+STRUCTURING_CHUNK_CHARS = int(os.getenv("STRUCTURING_CHUNK_CHARS", "40000"))
+STRUCTURING_CHUNK_OVERLAP_PAGES = int(os.getenv("STRUCTURING_CHUNK_OVERLAP_PAGES", "1"))
+STRUCTURING_CONCURRENCY = int(os.getenv("STRUCTURING_CONCURRENCY", "4"))
 if not MISTRAL_API_KEY:
     logging.warning("⚠️ MISTRAL_API_KEY not set – OCR will be skipped")
 
@@ -109,6 +125,7 @@ AZURE = {
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers
 DATA_URI_RE = re.compile(r"data:(image/[^;]+);base64,(.+)", re.I | re.S)
+PAGE_SEPARATOR = "\n\n---\n\n"
 
 
 def safe_json_load(text: str) -> Any:
@@ -163,15 +180,48 @@ class IdPool:
 
 # ──────────────────────────────────────────────────────────────────────────────
 # OCR
-def extract_ocr(file_path: Path) -> Dict[str, Any]:
-    if not MISTRAL_API_KEY:
-        logging.error("MISTRAL_API_KEY not configured. OCR cannot proceed.")
-        return {}
+_MISTRAL_CLIENT: Optional[Mistral] = None
+_MISTRAL_CLIENT_LOCK = threading.Lock()
+
+
+def get_mistral_client() -> Mistral:
+    """One Mistral client (and its HTTP connection pool) shared by all OCR calls."""
+    global _MISTRAL_CLIENT
+    if _MISTRAL_CLIENT is None:
+        with _MISTRAL_CLIENT_LOCK:
+            if _MISTRAL_CLIENT is None:
+                _MISTRAL_CLIENT = Mistral(api_key=MISTRAL_API_KEY)
+    return _MISTRAL_CLIENT
+
+
+def extract_ocr(file_path: Path, use_cache: bool = OCR_CACHE_ENABLED) -> Dict[str, Any]:
     if not file_path.exists():
         logging.error(f"OCR input file not found: {file_path}")
         return {}
 
-    client = Mistral(api_key=MISTRAL_API_KEY)
+    # Identical uploads (same bytes, same OCR model) reuse the previous OCR result
+    digest = None
+    if use_cache:
+        digest = file_digest(file_path)
+        cached = ocr_cache.get(file_path, OCR_MODEL, digest=digest)
+        if cached:
+            return cached
+
+    if not MISTRAL_API_KEY:
+        logging.error("MISTRAL_API_KEY not configured. OCR cannot proceed.")
+        return {}
+
+    result = _run_mistral_ocr(file_path)
+    if use_cache and result.get("pages"):
+        try:
+            ocr_cache.put(file_path, OCR_MODEL, result, digest=digest)
+        except OSError as e:
+            logging.warning("Could not write OCR cache entry for %s: %s", file_path.name, e)
+    return result
+
+
+def _run_mistral_ocr(file_path: Path) -> Dict[str, Any]:
+    client = get_mistral_client()
     ext = file_path.suffix.lower()
     try:
         if ext == ".pdf":
@@ -188,7 +238,7 @@ def extract_ocr(file_path: Path) -> Dict[str, Any]:
             url = url_response.url
 
             resp = client.ocr.process(
-                model="mistral-ocr-latest",
+                model=OCR_MODEL,
                 document={"type": "document_url", "document_url": url},
                 include_image_base64=True,
             )
@@ -199,7 +249,7 @@ def extract_ocr(file_path: Path) -> Dict[str, Any]:
                 return {}
             data_uri = f"data:{mime};base64,{b64}"
             resp = client.ocr.process(
-                model="mistral-ocr-latest",
+                model=OCR_MODEL,
                 document={"type": "image_url", "image_url": data_uri},
                 include_image_base64=True,
             )
@@ -220,15 +270,29 @@ def extract_ocr(file_path: Path) -> Dict[str, Any]:
 
 # ──────────────────────────────────────────────────────────────────────────────
 # OCR -> markdown + image map
-def markdown_from_ocr(
-    pages: List[Dict[str, Any]],
-) -> Tuple[str, Dict[str, Dict[str, str]]]:
-    image_store: Dict[str, Dict[str, str]] = {}
-    md_segments = []
+def _page_image_pattern(ocr_img_ids: Iterable[str]) -> "re.Pattern[str]":
+    """One pattern for all of a page's images: ![any alt text](<one of the OCR IDs>)."""
+    # Longest first, so an ID that is a prefix of another needs no backtracking
+    alternatives = "|".join(re.escape(i) for i in sorted(ocr_img_ids, key=len, reverse=True))
+    return re.compile(rf"!\[[^\]]*\]\(({alternatives})\)")
+
+
+def iter_markdown_from_ocr(
+    pages: Iterable[Dict[str, Any]],
+    image_store: Dict[str, Dict[str, Any]],
+    spill_dir: Optional[Path] = None,
+) -> Iterator[str]:
+    """
+    Yields each page's markdown with its OCR image links rewritten to internal keys
+    (image_1, image_2, ... across all pages), adding the images to `image_store` as
+    it goes. Each page is rewritten in a single regex pass. Images are decoded once;
+    large ones are spilled to files in `spill_dir` (see component_images.make_image_entry).
+    """
     img_pool = IdPool("image") # Use a consistent prefix for image references
 
     for i, page in enumerate(pages):
         markdown = page.get("markdown", "") or ""
+        key_by_ocr_id: Dict[str, str] = {}
         # Ensure images from OCR are correctly mapped
         for img_idx, img_data in enumerate(page.get("images", []) or []):
             b64_uri = img_data.get("image_base64")
@@ -242,30 +306,73 @@ def markdown_from_ocr(
             internal_image_key = img_pool.next()
 
             parsed_uri = parse_data_uri(b64_uri)
+            image_bytes = None
             if parsed_uri:
+                try:
+                    image_bytes = base64.b64decode(parsed_uri["base64"])
+                except ValueError as e:
+                    logging.warning(f"Could not decode image {ocr_img_id} on page {i+1}: {e}. Storing raw base64.")
+            if image_bytes is not None:
+                image_store[internal_image_key] = make_image_entry(image_bytes, parsed_uri["extension"], spill_dir, internal_image_key)
+            elif parsed_uri:
                 image_store[internal_image_key] = parsed_uri
             else:
                 # Fallback if parse_data_uri fails, store raw (but this shouldn't happen with Mistral's output)
                 image_store[internal_image_key] = {"base64": b64_uri, "extension": "png"} # Assume png if not parsable
                 logging.warning(f"Could not parse data URI for image {ocr_img_id} on page {i+1}. Storing raw base64.")
 
-            # Replace the ![...](ocr_img_id) in markdown with ![internal_image_key](internal_image_key)
-            # Escape ocr_img_id for regex, as it might contain special characters
-            escaped_ocr_img_id = re.escape(ocr_img_id)
-            # Regex to find ![any alt text](ocr_img_id)
-            markdown = re.sub(
-                rf"!\[[^\]]*\]\({escaped_ocr_img_id}\)",
-                f"![{internal_image_key}]({internal_image_key})", # Use internal key for both alt and ref
-                markdown,
-            )
-        md_segments.append(markdown)
+            # A repeated OCR ID keeps the key of its first image
+            key_by_ocr_id.setdefault(ocr_img_id, internal_image_key)
 
-    return "\n\n---\n\n".join(md_segments), image_store
+        if key_by_ocr_id and markdown:
+            # Replace every ![...](ocr_img_id) with ![internal_image_key](internal_image_key)
+            replacements = {ocr_id: f"![{key}]({key})" for ocr_id, key in key_by_ocr_id.items()}
+            markdown = _page_image_pattern(replacements).sub(lambda m: replacements[m.group(1)], markdown)
+        yield markdown
+
+
+def markdown_from_ocr(
+    pages: List[Dict[str, Any]],
+    spill_dir: Optional[Path] = None,
+) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    image_store: Dict[str, Dict[str, Any]] = {}
+    out = io.StringIO()
+    for page_idx, page_markdown in enumerate(iter_markdown_from_ocr(pages, image_store, spill_dir)):
+        if page_idx:
+            out.write(PAGE_SEPARATOR)
+        out.write(page_markdown)
+    return out.getvalue(), image_store
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # LLM helpers
+# AzureChatOpenAI instances are reusable and thread-safe, so one is built per model
+# and kept for the life of the worker (failed inits are not cached).
+_LLM_CACHE: Dict[str, AzureChatOpenAI] = {}
+_LLM_CACHE_LOCK = threading.Lock()
+
+
 def get_llm(model_name: str) -> Optional[AzureChatOpenAI]:
+    llm = _LLM_CACHE.get(model_name)
+    if llm is not None:
+        return llm
+    with _LLM_CACHE_LOCK:
+        llm = _LLM_CACHE.get(model_name)
+        if llm is None:
+            llm = _build_llm(model_name)
+            if llm is not None:
+                _LLM_CACHE[model_name] = llm
+    return llm
+
+
+@lru_cache(maxsize=None)
+def get_parser(output_schema: Type[BaseModel]) -> Tuple[JsonOutputParser, str]:
+    """Returns the JSON parser for a schema together with its (pre-rendered) format instructions."""
+    parser = JsonOutputParser(pydantic_object=output_schema)
+    return parser, parser.get_format_instructions()
+
+
+def _build_llm(model_name: str) -> Optional[AzureChatOpenAI]:
     conf = AZURE.get(model_name)
     if not conf or not conf.get("endpoint") or not conf.get("version") or not conf.get("deployment") or not AZURE.get("key"):
         logging.error(f"Azure OpenAI configuration missing or incomplete for model: {model_name}")
@@ -295,19 +402,28 @@ def get_llm(model_name: str) -> Optional[AzureChatOpenAI]:
         return None
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=10, max=60, jitter=5), reraise=True)
 def invoke_llm(
     assignment_text: str,
     prompt_template_str: str,
     output_schema: Type[BaseModel], # Use Type[BaseModel] for Pydantic model classes
     model_name: str = "gpt-4.1",
+    use_cache: bool = True,
+    retry_budget: Optional[RetryBudget] = None, # Budget shared with related calls; a fresh one if not given
 ) -> Optional[Dict[str, Any]]:
+    cache = get_response_cache() if use_cache else None
+    cache_key = make_cache_key(model_name, prompt_template_str, assignment_text, output_schema.model_json_schema()) if cache else None
+    if cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"LLM response cache hit for assignment structuring ({model_name}).")
+            return json.loads(cached)
+
     llm = get_llm(model_name)
     if not llm:
         logging.error(f"Failed to get LLM instance for model: {model_name}")
         return None
     try:
-        parser = JsonOutputParser(pydantic_object=output_schema)
+        parser, format_instructions = get_parser(output_schema)
 
         # Format the prompt template with the assignment text
         # The original prompt_lib.py uses {format_instructions} which langchain populates
@@ -322,16 +438,23 @@ def invoke_llm(
         # Simpler formatting if prompt_template_str is basic:
         prompt_content = prompt_template_str.format(
             assignment_text=assignment_text,
-            format_instructions=parser.get_format_instructions() # Add format instructions
+            format_instructions=format_instructions # Add format instructions
         )
         messages = [HumanMessage(content=prompt_content)]
 
         chain = llm | parser # No need for ChatPromptTemplate if messages are constructed directly
 
         logging.info(f"Invoking LLM {model_name} for assignment structuring...")
-        response = chain.invoke(messages) # Pass messages to invoke for newer Langchain versions
+        budget = retry_budget or RetryBudget()
+        response = budget.run(
+            "llm_structuring",
+            lambda: chain.invoke(messages), # Pass messages to invoke for newer Langchain versions
+            initial_wait=10, max_wait=60, jitter=5,
+        )
 
         # logging.info("LLM response received (first 100 chars): %s", json.dumps(response, indent=2)[:100])
+        if cache and response:
+            cache.set(cache_key, json.dumps(response, ensure_ascii=False))
         return response # response should already be a dict parsed by JsonOutputParser
     except Exception as e:
         logging.error("LLM invocation error during assignment structuring: %s", e)
@@ -341,185 +464,406 @@ def invoke_llm(
 
 
 # ──────────────────────────────────────────────────────────────────────────────
-# Component de-duplication
-def deduplicate_components(
-    structured: Dict[str, Any],
-    image_map: Dict[str, Dict[str, str]], # image_map: internal_key -> {base64, extension}
-) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+# Chunked structuring
+def split_markdown_into_chunks(
+    markdown: str,
+    max_chars: int = STRUCTURING_CHUNK_CHARS,
+    overlap_pages: int = STRUCTURING_CHUNK_OVERLAP_PAGES,
+) -> List[str]:
+    """
+    Packs whole pages (split on PAGE_SEPARATOR) into chunks of at most ~max_chars.
+    Each chunk after the first repeats the last `overlap_pages` pages of the previous
+    one, so a question spanning a page break is seen whole by at least one chunk.
+    A single page longer than max_chars becomes its own chunk.
+    """
+    pages = markdown.split(PAGE_SEPARATOR)
+    if len(markdown) <= max_chars or len(pages) == 1:
+        return [markdown]
+
+    chunks: List[str] = []
+    start = 0
+    while start < len(pages):
+        end = start
+        size = 0
+        while end < len(pages) and (end == start or size + len(PAGE_SEPARATOR) + len(pages[end]) <= max_chars):
+            size += len(pages[end]) + (len(PAGE_SEPARATOR) if end > start else 0)
+            end += 1
+        chunks.append(PAGE_SEPARATOR.join(pages[start:end]))
+        if end >= len(pages):
+            break
+        # Step back for the overlap, but always make progress
+        start = max(start + 1, end - overlap_pages)
+    return chunks
+
+
+def _question_key(question_id: Any) -> str:
+    return "".join(str(question_id or "").split()).lower()
+
+
+def _stitch_question(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """Merges two extractions of the same question_id (from overlapping or adjacent chunks)."""
+    merged = dict(first)
+    # The longer text is the one that saw the whole question, not a page-break fragment
+    if len(second.get("question") or "") > len(first.get("question") or ""):
+        merged["question"] = second.get("question")
+    for field in ("total_marks_available", "parent_question_id", "question_number"):
+        if merged.get(field) is None and second.get(field) is not None:
+            merged[field] = second[field]
+    for field in ("possible_answers", "question_dependencies", "question_context"):
+        combined = list(first.get(field) or [])
+        for item in second.get(field) or []:
+            if item not in combined:
+                combined.append(item)
+        merged[field] = combined
+    # Marking is needed if either chunk thought so
+    if "needs_marking" in first or "needs_marking" in second:
+        merged["needs_marking"] = bool(first.get("needs_marking", False) or second.get("needs_marking", False))
+    return merged
+
+
+def merge_question_lists(chunk_questions: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Concatenates per-chunk question lists in chunk order, stitching together
+    questions with the same question_id. A question keeps its first-seen position.
+    Questions without a question_id can't be matched up, so each is kept as-is.
+    """
+    merged: List[Dict[str, Any]] = []
+    position: Dict[str, int] = {}  # question key -> index in merged
+    for questions in chunk_questions:
+        for question in questions:
+            key = _question_key(question.get("question_id"))
+            if not key:
+                merged.append(question)
+            elif key in position:
+                merged[position[key]] = _stitch_question(merged[position[key]], question)
+            else:
+                position[key] = len(merged)
+                merged.append(question)
+    return merged
+
+
+def structure_assignment(
+    markdown_content: str,
+    model_name: str,
+    max_chars: int = STRUCTURING_CHUNK_CHARS,
+    max_workers: int = STRUCTURING_CONCURRENCY,
+    max_retries: int = INGESTION_MAX_RETRIES,
+    checkpoints: Optional[StageCheckpoints] = None,
+) -> Dict[str, Any]:
+    """
+    Runs QuestionModelV3 structuring over the markdown. Short documents go through a
+    single invoke_llm call; longer ones are chunked, structured in parallel and merged.
+    Each chunk has its own RetryBudget of `max_retries`, so failures in some chunks
+    can't use up the retries of the others.
+
+    Each structured chunk is checkpointed ("structured_chunks", keyed by chunk digest),
+    so a re-run only structures the chunks that are still missing. Raises RuntimeError
+    if any chunk fails: a merged result with a chunk missing would silently lose its
+    questions.
+    """
+    checkpoints = checkpoints or StageCheckpoints()
+    chunks = split_markdown_into_chunks(markdown_content, max_chars=max_chars)
+    if len(chunks) > 1:
+        logging.info(f"Structuring assignment in {len(chunks)} chunks (max {max_chars} chars each)...")
+
+    done: Dict[str, Any] = checkpoints.load("structured_chunks") or {}  # chunk digest -> structured result
+    done_lock = threading.Lock()
+
+    def _structure_chunk(chunk: str) -> Optional[Dict[str, Any]]:
+        digest = payload_digest(chunk)
+        if digest in done:
+            return done[digest]
+        result = invoke_llm(
+            assignment_text=chunk,
+            prompt_template_str=assignment_extraction_prompt_template_reasoning_v9,
+            output_schema=QuestionModelV3, # Pass the Pydantic model class itself
+            model_name=model_name,
+            retry_budget=RetryBudget(max_retries),
+        )
+        if result and len(chunks) > 1:
+            with done_lock:
+                done[digest] = result
+                checkpoints.save("structured_chunks", done)
+        return result
 
-    # Ensure ComponentType is the Enum, not the string "ComponentType"
-    # This should be handled by correct import from .output
-    pools = {ct: IdPool(ct.value) for ct in ComponentType}
-    common_components_pool: Dict[str, Any] = {} # Stores the actual component data, keyed by new CID
-    dedup_map: Dict[str, str] = {}  # composite_key (type:hash or type:ref) -> new_cid
+    workers = max(1, min(max_workers, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="structuring") as executor:
+        chunk_results = list(executor.map(_structure_chunk, chunks))
 
-    def _get_composite_key(ctype: ComponentType, original_key_or_data: Any) -> str:
-        """Generates a key for deduplication. For images/charts, it's based on original_key. For others, hash of data."""
+    failed = [str(idx + 1) for idx, result in enumerate(chunk_results) if not result]
+    if failed:
+        raise RuntimeError(f"LLM structuring failed for chunk(s) {', '.join(failed)} of {len(chunks)}")
+    if len(chunks) == 1:
+        return chunk_results[0]
+    return {"questions": merge_question_lists([result.get("questions", []) for result in chunk_results])}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Component de-duplication
+def payload_digest(data: Any) -> str:
+    """Content hash of a component payload: BLAKE2b over the raw UTF-8 text, no re-serialisation."""
+    if isinstance(data, str):
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+    return generate_hash(data)
+
+
+class ComponentDeduplicator:
+    """
+    Pools the context components of questions into common components and rewrites
+    each question's `question_context` into references to them.
+
+    Questions can be added in any number of batches (e.g. as each structuring chunk
+    completes); component IDs keep counting across batches, so batches added one after
+    another in question order give the same result as deduplicating all questions at
+    once. add_question is thread-safe, but concurrent calls get IDs in the order they
+    take the lock, so IDs are only deterministic when batches are added sequentially.
+    Input questions are never modified: each rewritten question is a shallow copy with
+    a newly built context list.
+    """
+
+    def __init__(self, image_map: Dict[str, Dict[str, Any]]): # image_map: internal_key -> {extension, data | file}
+        self.image_map = image_map
+        self.common_components: Dict[str, Any] = {} # Stores the actual component data, keyed by new CID
+        self._pools = {ct: IdPool(ct.value) for ct in ComponentType}
+        self._dedup_map: Dict[str, str] = {}  # composite_key (type:hash or type:image content key) -> new_cid
+        self._image_index = ImageDedupIndex()
+        self._text_index = TextDedupIndex()
+        self._first_question: Dict[str, int] = {}  # cid -> index of the question that introduced it
+        self.near_duplicate_merges = 0
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "common_components": len(self.common_components),
+            "near_duplicate_merges": self.near_duplicate_merges,
+        }
+
+    def _composite_key(self, ctype: ComponentType, original_key_or_data: Any) -> Tuple[str, Optional[float]]:
+        """
+        Generates a key for deduplication. For images/charts, it's based on the image content. For others,
+        on the normalised text (see text_dedup). Also returns the similarity if the key is a near duplicate's.
+        """
         if ctype == ComponentType.IMAGE or ctype == ComponentType.CHART:
-            # original_key_or_data is the reference like "image_1" from markdown_from_ocr's image_map
-            return f"{ctype.value}:{original_key_or_data}"
-        else:
-            # original_key_or_data is the actual component data (e.g., text string, table markdown)
-            return f"{ctype.value}:{generate_hash(original_key_or_data)}"
+            # original_key_or_data is the reference like "image_1" from markdown_from_ocr's image_map;
+            # identical pictures under different keys get the same content key (see image_dedup)
+            image_key = str(original_key_or_data)
+            return f"{ctype.value}:{self._image_index.key_for(image_key, self.image_map.get(image_key))}", None
+        # original_key_or_data is the actual component data (e.g., text string, table markdown)
+        if isinstance(original_key_or_data, str):
+            text_key, similarity = self._text_index.lookup(ctype.value, original_key_or_data)
+            return f"{ctype.value}:{text_key}", similarity
+        return f"{ctype.value}:{payload_digest(original_key_or_data)}", None
 
     def _record_component(
+        self,
         ctype: ComponentType,
         original_key_or_data: Any, # For IMAGE/CHART, this is the key from image_map (e.g. "image_1")
                                    # For TEXT/TABLE/EQUATION, this is the actual data (e.g. text string)
-        payload_supplier # A function that returns the payload if this is a new component
+        q_idx: int = 0,
     ) -> str: # Returns the new Component ID (CID)
+        composite_key, similarity = self._composite_key(ctype, original_key_or_data)
+        existing_cid = self._dedup_map.get(composite_key)
+        if existing_cid is not None:
+            if similarity is not None:
+                self.near_duplicate_merges += 1
+                logging.info(
+                    f"Q{q_idx} {ctype.value} component is a near duplicate (similarity {similarity:.3f}) of "
+                    f"{existing_cid} from Q{self._first_question.get(existing_cid)}; reusing {existing_cid}. "
+                    f"Text: {str(original_key_or_data)[:80]!r}"
+                )
+            return existing_cid
 
-        composite_key = _get_composite_key(ctype, original_key_or_data)
-
-        if composite_key not in dedup_map:
-            new_cid = pools[ctype].next()
-            dedup_map[composite_key] = new_cid
-
-            # The payload for common_components_pool should be the final storable form
-            # For images/charts, this comes from image_map. For others, it's the data itself.
-            if ctype == ComponentType.IMAGE or ctype == ComponentType.CHART:
-                # original_key_or_data is the key for image_map
-                img_data_from_map = image_map.get(str(original_key_or_data))
-                if not img_data_from_map:
-                    logging.error(f"Consistency error: Image key {original_key_or_data} not found in image_map during deduplication.")
-                    # Handle error: perhaps store a placeholder or skip
-                    # For now, let's create a placeholder to avoid crashing
-                    common_components_pool[new_cid] = {"component_type": ctype.value, "error": "source_data_missing", "original_key": original_key_or_data}
-                else:
-                    common_components_pool[new_cid] = {"component_type": ctype.value, **img_data_from_map}
+        new_cid = self._pools[ctype].next()
+        self._dedup_map[composite_key] = new_cid
+        self._first_question[new_cid] = q_idx
+
+        # The payload for the common components pool should be the final storable form
+        # For images/charts, this comes from image_map. For others, it's the data itself.
+        if ctype == ComponentType.IMAGE or ctype == ComponentType.CHART:
+            img_data_from_map = self.image_map.get(str(original_key_or_data))
+            if not img_data_from_map:
+                logging.error(f"Consistency error: Image key {original_key_or_data} not found in image_map during deduplication.")
+                # Store a placeholder to avoid crashing
+                self.common_components[new_cid] = {"component_type": ctype.value, "error": "source_data_missing", "original_key": original_key_or_data}
             else:
-                # For TEXT, TABLE, EQUATION, the payload is constructed from original_key_or_data
-                # The payload_supplier is not strictly needed here if original_key_or_data is the content
-                common_components_pool[new_cid] = {"component_type": ctype.value, "component": {"type": "text", "data": original_key_or_data}}
+                self.common_components[new_cid] = {"component_type": ctype.value, **img_data_from_map}
+        else:
+            self.common_components[new_cid] = {"component_type": ctype.value, "component": {"type": "text", "data": original_key_or_data}}
+        return new_cid
 
-        return dedup_map[composite_key]
+    def _rewrite_context_item(self, comp_wrapper: Dict[str, Any], q_idx: int) -> Dict[str, Any]:
+        """Reference wrapper for one context item, or the original item if it can't be pooled."""
+        # component_type_str is from LLM output, e.g., "image", "text"
+        component_type_str = comp_wrapper.get("component_type")
+        llm_component_data = comp_wrapper.get("component", {}) # This is the component object from LLM
 
-    modified_structured_assessment = json.loads(json.dumps(structured)) # Deep copy
+        # Validate component_type_str against our Enum
+        try:
+            ctype_enum_val = ComponentType(component_type_str)
+        except ValueError:
+            logging.warning(f"Invalid component_type '{component_type_str}' in Q{q_idx}. Skipping this context item.")
+            return comp_wrapper # Keep as is if invalid
+
+        if ctype_enum_val == ComponentType.IMAGE or ctype_enum_val == ComponentType.CHART:
+            # LLM output for image/chart should be: {"type": "reference", "reference": "image_X"}
+            # where "image_X" is the key from markdown_from_ocr's image_map
+            if llm_component_data.get("type") == "reference" and isinstance(llm_component_data.get("reference"), str):
+                image_map_key = llm_component_data["reference"]
+                if image_map_key not in self.image_map:
+                    logging.warning(f"LLM referenced image key '{image_map_key}' not found in OCR image_map for Q{q_idx}. Keeping original.")
+                    return comp_wrapper # Keep original if ref is broken
+                new_cid = self._record_component(ctype_enum_val, image_map_key, q_idx)
+            else:
+                logging.warning(f"Malformed IMAGE/CHART component from LLM for Q{q_idx}: {llm_component_data}. Keeping original.")
+                return comp_wrapper
 
-    for q_idx, q_content in enumerate(modified_structured_assessment.get("questions", [])):
+        elif ctype_enum_val in [ComponentType.TEXT, ComponentType.TABLE, ComponentType.EQUATION]:
+            # LLM output for text/table/equation: {"type": "text", "data": "text, markdown table or equation string"}
+            if llm_component_data.get("type") == "text" and isinstance(llm_component_data.get("data"), str):
+                new_cid = self._record_component(ctype_enum_val, llm_component_data["data"], q_idx)
+            else:
+                logging.warning(f"Malformed {ctype_enum_val.value.upper()} component from LLM for Q{q_idx}: {llm_component_data}. Keeping original.")
+                return comp_wrapper
+        else:
+            # Should not happen if ctype_enum_val is validated
+            logging.error(f"Unhandled component type '{ctype_enum_val}' during deduplication for Q{q_idx}.")
+            return comp_wrapper
+
+        # Replace the original component wrapper with a reference to the common component
+        return {
+            "component_type": ComponentType.REFERENCE.value, # This context item is now a reference
+            "component": {"type": "reference", "reference": new_cid}
+        }
+
+    def add_question(self, q_content: Dict[str, Any], q_idx: int = 0) -> Dict[str, Any]:
+        """Pools one question's context components and returns the rewritten question."""
         new_question_context = []
-        for comp_wrapper in q_content.get("question_context", []):
-            try:
-                # component_type_str is from LLM output, e.g., "image", "text"
-                component_type_str = comp_wrapper.get("component_type")
-                llm_component_data = comp_wrapper.get("component", {}) # This is the component object from LLM
-
-                # Validate component_type_str against our Enum
+        with self._lock:
+            for comp_wrapper in q_content.get("question_context") or []:
                 try:
-                    ctype_enum_val = ComponentType(component_type_str)
-                except ValueError:
-                    logging.warning(f"Invalid component_type '{component_type_str}' in Q{q_idx}. Skipping this context item.")
-                    new_question_context.append(comp_wrapper) # Keep as is if invalid
-                    continue
-
-                new_cid = ""
-
-                if ctype_enum_val == ComponentType.IMAGE or ctype_enum_val == ComponentType.CHART:
-                    # LLM output for image/chart should be: {"type": "reference", "reference": "image_X"}
-                    # where "image_X" is the key from markdown_from_ocr's image_map
-                    if llm_component_data.get("type") == "reference" and isinstance(llm_component_data.get("reference"), str):
-                        image_map_key = llm_component_data["reference"]
-                        if image_map_key not in image_map:
-                            logging.warning(f"LLM referenced image key '{image_map_key}' not found in OCR image_map for Q{q_idx}. Keeping original.")
-                            new_question_context.append(comp_wrapper) # Keep original if ref is broken
-                            continue
-                        # The original_key_or_data for _record_component is image_map_key
-                        new_cid = _record_component(ctype_enum_val, image_map_key, lambda: image_map.get(image_map_key))
-                    else:
-                        logging.warning(f"Malformed IMAGE/CHART component from LLM for Q{q_idx}: {llm_component_data}. Keeping original.")
-                        new_question_context.append(comp_wrapper)
-                        continue
-
-                elif ctype_enum_val == ComponentType.TEXT:
-                    # LLM output for text: {"type": "text", "data": "actual text..."}
-                    if llm_component_data.get("type") == "text" and isinstance(llm_component_data.get("data"), str):
-                        text_data = llm_component_data["data"]
-                        # The original_key_or_data for _record_component is text_data itself
-                        new_cid = _record_component(ctype_enum_val, text_data, lambda: {"component": {"type": "text", "data": text_data}})
-                    else:
-                        logging.warning(f"Malformed TEXT component from LLM for Q{q_idx}: {llm_component_data}. Keeping original.")
-                        new_question_context.append(comp_wrapper)
-                        continue
-
-                elif ctype_enum_val in [ComponentType.TABLE, ComponentType.EQUATION]:
-                     # LLM output for table/equation: {"type": "text", "data": "markdown_table_or_equation_string"}
-                    if llm_component_data.get("type") == "text" and isinstance(llm_component_data.get("data"), str):
-                        content_data = llm_component_data["data"]
-                        # The original_key_or_data for _record_component is content_data itself
-                        new_cid = _record_component(ctype_enum_val, content_data, lambda: {"component": {"type": "text", "data": content_data}})
-                    else:
-                        logging.warning(f"Malformed {ctype_enum_val.value.upper()} component from LLM for Q{q_idx}: {llm_component_data}. Keeping original.")
-                        new_question_context.append(comp_wrapper)
-                        continue
-                else:
-                    # Should not happen if ctype_enum_val is validated
-                    logging.error(f"Unhandled component type '{ctype_enum_val}' during deduplication for Q{q_idx}.")
-                    new_question_context.append(comp_wrapper)
-                    continue
-
-                # Replace the original component wrapper with a reference to the common component
-                new_question_context.append({
-                    "component_type": ComponentType.REFERENCE.value, # This context item is now a reference
-                    "component": {"type": "reference", "reference": new_cid}
-                })
+                    new_question_context.append(self._rewrite_context_item(comp_wrapper, q_idx))
+                except Exception as e:
+                    logging.error(f"Error processing component in Q{q_idx}: {comp_wrapper}. Error: {e}")
+                    new_question_context.append(comp_wrapper) # Add original back on error
+        return {**q_content, "question_context": new_question_context}
 
-            except Exception as e:
-                logging.error(f"Error processing component in Q{q_idx}: {comp_wrapper}. Error: {e}")
-                new_question_context.append(comp_wrapper) # Add original back on error
+    def add_questions(self, questions: Iterable[Dict[str, Any]], start_idx: int = 0) -> List[Dict[str, Any]]:
+        return [self.add_question(q_content, q_idx) for q_idx, q_content in enumerate(questions, start=start_idx)]
 
-        q_content["question_context"] = new_question_context
 
-    return common_components_pool, modified_structured_assessment
+def deduplicate_components(
+    structured: Dict[str, Any],
+    image_map: Dict[str, Dict[str, Any]], # image_map: internal_key -> {extension, data | file}
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Returns (common components pool, structured assessment with context rewritten into references)."""
+    deduplicator = ComponentDeduplicator(image_map)
+    modified_structured_assessment = dict(structured) # Shallow: only the question list is rebuilt
+    if "questions" in structured:
+        modified_structured_assessment["questions"] = deduplicator.add_questions(structured["questions"])
+    stats = deduplicator.stats()
+    if stats["near_duplicate_merges"]:
+        logging.info(f"Pooled {stats['near_duplicate_merges']} near-duplicate text components.")
+    return deduplicator.common_components, modified_structured_assessment
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Orchestration
-@retry(stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=15, max=90, jitter=10), reraise=True)
-def ingest_assignment(
-    files: List[Path], # List of Path objects to uploaded files (PDF or images)
-    llm_model: str = os.getenv("ASSIGNMENT_LLM_MODEL", "gpt-4.1"), # Get model from env or default
-) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-
-    if not files:
-        logging.error("No files provided for assignment ingestion.")
-        # Return empty structures or raise error, depending on desired handling
-        return {}, {}
-
-    all_ocr_pages = []
+def ocr_files(files: List[Path], max_workers: int = OCR_CONCURRENCY) -> List[Dict[str, Any]]:
+    """
+    OCRs every file, up to `max_workers` at a time, and returns all pages
+    concatenated in the original file order. Raises RuntimeError if any existing
+    file yields no pages, so the caller retries instead of keeping a partial set
+    (files that did succeed are served from the OCR cache on the retry).
+    """
+    existing_files = []
     for file_path in files:
         if not file_path.exists():
             logging.warning(f"File not found: {file_path}, skipping.")
             continue
+        existing_files.append(file_path)
+
+    def _ocr(file_path: Path) -> Dict[str, Any]:
         logging.info(f"Processing file for OCR: {file_path.name}")
-        ocr_result = extract_ocr(file_path)
-        if ocr_result and "pages" in ocr_result:
+        return extract_ocr(file_path)
+
+    workers = max(1, min(max_workers, len(existing_files) or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr") as executor:
+        # executor.map preserves input order, so pages stay in upload order
+        ocr_results = list(executor.map(_ocr, existing_files))
+
+    all_ocr_pages = []
+    failed_files = []
+    for file_path, ocr_result in zip(existing_files, ocr_results):
+        if ocr_result and ocr_result.get("pages"):
             all_ocr_pages.extend(ocr_result["pages"])
         else:
             logging.warning(f"No pages extracted from OCR for file: {file_path.name}")
+            failed_files.append(file_path.name)
+    if failed_files:
+        raise RuntimeError(f"OCR produced no pages for: {', '.join(failed_files)}")
+    return all_ocr_pages
+
 
-    if not all_ocr_pages:
-        logging.error("OCR produced no pages from any of the provided files.")
-        return {}, {} # Return empty dicts if no OCR content
+def ingest_assignment(
+    files: List[Path], # List of Path objects to uploaded files (PDF or images)
+    llm_model: str = os.getenv("ASSIGNMENT_LLM_MODEL", "gpt-4.1"), # Get model from env or default
+    checkpoint_dir: Optional[Path] = None, # Per-job folder for stage checkpoints; None disables them
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    OCR -> markdown + image map -> LLM structuring -> de-duplication.
+    Each completed stage is checkpointed in `checkpoint_dir`, so a re-run skips
+    straight to the first unfinished stage. OCR failures are retried from a RetryBudget
+    for the job; each structuring chunk has its own (no nested retries).
+    """
+
+    if not files:
+        logging.error("No files provided for assignment ingestion.")
+        # Return empty structures or raise error, depending on desired handling
+        return {}, {}
 
-    logging.info(f"Total pages from OCR: {len(all_ocr_pages)}")
-    markdown_content, image_map = markdown_from_ocr(all_ocr_pages)
+    checkpoints = StageCheckpoints(checkpoint_dir)
+    retry_budget = RetryBudget()
+    image_spill_dir = checkpoints.image_dir
 
-    if not markdown_content.strip():
-        logging.warning("Markdown content from OCR is empty. Skipping LLM structuring.")
-        structured_assessment = {"questions": []}
+    markdown_stage = checkpoints.load("markdown")
+    if markdown_stage is not None:
+        markdown_content = markdown_stage["markdown"]
+        image_map = image_map_from_json(markdown_stage["image_map"], image_spill_dir)
     else:
-        logging.info("Invoking LLM for structuring assignment from Markdown...")
-        structured_assessment = invoke_llm(
-            assignment_text=markdown_content,
-            prompt_template_str=assignment_extraction_prompt_template_reasoning_v9,
-            output_schema=QuestionModelV3, # Pass the Pydantic model class itself
-            model_name=llm_model,
-        )
-        if not structured_assessment:
-            logging.error("LLM structuring failed to return data. Proceeding with empty assessment.")
+        all_ocr_pages = checkpoints.load("ocr_pages")
+        if all_ocr_pages is None:
+            def _ocr_stage() -> List[Dict[str, Any]]:
+                pages = ocr_files(files)
+                if not pages:
+                    raise RuntimeError("OCR produced no pages from any of the provided files.")
+                return pages
+
+            try:
+                # Files OCR'd successfully on a previous attempt are served from the OCR cache
+                all_ocr_pages = retry_budget.run("ocr", _ocr_stage, initial_wait=15, max_wait=90, jitter=10)
+            except Exception as e:
+                logging.error(f"OCR stage failed: {e}")
+                return {}, {} # Return empty dicts if no OCR content
+            checkpoints.save("ocr_pages", all_ocr_pages)
+
+        logging.info(f"Total pages from OCR: {len(all_ocr_pages)}")
+        markdown_content, image_map = markdown_from_ocr(all_ocr_pages, spill_dir=image_spill_dir)
+        # The raw OCR response holds every image as base64 again; drop it before the long stages
+        del all_ocr_pages
+        checkpoints.save("markdown", {"markdown": markdown_content, "image_map": image_map_to_json(image_map)})
+
+    structured_assessment = checkpoints.load("structured")
+    if structured_assessment is None:
+        if not markdown_content.strip():
+            logging.warning("Markdown content from OCR is empty. Skipping LLM structuring.")
             structured_assessment = {"questions": []}
-            # Optionally, could return the raw markdown and image_map here for debugging or partial success
-            # return {"raw_markdown": markdown_content, "image_map": image_map, "error": "LLM_failed"}, {}
+        else:
+            logging.info("Invoking LLM for structuring assignment from Markdown...")
+            # Raises if any chunk failed; the stage fails and a re-run resumes from the structured chunks
+            structured_assessment = structure_assignment(
+                markdown_content, model_name=llm_model, checkpoints=checkpoints,
+            )
+            checkpoints.save("structured", structured_assessment)
 
 
     logging.info("Deduplicating components...")
@@ -539,8 +883,9 @@ def save_results(modified: Dict[str, Any], common: Dict[str, Any], output_dir: P
     (output_dir / "modified_assessment.json").write_text(
         json.dumps(modified, indent=4, ensure_ascii=False), encoding="utf-8"
     )
+    # Images are written as files once per component ID; the JSON only references them
     (output_dir / "common_components.json").write_text(
-        json.dumps(common, indent=4, ensure_ascii=False), encoding="utf-8"
+        json.dumps(externalise_component_images(common, output_dir), indent=4, ensure_ascii=False), encoding="utf-8"
     )
     logging.info("✅ Assignment results saved to %s", output_dir.resolve())
 
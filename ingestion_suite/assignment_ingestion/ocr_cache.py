@@ -0,0 +1,118 @@
+"""
+ocr_cache.py
+------------
+On-disk cache of Mistral OCR results, keyed by SHA-256(file bytes) + OCR model.
+
+* One JSON file per entry, holding the `model_dump()` of the OCR response.
+* LRU eviction: a hit touches the entry's mtime; writes evict the least
+  recently used entries until the cache is under `max_bytes`.
+* `invalidate()` drops a single file's entry, `clear()` drops everything.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+OCR_CACHE_DIR = Path(os.getenv("OCR_CACHE_DIR", "ocr_cache"))
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_MB", "2048")) * 1024 * 1024
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+
+
+def file_digest(file_path: Path) -> str:
+    """SHA-256 of a file's bytes, read in chunks so large PDFs aren't loaded at once."""
+    h = hashlib.sha256()
+    with file_path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class OcrCache:
+    def __init__(self, cache_dir: Path = OCR_CACHE_DIR, max_bytes: int = OCR_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entry_path(self, digest: str, model: str) -> Path:
+        # Model names like "mistral-ocr-latest" are filename-safe; guard against anything else
+        safe_model = "".join(c if c.isalnum() or c in "-_." else "_" for c in model)
+        return self.cache_dir / safe_model / f"{digest}.json"
+
+    def get(self, file_path: Path, model: str, digest: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        digest = digest or file_digest(file_path)
+        entry = self._entry_path(digest, model)
+        try:
+            data = json.loads(entry.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning("Discarding unreadable OCR cache entry %s: %s", entry, e)
+            entry.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(entry)  # mark as recently used
+        except OSError:
+            pass
+        logging.info("OCR cache hit for %s (%s)", file_path.name, digest[:12])
+        return data
+
+    def put(self, file_path: Path, model: str, result: Dict[str, Any], digest: Optional[str] = None) -> None:
+        if not result:
+            return
+        digest = digest or file_digest(file_path)
+        entry = self._entry_path(digest, model)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file then rename, so concurrent readers never see a partial entry
+        tmp = entry.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, entry)
+        self._evict()
+
+    def invalidate(self, file_or_digest: Union[Path, str], model: Optional[str] = None) -> int:
+        """Removes the entry for a file (or a raw digest) — for one model, or every model if None."""
+        digest = file_digest(file_or_digest) if isinstance(file_or_digest, Path) else file_or_digest
+        if model is not None:
+            entries = [self._entry_path(digest, model)]
+        else:
+            entries = list(self.cache_dir.glob(f"*/{digest}.json"))
+        removed = 0
+        for entry in entries:
+            if entry.exists():
+                entry.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def clear(self) -> int:
+        removed = 0
+        for entry in self.cache_dir.glob("*/*.json"):
+            entry.unlink(missing_ok=True)
+            removed += 1
+        return removed
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in self.cache_dir.glob("*/*.json"):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry))
+                total += st.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()  # oldest mtime (least recently used) first
+            for _, size, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                entry.unlink(missing_ok=True)
+                total -= size
+                logging.info("Evicted OCR cache entry %s", entry.name)
+
+
+ocr_cache = OcrCache()
@@ -0,0 +1,220 @@
+"""
+text_dedup.py
+-------------
+Dedup keys for TEXT / TABLE / EQUATION components, so `deduplicate_components`
+pools the same source extract even when the LLM transcribed it slightly
+differently for different questions.
+
+Two stages:
+  1. Normalisation (TEXT_DEDUP_NORMALISE, default on) – Unicode NFC, collapsed
+     whitespace and, for tables, cell padding and alignment rows; for text also
+     one style of quotes/dashes/ellipsis. No compatibility folding, so "mc²" and
+     "mc2" stay different. Texts equal after normalisation share a key.
+  2. Near duplicates (TEXT_DEDUP_THRESHOLD, default 0.9; 0 disables) – a MinHash
+     signature over character shingles of each new text is looked up in an LSH
+     index (banded buckets), and candidates are confirmed with their exact
+     shingle Jaccard similarity. Each text is hashed once and only compared with
+     its bucket neighbours, so pooling stays linear in the number of components.
+
+A candidate above the threshold is only reused if both texts have exactly the
+same content tokens (`content_tokens`: words case-insensitively, numbers with
+their sign and decimal separator, and symbols such as + < = %), i.e. they differ
+only in spacing, capitalisation or sentence punctuation. Character similarity
+alone would merge "increases" and "decreases", or "5 m/s" and "-5 m/s", in an
+otherwise identical passage. Near-duplicate matching also only
+applies to TEXT_DEDUP_FUZZY_TYPES (default text and table: in an equation one
+changed character is a different equation) and to texts of at least
+TEXT_DEDUP_MIN_CHARS characters.
+"""
+
+import hashlib
+import os
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+TEXT_DEDUP_NORMALISE = os.getenv("TEXT_DEDUP_NORMALISE", "true").lower() in ("1", "true", "yes")
+TEXT_DEDUP_THRESHOLD = float(os.getenv("TEXT_DEDUP_THRESHOLD", "0.9"))
+TEXT_DEDUP_FUZZY_TYPES = frozenset(t.strip() for t in os.getenv("TEXT_DEDUP_FUZZY_TYPES", "text,table").split(",") if t.strip())
+TEXT_DEDUP_MIN_CHARS = int(os.getenv("TEXT_DEDUP_MIN_CHARS", "40"))
+TEXT_DEDUP_NUM_PERM = int(os.getenv("TEXT_DEDUP_NUM_PERM", "128"))
+TEXT_DEDUP_SHINGLE_SIZE = int(os.getenv("TEXT_DEDUP_SHINGLE_SIZE", "5"))
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+_CHAR_MAP = str.maketrans({
+    "‘": "'", "’": "'", "‚": "'", "‛": "'", "′": "'",
+    "“": '"', "”": '"', "„": '"', "″": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-",
+    "…": "...", " ": " ",
+})
+_WHITESPACE_RE = re.compile(r"\s+")
+_SPACE_BEFORE_PUNCT_RE = re.compile(r" +([,.;:!?)\]])")
+_SPACE_AFTER_OPEN_RE = re.compile(r"([(\[]) +")
+_TABLE_CELL_RE = re.compile(r" *\| *")
+_TABLE_RULE_CELL_RE = re.compile(r"^:?-+:?$")
+_EQUATION_SPACE_RE = re.compile(r" *([^\w\s\\]) *")  # spaces around operators/brackets carry no meaning
+# Signed numbers with decimal parts ("-1.5" vs "1,5" vs "2·5" differ), words, and any symbol
+# other than sentence punctuation, quotes and brackets ("<" vs ">" differ)
+_CONTENT_TOKEN_RE = re.compile(r"""[-+−]?\d+(?:[.,·]\d+)*|\w+|[^\w\s.,;:!?'"()\[\]{}\-]""")
+
+
+def _normalise_table(text: str) -> str:
+    rows = []
+    for line in text.splitlines():
+        line = _WHITESPACE_RE.sub(" ", line).strip()
+        if not line:
+            continue
+        cells = _TABLE_CELL_RE.split(line.strip("|").strip())
+        if all(_TABLE_RULE_CELL_RE.fullmatch(c) for c in cells):
+            cells = ["-"] * len(cells)  # alignment row: only the column count matters
+        rows.append("|" + "|".join(cells) + "|")
+    return "\n".join(rows)
+
+
+def normalise_text(text: str, component_type: str = "text") -> str:
+    """Canonical form used for the dedup key; formatting-only differences disappear."""
+    # NFC only: compatibility folding (NFKC) would turn "x²" into "x2" and "x₁" into "x1"
+    text = unicodedata.normalize("NFC", text)
+    if component_type == "table":
+        return _normalise_table(text)
+    text = _WHITESPACE_RE.sub(" ", text).strip()
+    if component_type == "equation":
+        return _EQUATION_SPACE_RE.sub(r"\1", text)
+    text = _WHITESPACE_RE.sub(" ", text.translate(_CHAR_MAP))
+    text = _SPACE_BEFORE_PUNCT_RE.sub(r"\1", text)
+    return _SPACE_AFTER_OPEN_RE.sub(r"\1", text)
+
+
+def text_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def content_tokens(text: str) -> Tuple[str, ...]:
+    return tuple(_CONTENT_TOKEN_RE.findall(text.casefold()))
+
+
+def shingles(text: str, size: int = TEXT_DEDUP_SHINGLE_SIZE) -> Set[str]:
+    text = text.casefold()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_bands(threshold: float, num_perm: int, recall: float = 0.95) -> Tuple[int, int]:
+    """
+    (bands, rows) for num_perm signature values: the most rows per band (fewest
+    spurious candidates) for which two texts at exactly `threshold` similarity
+    still share a bucket with probability >= recall.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands < recall:
+            break
+        best = (bands, rows)
+    return best
+
+
+class MinHasher:
+    """MinHash signatures with num_perm universal hash functions (a*x + b mod 2^61-1) over 32-bit shingle hashes."""
+
+    def __init__(self, num_perm: int = TEXT_DEDUP_NUM_PERM, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set: Set[str]) -> np.ndarray:
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingle_set),
+            dtype=np.uint64, count=len(shingle_set),
+        )
+        # a, b, x < 2^32, so a*x + b fits in uint64 before the modulus
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+class TextDedupIndex:
+    """
+    Maps text payloads to dedup keys for one assessment. Keys are per component
+    type; an exact or normalised match reuses the earlier key directly, and a
+    near duplicate reuses the key of the first earlier text it matches.
+    `lookup` also reports the similarity when a near duplicate was reused.
+    """
+
+    def __init__(
+        self,
+        normalise: bool = TEXT_DEDUP_NORMALISE,
+        threshold: float = TEXT_DEDUP_THRESHOLD,
+        fuzzy_types: frozenset = TEXT_DEDUP_FUZZY_TYPES,
+        min_chars: int = TEXT_DEDUP_MIN_CHARS,
+        num_perm: int = TEXT_DEDUP_NUM_PERM,
+    ):
+        self.normalise = normalise
+        self.threshold = threshold
+        self.fuzzy_types = fuzzy_types
+        self.min_chars = min_chars
+        self._fuzzy = normalise and 0 < threshold < 1
+        if self._fuzzy:
+            self._hasher = MinHasher(num_perm)
+            self._bands, self._rows = lsh_bands(threshold, num_perm)
+        self._keys: Dict[Tuple[str, str], str] = {}  # (type, normalised text) -> key
+        self._buckets: Dict[Tuple[str, int, bytes], List[str]] = defaultdict(list)  # (type, band, band hash) -> keys
+        self._entries: Dict[Tuple[str, str], Tuple[Set[str], Tuple[str, ...]]] = {}  # (type, key) -> (shingles, content tokens)
+
+    def key_for(self, component_type: str, text: str) -> str:
+        return self.lookup(component_type, text)[0]
+
+    def lookup(self, component_type: str, text: str) -> Tuple[str, Optional[float]]:
+        """(dedup key, similarity if the key is that of an earlier near duplicate, else None)."""
+        if not self.normalise:
+            return text_digest(text), None
+        normalised = normalise_text(text, component_type)
+        exact = self._keys.get((component_type, normalised))
+        if exact is not None:
+            return exact, None
+
+        key, similarity = text_digest(normalised), None
+        if self._fuzzy and component_type in self.fuzzy_types and len(normalised) >= self.min_chars:
+            key, similarity = self._near_duplicate_key(component_type, normalised, key)
+        self._keys[(component_type, normalised)] = key
+        return key, similarity
+
+    def _near_duplicate_key(self, component_type: str, normalised: str, key: str) -> Tuple[str, Optional[float]]:
+        shingle_set = shingles(normalised)
+        text_tokens = content_tokens(normalised)
+        signature = self._hasher.signature(shingle_set)
+        band_keys = [
+            (component_type, band, signature[band * self._rows:(band + 1) * self._rows].tobytes())
+            for band in range(self._bands)
+        ]
+
+        checked = set()
+        for band_key in band_keys:
+            for other_key in self._buckets.get(band_key, ()):
+                if other_key in checked:
+                    continue
+                checked.add(other_key)
+                other_shingles, other_tokens = self._entries[(component_type, other_key)]
+                if other_tokens != text_tokens:
+                    continue  # a changed word, number or sign is a different text, however similar the characters
+                similarity = jaccard(shingle_set, other_shingles)
+                if similarity >= self.threshold:
+                    return other_key, similarity
+
+        if (component_type, key) not in self._entries:
+            self._entries[(component_type, key)] = (shingle_set, text_tokens)
+            for band_key in band_keys:
+                self._buckets[band_key].append(key)
+        return key, None
@@ -0,0 +1,250 @@
+"""
+llm_cache.py
+------------
+Response cache shared by the assignment (`invoke_llm`) and mark scheme
+(`invoke_openai`) LLM call sites.
+
+* Key   : SHA-256 over (model, prompt, payload, output schema)
+* Value : the raw response text
+* Backends: SQLite (default) or one-file-per-entry on disk; both support a TTL
+  and a max-entry LRU bound. Pass `LLM_CACHE_BACKEND=none` to disable.
+* `ResponseCache.stats()` reports hit/miss counters for the process.
+
+Only successful responses should be stored, so a failed or empty call is
+always retried against the provider.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "sqlite").lower()
+LLM_CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", "llm_cache"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+
+def _jsonable(obj: Any) -> Any:
+    """Best-effort conversion of SDK message objects / pydantic models into JSON-serialisable data."""
+    if hasattr(obj, "as_dict"):  # azure.ai.inference models
+        return obj.as_dict()
+    if hasattr(obj, "model_dump"):  # pydantic models
+        return obj.model_dump()
+    return str(obj)
+
+
+def make_cache_key(model: str, prompt: str, payload: Any = None, schema: Any = None) -> str:
+    """Stable hash of everything that determines an LLM response."""
+    src = json.dumps(
+        {"model": model, "prompt": prompt, "payload": payload, "schema": schema},
+        sort_keys=True,
+        default=_jsonable,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Base class / no-op backend. Subclasses implement _get, _set, delete and clear."""
+
+    def __init__(self, ttl_seconds: float = LLM_CACHE_TTL_SECONDS, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        if value:
+            self._set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+    def _get(self, key: str) -> Optional[str]:
+        return None
+
+    def _set(self, key: str, value: str) -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class SqliteResponseCache(ResponseCache):
+    def __init__(self, db_path: Path, **kwargs):
+        super().__init__(**kwargs)
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def _set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            if self.max_entries:
+                # Keep only the max_entries most recently used rows
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class FileResponseCache(ResponseCache):
+    """One `<key>.json` file per entry; the file's mtime is its last-access time for LRU eviction."""
+
+    def __init__(self, cache_dir: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError):
+            path.unlink(missing_ok=True)
+            return None
+        if self.ttl_seconds and time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def _set(self, key: str, value: str) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps({"created_at": time.time(), "value": value}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        if not self.max_entries:
+            return
+        with self._lock:
+            entries = []
+            for path in self.cache_dir.glob("*/*.json"):
+                try:
+                    entries.append((path.stat().st_mtime, path))
+                except FileNotFoundError:
+                    continue
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort()
+            for _, path in entries[: len(entries) - self.max_entries]:
+                path.unlink(missing_ok=True)
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        for path in self.cache_dir.glob("*/*.json"):
+            path.unlink(missing_ok=True)
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def _build_default_cache() -> ResponseCache:
+    try:
+        if LLM_CACHE_BACKEND == "sqlite":
+            return SqliteResponseCache(LLM_CACHE_PATH / "responses.sqlite3")
+        if LLM_CACHE_BACKEND == "file":
+            return FileResponseCache(LLM_CACHE_PATH / "responses")
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Could not open %s LLM response cache at %s: %s. Caching disabled.", LLM_CACHE_BACKEND, LLM_CACHE_PATH, e)
+    return ResponseCache()
+
+
+def get_response_cache() -> ResponseCache:
+    """The process-wide response cache, created on first use from the LLM_CACHE_* settings."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = _build_default_cache()
+    return _response_cache
+
+
+def set_response_cache(cache: ResponseCache) -> None:
+    """Swaps in a different backend (e.g. a shared store, or ResponseCache() to disable caching)."""
+    global _response_cache
+    with _response_cache_lock:
+        _response_cache = cache
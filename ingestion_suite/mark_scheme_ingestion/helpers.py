@@ -1,14 +1,23 @@
 from pathlib import Path
 import os
+import re
+import uuid
+import atexit
 import base64
 import logging
-from typing import Any, Dict, Optional, List # Added List
+import threading
+from typing import Any, Dict, Iterator, Optional, List, Tuple # Added List
 
+import requests
+from requests.adapters import HTTPAdapter
 from azure.ai.inference import ChatCompletionsClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 
 from pdf2image import convert_from_path, pdfinfo_from_path
 
+from .image_preparation import prepare_image_for_model
+
 
 # load_dotenv should be handled by the main Flask app.
 # from dotenv import load_dotenv
@@ -39,68 +48,164 @@ def fetch_test_file_path(*path_parts: str, index: int = 0) -> Path:
 
     return Path(str(pdfs[idx]).replace('\\', '/'))
 
+# ──────────────────────── LLM client registry ─────────────────────────
+# ChatCompletionsClient is safe to share across threads, so one client (and one
+# keep-alive connection pool) is kept per model/endpoint for the life of the process.
+# Pool size should be at least the page/detail extraction concurrency.
+HTTP_POOL_MAXSIZE = int(os.getenv("AZURE_HTTP_POOL_MAXSIZE", "16"))
+
+_llm_clients: Dict[Tuple[str, str, str], ChatCompletionsClient] = {}
+_llm_clients_lock = threading.Lock()
+
+
+def _build_transport() -> RequestsTransport:
+    """A requests-based transport whose session keeps up to HTTP_POOL_MAXSIZE warm connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session, session_owner=True)
+
+
 def get_llm(model_name: str) -> Optional[ChatCompletionsClient]:
-    """Return an AzureChatOpenAI instance (or None on config error)."""
+    """Return the shared ChatCompletionsClient for this model/endpoint (or None on config error)."""
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT_4_1")
     key = os.getenv("AZURE_OPENAI_API_KEY")
     version = os.getenv("AZURE_OPENAI_VERSION_4_1")
 
-    print(endpoint)
-    print(key)
-    print(version)
+    if not endpoint or not key:
+        logger.error("Azure OpenAI configuration missing or incomplete for model: %s", model_name)
+        return None
 
-    client = ChatCompletionsClient(
-        endpoint=endpoint,
-        credential=AzureKeyCredential(key),
-        api_version=version,
-    )
+    registry_key = (model_name, endpoint, version or "")
+    client = _llm_clients.get(registry_key)
+    if client is not None:
+        return client
 
-    try:
+    with _llm_clients_lock:
+        # Another thread may have created it while we waited for the lock
+        client = _llm_clients.get(registry_key)
+        if client is not None:
+            return client
+        try:
+            client = ChatCompletionsClient(
+                endpoint=endpoint,
+                credential=AzureKeyCredential(key),
+                api_version=version,
+                transport=_build_transport(),
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("LLM init error: %s", exc)
+            return None
+        _llm_clients[registry_key] = client
+        logger.info("Created pooled LLM client for model %s at %s", model_name, endpoint)
         return client
-    except Exception as exc:  # pylint: disable=broad-except
-        logger.exception("LLM init error: %s", exc)
-        return None
 
-# MODIFIED pdf_to_images function
-def pdf_to_images(pdf_path: Path, output_image_folder: Path) -> list[Path]:
+
+def close_llm_clients() -> None:
+    """Closes every pooled client and its connections. Later get_llm calls create fresh ones."""
+    with _llm_clients_lock:
+        clients = list(_llm_clients.values())
+        _llm_clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error closing LLM client: %s", exc)
+
+
+atexit.register(close_llm_clients)
+
+# ──────────────────────── PDF rasterisation ─────────────────────────
+# Pages are rendered a few at a time straight to disk (pdf2image paths_only mode), so
+# memory stays flat regardless of page count and each page can be used as soon as it exists.
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "200"))
+PDF_RENDER_GRAYSCALE = os.getenv("PDF_RENDER_GRAYSCALE", "false").lower() in ("1", "true", "yes")
+PDF_RENDER_THREADS = int(os.getenv("PDF_RENDER_THREADS", "2"))
+PDF_RENDER_BATCH_PAGES = int(os.getenv("PDF_RENDER_BATCH_PAGES", "2"))
+
+_RENDERED_PAGE_RE = re.compile(r"-(\d+)\.png$")
+
+
+def iter_pdf_to_images(
+    pdf_path: Path,
+    output_image_folder: Path,
+    dpi: int = PDF_RENDER_DPI,
+    grayscale: bool = PDF_RENDER_GRAYSCALE,
+    thread_count: int = PDF_RENDER_THREADS,
+    batch_pages: int = PDF_RENDER_BATCH_PAGES,
+) -> Iterator[Path]:
     """
-    Convert a PDF file to a list of image file paths, one per page.
-    Images are saved in the specified output_image_folder.
+    Render a PDF to `page_<n>.png` files in output_image_folder, yielding each path
+    (in page order) as soon as its batch of `batch_pages` pages has been written.
+    Each batch is split across `thread_count` pdftoppm processes.
+    Raises on failure (missing file, Poppler not installed, corrupt PDF).
     """
     if not pdf_path.exists():
-        logger.error(f"PDF file not found: {pdf_path}")
-        return []
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
 
     output_image_folder.mkdir(parents=True, exist_ok=True)
-    image_paths = []
-
+    poppler_path_env = os.getenv('POPPLER_PATH') # crucial for pdf2image on many systems
+    page_count = int(pdfinfo_from_path(str(pdf_path), poppler_path=poppler_path_env).get("Pages", 0))
+    batch_pages = max(1, batch_pages)
+
+    for first_page in range(1, page_count + 1, batch_pages):
+        last_page = min(page_count, first_page + batch_pages - 1)
+        batch_prefix = f"render_{uuid.uuid4().hex}"
+        rendered = convert_from_path(
+            str(pdf_path),
+            dpi=dpi,
+            output_folder=str(output_image_folder),
+            first_page=first_page,
+            last_page=last_page,
+            fmt="png",
+            thread_count=max(1, min(thread_count, last_page - first_page + 1)),
+            output_file=batch_prefix,
+            paths_only=True,
+            grayscale=grayscale,
+            poppler_path=poppler_path_env,
+        )
+        # pdftoppm names files <prefix>[-<thread>]-<page>.png; order by the page number
+        rendered = sorted(rendered, key=lambda p: int(_RENDERED_PAGE_RE.search(str(p)).group(1)))
+        if len(rendered) != last_page - first_page + 1:
+            raise RuntimeError(f"Expected pages {first_page}-{last_page} of {pdf_path.name}, got {len(rendered)} images.")
+
+        for page_number, rendered_path in enumerate(rendered, start=first_page):
+            page_path = output_image_folder / f"page_{page_number}.png"
+            os.replace(rendered_path, page_path)
+            yield page_path
+
+    logger.info(f"Converted PDF {pdf_path.name} to {page_count} images in {output_image_folder}")
+
+
+def pdf_to_images(pdf_path: Path, output_image_folder: Path, **render_options: Any) -> list[Path]:
+    """
+    Convert a PDF file to a list of image file paths, one per page.
+    Images are saved in the specified output_image_folder. Returns [] on failure.
+    See iter_pdf_to_images for the streaming version and render options.
+    """
     try:
-        # Get POPPLER_PATH from environment; crucial for pdf2image on many systems
-        poppler_path_env = os.getenv('POPPLER_PATH')
-        images = convert_from_path(str(pdf_path), poppler_path=poppler_path_env)
-
-        for i, image in enumerate(images):
-            image_filename = f"page_{i+1}.png"
-            persistent_image_path = output_image_folder / image_filename
-            image.save(persistent_image_path, "PNG")
-            image_paths.append(persistent_image_path)
-        logger.info(f"Converted PDF {pdf_path.name} to {len(image_paths)} images in {output_image_folder}")
+        return list(iter_pdf_to_images(pdf_path, output_image_folder, **render_options))
     except Exception as e:
         logger.error(f"Failed to convert PDF {pdf_path.name} to images: {e}")
         logger.error("Ensure Poppler is installed and POPPLER_PATH environment variable is set correctly if needed.")
-        # import traceback # Uncomment for detailed stack trace during debugging
-        # traceback.print_exc() # Uncomment for detailed stack trace
         return [] # Return empty list on failure
 
-    return image_paths
-
 
-def load_image_as_data_url(image_path: Path) -> Optional[str]:
-    """Encodes an image file to a base64 data URL."""
+def load_image_as_data_url(image_path: Path, model_name: Optional[str] = None) -> Optional[str]:
+    """
+    Encodes an image file to a base64 data URL. With a model_name, the image first goes
+    through that model's preparation profile (crop, grayscale, downscale, re-encode).
+    """
     if not image_path.exists():
         logger.error(f"Image file not found for data URL: {image_path}")
         return None
     try:
+        prepared = prepare_image_for_model(image_path, model_name) if model_name else None
+        if prepared:
+            image_bytes, mime_type = prepared
+            return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
         with open(image_path, "rb") as image_file:
             encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
 
@@ -0,0 +1,176 @@
+"""
+image_preparation.py
+--------------------
+Shrinks mark scheme page images before they are base64-encoded and sent to the
+vision model. Full-DPI lossless PNGs make very large request bodies, while the
+provider downsamples them anyway (OpenAI vision models fit the short side to
+768 px at "high" detail), so the extra pixels only cost upload time.
+
+Per page, in order:
+  1. crop whitespace margins (keeping a small padding),
+  2. convert to grayscale and/or quantise to a small palette,
+  3. downscale to fit the profile's short/long side limits,
+  4. re-encode as PNG, JPEG or WebP.
+
+Profiles are chosen per model (IMAGE_PREP_PROFILES, falling back to the
+MARK_SCHEME_IMAGE_* environment settings), and `image_prep_stats()` reports the
+bytes saved in this process.
+"""
+
+import io
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREP_ENABLED = os.getenv("MARK_SCHEME_IMAGE_PREP_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+class ImagePrepProfile:
+    def __init__(
+        self,
+        max_short_side: int = 768,      # 0 = no limit
+        max_long_side: int = 2048,      # 0 = no limit
+        grayscale: bool = True,
+        palette_colors: int = 0,        # >0 quantises to that many colours (PNG only)
+        image_format: str = "png",      # png | jpeg | webp
+        quality: int = 85,              # JPEG / WebP quality
+        crop_margins: bool = True,
+        crop_padding: int = 16,         # px kept around the content after cropping
+        crop_threshold: int = 245,      # pixels darker than this count as content
+    ):
+        self.max_short_side = max_short_side
+        self.max_long_side = max_long_side
+        self.grayscale = grayscale
+        self.palette_colors = palette_colors
+        self.image_format = image_format.lower()
+        self.quality = quality
+        self.crop_margins = crop_margins
+        self.crop_padding = crop_padding
+        self.crop_threshold = crop_threshold
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+DEFAULT_IMAGE_PREP_PROFILE = ImagePrepProfile(
+    max_short_side=int(os.getenv("MARK_SCHEME_IMAGE_MAX_SHORT_SIDE", "768")),
+    max_long_side=int(os.getenv("MARK_SCHEME_IMAGE_MAX_LONG_SIDE", "2048")),
+    grayscale=_env_bool("MARK_SCHEME_IMAGE_GRAYSCALE", True),
+    palette_colors=int(os.getenv("MARK_SCHEME_IMAGE_PALETTE_COLORS", "0")),
+    image_format=os.getenv("MARK_SCHEME_IMAGE_FORMAT", "png"),
+    quality=int(os.getenv("MARK_SCHEME_IMAGE_QUALITY", "85")),
+    crop_margins=_env_bool("MARK_SCHEME_IMAGE_CROP_MARGINS", True),
+)
+
+# Model-specific overrides; models not listed use DEFAULT_IMAGE_PREP_PROFILE.
+IMAGE_PREP_PROFILES: Dict[str, ImagePrepProfile] = {}
+
+_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+def get_image_prep_profile(model_name: Optional[str]) -> ImagePrepProfile:
+    return IMAGE_PREP_PROFILES.get(model_name or "", DEFAULT_IMAGE_PREP_PROFILE)
+
+
+def _crop_margins(image: Image.Image, profile: ImagePrepProfile) -> Image.Image:
+    # Content = anything darker than the threshold; getbbox() finds the non-zero region of the inverted mask
+    mask = image.convert("L").point(lambda v: 255 if v < profile.crop_threshold else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image  # blank page
+    left, top, right, bottom = bbox
+    pad = profile.crop_padding
+    return image.crop((max(0, left - pad), max(0, top - pad), min(image.width, right + pad), min(image.height, bottom + pad)))
+
+
+def _downscale(image: Image.Image, profile: ImagePrepProfile) -> Image.Image:
+    short_side, long_side = sorted(image.size)
+    scale = 1.0
+    if profile.max_short_side:
+        scale = min(scale, profile.max_short_side / short_side)
+    if profile.max_long_side:
+        scale = min(scale, profile.max_long_side / long_side)
+    if scale >= 1.0:
+        return image
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def prepare_image(image_path: Path, profile: ImagePrepProfile) -> Tuple[bytes, str]:
+    """Returns (encoded bytes, MIME type) of the prepared page image."""
+    with Image.open(image_path) as source:
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white so cropping and JPEG encoding behave
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").split()[-1])
+        image = background
+
+    if profile.crop_margins:
+        image = _crop_margins(image, profile)
+    image = _downscale(image, profile)
+    image = image.convert("L") if profile.grayscale else image.convert("RGB")
+
+    out = io.BytesIO()
+    if profile.image_format in ("jpeg", "jpg"):
+        image.save(out, "JPEG", quality=profile.quality, optimize=True)
+    elif profile.image_format == "webp":
+        image.save(out, "WEBP", quality=profile.quality, method=4)
+    else:
+        if profile.palette_colors:
+            image = image.quantize(colors=profile.palette_colors)
+        image.save(out, "PNG", optimize=True)
+    return out.getvalue(), _MIME_TYPES.get(profile.image_format, "image/png")
+
+
+# ─────────────────────────── savings stats ───────────────────────────
+_stats_lock = threading.Lock()
+_stats = {"images": 0, "original_bytes": 0, "prepared_bytes": 0}
+
+
+def _record(original_bytes: int, prepared_bytes: int) -> None:
+    with _stats_lock:
+        _stats["images"] += 1
+        _stats["original_bytes"] += original_bytes
+        _stats["prepared_bytes"] += prepared_bytes
+
+
+def image_prep_stats() -> Dict[str, Any]:
+    """Totals for every image prepared in this process."""
+    with _stats_lock:
+        stats = dict(_stats)
+    original = stats["original_bytes"]
+    stats["saved_bytes"] = original - stats["prepared_bytes"]
+    stats["saved_ratio"] = round(stats["saved_bytes"] / original, 3) if original else 0.0
+    return stats
+
+
+def prepare_image_for_model(image_path: Path, model_name: Optional[str]) -> Optional[Tuple[bytes, str]]:
+    """
+    Prepared (bytes, MIME type) for the model's profile, or None if preparation is
+    disabled, fails, or would not make the image smaller (callers then send the file as-is).
+    """
+    if not IMAGE_PREP_ENABLED:
+        return None
+    try:
+        original_size = image_path.stat().st_size
+        prepared, mime_type = prepare_image(image_path, get_image_prep_profile(model_name))
+    except Exception as e:  # pylint: disable=broad-except
+        logger.warning(f"Image preparation failed for {image_path}: {e}. Sending the original.")
+        return None
+
+    if len(prepared) >= original_size:
+        _record(original_size, original_size)
+        return None
+    _record(original_size, len(prepared))
+    logger.info(f"Prepared {image_path.name} for {model_name}: {original_size} -> {len(prepared)} bytes ({1 - len(prepared) / original_size:.0%} smaller)")
+    return prepared, mime_type
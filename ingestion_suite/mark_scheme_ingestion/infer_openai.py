@@ -6,32 +6,58 @@ from azure.ai.inference.models import (
     JsonSchemaFormat
     )
 
-from typing import List
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel
 from .helpers import get_llm, load_image_as_data_url
+from ..llm_cache import get_response_cache, make_cache_key
+
+
+@lru_cache(maxsize=None)
+def get_response_format(output_format: type) -> Tuple[Dict[str, Any], JsonSchemaFormat]:
+    """JSON schema and response_format of an output model, generated once per model class."""
+    schema = output_format.model_json_schema()
+    return schema, JsonSchemaFormat(name="output_format", schema=schema)
+
 
 def invoke_openai(
     prompt: str,
     model_name: str,
     output_format: BaseModel = None,
-    payload: List[UserMessage] = None
+    payload: List[UserMessage] = None,
+    use_cache: bool = True,
+    timeout: Optional[float] = None, # Seconds for the whole call, retries included
 ) -> str:
+    schema, response_format = get_response_format(output_format) if output_format is not None else (None, None)
+
+    # Same model + prompt + payload (e.g. page image) + schema -> same response; skip the call
+    cache = get_response_cache() if use_cache else None
+    cache_key = make_cache_key(model_name, prompt, payload, schema) if cache else None
+    if cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     client = get_llm(model_name)
     request_kwargs = {
         "messages": [SystemMessage(content=prompt), *payload],
         "model": model_name,
     }
 
-    if output_format is not None:
-        request_kwargs["response_format"] = JsonSchemaFormat(
-            name="output_format",
-            schema=output_format.model_json_schema()
-        )
+    if response_format is not None:
+        request_kwargs["response_format"] = response_format
+    if timeout is not None:
+        # azure-core stops retrying once `timeout` has passed; read_timeout bounds a stalled response
+        request_kwargs["timeout"] = timeout
+        request_kwargs["read_timeout"] = timeout
 
     response = client.complete(**request_kwargs)
 
-    return response.choices[0].message.content
+    content = response.choices[0].message.content
+    if cache and content:
+        cache.set(cache_key, content)
+    return content
 
 # if __name__ == "__main__":
 #     image_path = "June 2020 MS_images\\page_6.png"
@@ -1,7 +1,10 @@
 import json
 import os # For os.getenv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FuturesTimeoutError
 from pathlib import Path
-from typing import List, Union, cast # Added Union and cast
+from typing import Dict, Iterable, Iterator, List, Optional, Union, cast # Added Union and cast
 
 from azure.ai.inference.models import TextContentItem, UserMessage
 
@@ -25,36 +28,69 @@ from .prompt_lib import (
     extract_rubric_mark_scheme_prompt, # Added rubric prompt
     extract_mark_schemes_from_image_and_classify_prompt
 )
-from .helpers import pdf_to_images as csis_pdf_to_images # Use aliased helper
+from .helpers import iter_pdf_to_images as csis_iter_pdf_to_images # Use aliased helper
 from .structured_extraction import extract_mark_scheme_information_from_images_openai
+from .image_preparation import image_prep_stats
+from .prompt_compiler import compile_prompt, render_example
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def extract_generic_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation) -> MarkSchemeBaseModel:
+# Prompts with the few-shot examples rendered once. Per-question context (question text,
+# marks) goes in the user message, so each system prompt is byte-identical across
+# questions and forms a prefix the provider's prompt cache can reuse.
+GENERIC_MARK_SCHEME_PROMPT = compile_prompt(
+    extract_generic_mark_scheme_prompt,
+    question_text="",
+    marks_available="",
+    example_output_1=render_example(extract_generic_mark_scheme_example_output_1),
+    example_output_2=render_example(extract_generic_mark_scheme_example_output_2),
+    example_output_3=render_example(extract_generic_mark_scheme_example_output_3),
+    # example_output_4=render_example(extract_generic_mark_scheme_example_output_4) # Add if you have a 4th example
+).render()
+LEVELLED_MARK_SCHEME_PROMPT = compile_prompt(
+    extract_levelled_mark_scheme_prompt,
+    question_text="",
+    example_output_1=render_example(extract_levelled_mark_scheme_example_output_1),
+    example_output_2=render_example(extract_levelled_mark_scheme_example_output_2)
+).render()
+RUBRIC_MARK_SCHEME_PROMPT = compile_prompt(
+    extract_rubric_mark_scheme_prompt,
+    question_text="",
+    example_output_1=render_example(extract_rubric_mark_scheme_example_output_1), # Ensure these examples exist
+    example_output_2=render_example(extract_rubric_mark_scheme_example_output_2)
+).render()
+
+_QUESTION_TEXT_CONTEXT = compile_prompt("\nFor your context, the question that the mark scheme is for is as follows: \n<question>\n{question_text}\n</question>")
+_MARKS_AVAILABLE_CONTEXT = compile_prompt("\nFor additional context, the total marks available for the question is as follows: \n<marks_available>\n{marks_available}\n</marks_available>")
+
+
+def _mark_scheme_user_message(mark_scheme_raw: ExtractedMarkSchemeInformation, include_marks: bool = False) -> UserMessage:
+    """Per-question context followed by the raw mark scheme text."""
+    context = ""
+    if mark_scheme_raw.get("question_text"):
+        context += _QUESTION_TEXT_CONTEXT.render(question_text=mark_scheme_raw.get("question_text"))
+    if include_marks and mark_scheme_raw.get("marks_available") is not None:
+        context += _MARKS_AVAILABLE_CONTEXT.render(marks_available=str(mark_scheme_raw.get("marks_available")))
+
+    content = [TextContentItem(text=context.lstrip("\n"))] if context else []
+    content.append(TextContentItem(text=mark_scheme_raw.get('mark_scheme_information', '')))
+    return UserMessage(content=content)
+
+
+def extract_generic_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation, timeout: Optional[float] = None) -> MarkSchemeBaseModel:
     logger.info(f"Extracting generic mark scheme for: {mark_scheme_raw.get('question_number', 'N/A')}")
-    question_text_context = f"\nFor your context, the question that the mark scheme is for is as follows: \n<question>\n{mark_scheme_raw.get('question_text')}\n</question>" if mark_scheme_raw.get("question_text") else ""
-    marks_available_context = f"\nFor additional context, the total marks available for the question is as follows: \n<marks_available>\n{str(mark_scheme_raw.get('marks_available'))}\n</marks_available>" if mark_scheme_raw.get("marks_available") is not None else ""
-
-    prompt = extract_generic_mark_scheme_prompt.format(
-        question_text=question_text_context,
-        marks_available=marks_available_context,
-        example_output_1=json.dumps(extract_generic_mark_scheme_example_output_1, indent=2),
-        example_output_2=json.dumps(extract_generic_mark_scheme_example_output_2, indent=2),
-        example_output_3=json.dumps(extract_generic_mark_scheme_example_output_3, indent=2),
-        # example_output_4=json.dumps(extract_generic_mark_scheme_example_output_4, indent=2) # Add if you have a 4th example
-    )
-
     mark_scheme_content_for_llm = mark_scheme_raw.get('mark_scheme_information', '')
-    user_message = UserMessage(content=[TextContentItem(text=mark_scheme_content_for_llm)])
+    user_message = _mark_scheme_user_message(mark_scheme_raw, include_marks=True)
 
     try:
         response_str = invoke_openai(
-            prompt=prompt,
+            prompt=GENERIC_MARK_SCHEME_PROMPT,
             model_name="gpt-4.1",
             output_format=MarkSchemeBaseModel, # Pass the Pydantic model class
-            payload=[user_message]
+            payload=[user_message],
+            timeout=timeout,
         )
         if response_str:
             # The invoke_openai should ideally return a dict if output_format is used with azure.ai.inference
@@ -70,25 +106,18 @@ def extract_generic_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation)
         return MarkSchemeBaseModel(criteria=[], total_marks_available=mark_scheme_raw.get('marks_available'))
 
 
-def extract_levelled_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation) -> ObjectiveMarkSchemeModel:
+def extract_levelled_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation, timeout: Optional[float] = None) -> ObjectiveMarkSchemeModel:
     logger.info(f"Extracting levelled mark scheme for: {mark_scheme_raw.get('question_number', 'N/A')}")
-    question_text_context = f"\nFor your context, the question that the mark scheme is for is as follows: \n<question>\n{mark_scheme_raw.get('question_text')}\n</question>" if mark_scheme_raw.get("question_text") else ""
-
-    prompt = extract_levelled_mark_scheme_prompt.format(
-        question_text=question_text_context,
-        example_output_1=json.dumps(extract_levelled_mark_scheme_example_output_1, indent=2),
-        example_output_2=json.dumps(extract_levelled_mark_scheme_example_output_2, indent=2)
-    )
-
     mark_scheme_content_for_llm = mark_scheme_raw.get('mark_scheme_information', '')
-    user_message = UserMessage(content=[TextContentItem(text=mark_scheme_content_for_llm)])
+    user_message = _mark_scheme_user_message(mark_scheme_raw)
 
     try:
         response_str = invoke_openai(
-            prompt=prompt,
+            prompt=LEVELLED_MARK_SCHEME_PROMPT,
             model_name="gpt-4.1",
             output_format=ObjectiveMarkSchemeModel, # Pass Pydantic model
-            payload=[user_message]
+            payload=[user_message],
+            timeout=timeout,
         )
         if response_str:
             parsed_response = json.loads(response_str) if isinstance(response_str, str) else response_str
@@ -102,26 +131,18 @@ def extract_levelled_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation
         return ObjectiveMarkSchemeModel(objective="Error", mark_scheme=[])
 
 
-def extract_rubric_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation) -> RubricMarkSchemeModel:
+def extract_rubric_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation, timeout: Optional[float] = None) -> RubricMarkSchemeModel:
     logger.info(f"Extracting rubric mark scheme for: {mark_scheme_raw.get('question_number', 'N/A')}")
-    question_text_context = f"\nFor your context, the question that the mark scheme is for is as follows: \n<question>\n{mark_scheme_raw.get('question_text')}\n</question>" if mark_scheme_raw.get("question_text") else ""
-
-    # Assuming extract_rubric_mark_scheme_prompt exists and is similar to others
-    prompt = extract_rubric_mark_scheme_prompt.format(
-        question_text=question_text_context,
-        example_output_1=json.dumps(extract_rubric_mark_scheme_example_output_1, indent=2), # Ensure these examples exist
-        example_output_2=json.dumps(extract_rubric_mark_scheme_example_output_2, indent=2)
-    )
-
     mark_scheme_content_for_llm = mark_scheme_raw.get('mark_scheme_information', '')
-    user_message = UserMessage(content=[TextContentItem(text=mark_scheme_content_for_llm)])
+    user_message = _mark_scheme_user_message(mark_scheme_raw)
 
     try:
         response_str = invoke_openai(
-            prompt=prompt,
+            prompt=RUBRIC_MARK_SCHEME_PROMPT,
             model_name="gpt-4.1",
             output_format=RubricMarkSchemeModel, # Pass Pydantic model
-            payload=[user_message]
+            payload=[user_message],
+            timeout=timeout,
         )
         if response_str:
             parsed_response = json.loads(response_str) if isinstance(response_str, str) else response_str
@@ -134,62 +155,160 @@ def extract_rubric_mark_scheme(mark_scheme_raw: ExtractedMarkSchemeInformation)
         return RubricMarkSchemeModel(rubric=[])
 
 
-def route_and_extract_mark_schemes(
-    raw_mark_schemes_list: List[ExtractedMarkSchemeInformation]
-) -> IngestedMarkSchemesModel:
-
-    processed_mark_schemes: List[SingleIngestedMarkSchemeType] = []
+# Concurrency cap and per-item timeout (seconds) for the detailed extraction pass.
+DETAIL_EXTRACTION_CONCURRENCY = int(os.getenv("MARK_SCHEME_DETAIL_CONCURRENCY", "8"))
+DETAIL_EXTRACTION_TIMEOUT = float(os.getenv("MARK_SCHEME_DETAIL_TIMEOUT", "180"))
 
-    for raw_ms_info_dict in raw_mark_schemes_list:
-        # Ensure raw_ms_info_dict is a dictionary, not the Pydantic model instance yet,
-        # or convert Pydantic model to dict if needed by classification functions.
-        # The functions extract_generic/levelled/rubric expect ExtractedMarkSchemeInformation (which is a dict-like Pydantic model)
+# One pool for every job, so the cap holds process-wide, including calls still
+# running after their item timed out
+_detail_executor: Optional[ThreadPoolExecutor] = None
+_detail_executor_lock = threading.Lock()
 
-        # No need to create Pydantic model here if functions accept dict-like
-        # raw_ms_pydantic_item = ExtractedMarkSchemeInformation(**raw_ms_info_dict)
 
-        classification = raw_ms_info_dict.get('classification')
-        question_number = raw_ms_info_dict.get('question_number', 'UNKNOWN_QN')
+def _get_detail_executor() -> ThreadPoolExecutor:
+    global _detail_executor
+    with _detail_executor_lock:
+        if _detail_executor is None:
+            _detail_executor = ThreadPoolExecutor(max_workers=max(1, DETAIL_EXTRACTION_CONCURRENCY), thread_name_prefix="ms-detail")
+        return _detail_executor
 
-        extracted_detail: Union[MarkSchemeBaseModel, ObjectiveMarkSchemeModel, RubricMarkSchemeModel, None] = None
-        final_type_str = ""
 
-        if classification == "generic":
-            extracted_detail = extract_generic_mark_scheme(raw_ms_info_dict)
-            final_type_str = "generic"
-        elif classification == "levelled":
-            extracted_detail = extract_levelled_mark_scheme(raw_ms_info_dict)
-            final_type_str = "levelled"
-        elif classification == "rubric":
-            extracted_detail = extract_rubric_mark_scheme(raw_ms_info_dict)
-            final_type_str = "rubric"
-        else:
-            logger.warning(f"Unknown classification: '{classification}' for question '{question_number}'. Skipping detailed extraction for this item.")
-            # Create a placeholder or skip
-            # For now, let's create a basic entry to acknowledge it was seen
-            extracted_detail = MarkSchemeBaseModel(criteria=[], total_marks_available=raw_ms_info_dict.get('marks_available'))
-            final_type_str = "unknown_classification"
-
-
-        # Construct the SingleIngestedMarkSchemeType object
-        # Ensure all fields are present or have defaults
-        ingested_item_data = {
-            "type": final_type_str,
-            "question_number": question_number,
-            "question_text": raw_ms_info_dict.get("question_text"),
-            "marks_available": raw_ms_info_dict.get("marks_available"),
-            "mark_scheme_information": raw_ms_info_dict.get("mark_scheme_information", ""), # Raw text
-            "mark_scheme": extracted_detail # The structured Pydantic model
-        }
-        try:
-            processed_mark_schemes.append(SingleIngestedMarkSchemeType(**ingested_item_data))
-        except Exception as e_pydantic:
-            logger.error(f"Pydantic validation error for QN {question_number} with type {final_type_str}: {e_pydantic}")
-            logger.error(f"Data causing error: {ingested_item_data}")
+def _fallback_mark_scheme(classification: Optional[str], raw_ms_info_dict: ExtractedMarkSchemeInformation) -> Union[MarkSchemeBaseModel, ObjectiveMarkSchemeModel, RubricMarkSchemeModel]:
+    """The same minimal models the extract_* functions return when the LLM call fails."""
+    if classification == "levelled":
+        return ObjectiveMarkSchemeModel(objective="Error", mark_scheme=[])
+    if classification == "rubric":
+        return RubricMarkSchemeModel(rubric=[])
+    return MarkSchemeBaseModel(criteria=[], total_marks_available=raw_ms_info_dict.get('marks_available'))
+
+
+def _extract_mark_scheme_detail(raw_ms_info_dict: ExtractedMarkSchemeInformation, timeout: Optional[float] = None) -> Optional[SingleIngestedMarkSchemeType]:
+    """Routes one raw mark scheme to its detailed extractor and wraps the result."""
+    # Ensure raw_ms_info_dict is a dictionary, not the Pydantic model instance yet,
+    # or convert Pydantic model to dict if needed by classification functions.
+    # The functions extract_generic/levelled/rubric expect ExtractedMarkSchemeInformation (which is a dict-like Pydantic model)
+    classification = raw_ms_info_dict.get('classification')
+    question_number = raw_ms_info_dict.get('question_number', 'UNKNOWN_QN')
+
+    extracted_detail: Union[MarkSchemeBaseModel, ObjectiveMarkSchemeModel, RubricMarkSchemeModel, None] = None
+    final_type_str = ""
+
+    if classification == "generic":
+        extracted_detail = extract_generic_mark_scheme(raw_ms_info_dict, timeout=timeout)
+        final_type_str = "generic"
+    elif classification == "levelled":
+        extracted_detail = extract_levelled_mark_scheme(raw_ms_info_dict, timeout=timeout)
+        final_type_str = "levelled"
+    elif classification == "rubric":
+        extracted_detail = extract_rubric_mark_scheme(raw_ms_info_dict, timeout=timeout)
+        final_type_str = "rubric"
+    else:
+        logger.warning(f"Unknown classification: '{classification}' for question '{question_number}'. Skipping detailed extraction for this item.")
+        # Create a placeholder or skip
+        # For now, let's create a basic entry to acknowledge it was seen
+        extracted_detail = MarkSchemeBaseModel(criteria=[], total_marks_available=raw_ms_info_dict.get('marks_available'))
+        final_type_str = "unknown_classification"
+
+    return _build_ingested_item(raw_ms_info_dict, final_type_str, extracted_detail)
+
+
+def _build_ingested_item(
+    raw_ms_info_dict: ExtractedMarkSchemeInformation,
+    final_type_str: str,
+    extracted_detail: Union[MarkSchemeBaseModel, ObjectiveMarkSchemeModel, RubricMarkSchemeModel]
+) -> Optional[SingleIngestedMarkSchemeType]:
+    question_number = raw_ms_info_dict.get('question_number', 'UNKNOWN_QN')
+
+    # Construct the SingleIngestedMarkSchemeType object
+    # Ensure all fields are present or have defaults
+    ingested_item_data = {
+        "type": final_type_str,
+        "question_number": question_number,
+        "question_text": raw_ms_info_dict.get("question_text"),
+        "marks_available": raw_ms_info_dict.get("marks_available"),
+        "mark_scheme_information": raw_ms_info_dict.get("mark_scheme_information", ""), # Raw text
+        "mark_scheme": extracted_detail # The structured Pydantic model
+    }
+    try:
+        return SingleIngestedMarkSchemeType(**ingested_item_data)
+    except Exception as e_pydantic:
+        logger.error(f"Pydantic validation error for QN {question_number} with type {final_type_str}: {e_pydantic}")
+        logger.error(f"Data causing error: {ingested_item_data}")
+        return None
+
+
+def _wait_for_item(future: Future, started_at: Dict[int, float], idx: int, timeout: float):
+    """
+    Waits for one item, measuring its timeout from when a worker picked it up
+    (not from submission), so items queued behind the concurrency cap are not penalised.
+    """
+    while True:
+        start = started_at.get(idx)
+        if start is None:
+            # Still queued; poll until a worker starts it (or it finishes)
+            try:
+                return future.result(timeout=0.5)
+            except FuturesTimeoutError:
+                continue
+        remaining = start + timeout - time.monotonic()
+        return future.result(timeout=max(0.0, remaining))
 
 
+def route_and_extract_mark_schemes(
+    raw_mark_schemes_list: List[ExtractedMarkSchemeInformation],
+    item_timeout: Optional[float] = None
+) -> IngestedMarkSchemesModel:
+    """
+    Runs the detailed (generic/levelled/rubric) extraction for every raw mark scheme on
+    the shared pool of DETAIL_EXTRACTION_CONCURRENCY workers. An item exceeding
+    `item_timeout` seconds gets the same empty fallback model as a failed LLM call, so
+    one slow item cannot hold up the job; the timeout is also passed to the HTTP call,
+    so its worker stops soon after. Output order always follows raw_mark_schemes_list.
+    """
+    timeout = item_timeout if item_timeout is not None else DETAIL_EXTRACTION_TIMEOUT
+
+    started_at: Dict[int, float] = {}
+
+    def _run(idx: int, raw_ms_info_dict: ExtractedMarkSchemeInformation):
+        started_at[idx] = time.monotonic()
+        return _extract_mark_scheme_detail(raw_ms_info_dict, timeout=timeout)
+
+    results: List[Optional[SingleIngestedMarkSchemeType]] = [None] * len(raw_mark_schemes_list)
+    executor = _get_detail_executor()
+    futures = [executor.submit(_run, idx, raw) for idx, raw in enumerate(raw_mark_schemes_list)]
+    try:
+        for idx, future in enumerate(futures):
+            raw_ms_info_dict = raw_mark_schemes_list[idx]
+            try:
+                results[idx] = _wait_for_item(future, started_at, idx, timeout)
+            except FuturesTimeoutError:
+                classification = raw_ms_info_dict.get('classification')
+                logger.error(f"Detailed extraction timed out after {timeout}s for QN {raw_ms_info_dict.get('question_number', 'UNKNOWN_QN')}. Using empty {classification} mark scheme.")
+                results[idx] = _build_ingested_item(raw_ms_info_dict, classification, _fallback_mark_scheme(classification, raw_ms_info_dict))
+            except Exception as e:
+                logger.error(f"Detailed extraction failed for QN {raw_ms_info_dict.get('question_number', 'UNKNOWN_QN')}: {e}")
+    finally:
+        # Items of this job that haven't started yet (e.g. after an unexpected error) are dropped
+        for future in futures:
+            future.cancel()
+
+    processed_mark_schemes: List[SingleIngestedMarkSchemeType] = [item for item in results if item is not None]
     return IngestedMarkSchemesModel(mark_schemes=processed_mark_schemes)
 
+def _rendered_pages(job_id: str, pdf_file_path: Path, output_folder: Path) -> Iterator[Path]:
+    """Yields rendered page images of the PDF, raising RuntimeError if conversion fails or yields nothing."""
+    page_count = 0
+    try:
+        for page_path in csis_iter_pdf_to_images(pdf_file_path, output_folder):
+            page_count += 1
+            yield page_path
+    except Exception as e:
+        logger.error(f"Job {job_id}: PDF to image conversion failed for {pdf_file_path.name} after {page_count} pages: {e}")
+        raise RuntimeError(f"PDF to image conversion failed for {pdf_file_path.name}: {e}") from e
+    if page_count == 0:
+        logger.error(f"Job {job_id}: PDF to image conversion produced no pages for {pdf_file_path.name}.")
+        raise RuntimeError(f"PDF to image conversion failed for {pdf_file_path.name}.")
+
 # REFACTORED ingest_mark_scheme function
 def ingest_mark_scheme(
     input_files: List[Path],
@@ -202,7 +321,7 @@ def ingest_mark_scheme(
         logger.error(f"Job {job_id}: No input files provided for mark scheme ingestion.")
         raise ValueError("No input files provided for mark scheme ingestion.")
 
-    image_paths_for_extraction: List[Path] = []
+    image_paths_for_extraction: Iterable[Path] = []
 
     # Check if input is PDF (assume only one PDF if type is PDF)
     is_pdf_input = any(f.suffix.lower() == '.pdf' for f in input_files)
@@ -219,17 +338,15 @@ def ingest_mark_scheme(
         pdf_conversion_image_folder = temp_image_base_path / job_id / "ms_pdf_pages"
         pdf_conversion_image_folder.mkdir(parents=True, exist_ok=True)
 
-        image_paths_for_extraction = csis_pdf_to_images(pdf_file_path, pdf_conversion_image_folder)
-        if not image_paths_for_extraction:
-            logger.error(f"Job {job_id}: PDF to image conversion failed for {pdf_file_path.name}.")
-            raise RuntimeError(f"PDF to image conversion failed for {pdf_file_path.name}.")
+        # Pages are streamed: extraction of page 1 starts while later pages are still rendering
+        image_paths_for_extraction = _rendered_pages(job_id, pdf_file_path, pdf_conversion_image_folder)
     else: # Input is already a list of image paths
         logger.info(f"Job {job_id}: Processing pre-uploaded images for mark scheme.")
         image_paths_for_extraction = input_files
 
-    if not image_paths_for_extraction:
-        logger.error(f"Job {job_id}: No images available for mark scheme extraction after input processing.")
-        raise RuntimeError("No images available for mark scheme extraction.")
+        if not image_paths_for_extraction:
+            logger.error(f"Job {job_id}: No images available for mark scheme extraction after input processing.")
+            raise RuntimeError("No images available for mark scheme extraction.")
 
     # Prepare the prompt for the initial image-to-text/classification step
     # This prompt is defined in prompt_lib.py
@@ -237,13 +354,15 @@ def ingest_mark_scheme(
 
     # Call the function from structured_extraction.py
     # This returns a list of ExtractedMarkSchemeInformation (as dicts after collapse_entries)
-    logger.info(f"Job {job_id}: Starting initial mark scheme extraction from {len(image_paths_for_extraction)} images.")
+    logger.info(f"Job {job_id}: Starting initial mark scheme extraction.")
     raw_extracted_ms_list: List[ExtractedMarkSchemeInformation] = extract_mark_scheme_information_from_images_openai(
         images=image_paths_for_extraction,
         prompt=prompt_for_initial_extraction,
         model_name="gpt-4.1" # Configurable model
     )
 
+    logger.info(f"Job {job_id}: Page image preparation totals so far: {image_prep_stats()}")
+
     if not raw_extracted_ms_list:
         logger.warning(f"Job {job_id}: Initial extraction (structured_extraction) returned no mark schemes.")
         # Create an empty IngestedMarkSchemesModel
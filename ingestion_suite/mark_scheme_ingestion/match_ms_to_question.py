@@ -14,14 +14,18 @@ Usage (from another script or REPL):
 """
 
 from __future__ import annotations
-import json, re
+import json, os, re, sys
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, List, Tuple, Dict, Union, Optional # Added Union
 
 import numpy as np
 from pydantic import BaseModel, Field # Added Field for potential future use
 from rapidfuzz.fuzz import token_set_ratio, partial_ratio
+from rapidfuzz.process import cdist, cpdist
+from scipy import sparse
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 from tabulate import tabulate
 import logging
 
@@ -58,15 +62,27 @@ _ROMAN = [
     "xviii","xvii","xvi","xv","xiv","xiii","xii","xi",
     "viii","vii","vi","iv","ix","iii","ii","i"
 ]
+_ROMAN_SUFFIX_RE = re.compile(r"(.*?)(" + "|".join(_ROMAN) + r")")
+_ID_DELIMITERS_RE = re.compile(r"[.\(\)\s_\-]+")
+_ID_INVALID_RE = re.compile(r"[^0-9a-z#]+")
+
+# IDs and texts repeat within a match and across jobs sharing a mark scheme, so the
+# (pure) feature extractors below are memoised in bounded LRU caches.
+FEATURE_CACHE_SIZE = int(os.getenv("MATCH_FEATURE_CACHE_SIZE", "65536"))
+
 def tokenize_id(raw: str) -> List[str]:
     """Convert any question ID into an ordered list of semantic tokens."""
     if not raw:
         return []
+    return list(_tokenize_id_cached(raw))
+
+@lru_cache(maxsize=FEATURE_CACHE_SIZE)
+def _tokenize_id_cached(raw: str) -> Tuple[str, ...]:
     s = raw.lower() # Start with lowercase
     # Replace common delimiters with a single '#'
-    s = re.sub(r"[.\(\)\s_\-]+", "#", s)
+    s = _ID_DELIMITERS_RE.sub("#", s)
     # Remove any characters that are not alphanumeric or '#'
-    s = re.sub(r"[^0-9a-z#]+", "", s)
+    s = _ID_INVALID_RE.sub("", s)
 
     toks_raw, buf = [], ""
     current_type = None # 'digit' or 'alpha'
@@ -101,24 +117,18 @@ def tokenize_id(raw: str) -> List[str]:
             continue
 
         # Roman numeral splitting (more robustly handle cases like "aiv" vs "a" + "iv")
-        # This part can be complex if prefixes mix with roman numerals.
-        # The original logic splits if a known roman numeral is a suffix.
-        found_roman_suffix = False
-        for roman in _ROMAN: # Check longer roman numerals first
-            if tok.endswith(roman):
-                prefix = tok[:-len(roman)]
-                if prefix: # If there's a part before the roman numeral
-                    # Check if prefix is purely alpha or purely digit to avoid splitting mid-token like "qiv" into "q" + "iv"
-                    # This check might need refinement based on typical ID patterns.
-                    # For now, assume if prefix exists, it's a separate part.
-                    out.append(prefix)
-                out.append(roman)
-                found_roman_suffix = True
-                break
-        if not found_roman_suffix:
+        # A known roman numeral suffix is split off, e.g. "biv" -> "b" + "iv".
+        # The lazy prefix makes the regex take the longest suffix, same as scanning _ROMAN in order.
+        m = _ROMAN_SUFFIX_RE.fullmatch(tok)
+        if m:
+            prefix, roman = m.groups()
+            if prefix: # If there's a part before the roman numeral
+                out.append(prefix)
+            out.append(roman)
+        else:
             out.append(tok)
 
-    return [t for t in out if t] # Filter out any empty strings
+    return tuple(sys.intern(t) for t in out if t) # Filter out any empty strings; intern the repeated tokens
 
 # ───────────────────────── text helpers ──────────────────────────
 _WORD_RE = re.compile(r"[a-z0-9]+") # Find alphanumeric sequences
@@ -126,9 +136,32 @@ def canonical_text(t: Optional[str]) -> str:
     """Converts text to a canonical form for comparison: lowercase, alphanumeric, limited length."""
     if not t:
         return ""
+    return _canonical_text_cached(t)
+
+@lru_cache(maxsize=FEATURE_CACHE_SIZE)
+def _canonical_text_cached(t: str) -> str:
     # Take first 120 chars of the lowercased, tokenized string
     return " ".join(_WORD_RE.findall(t.lower()))[:120]
 
+def feature_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Hit/miss counters of the tokenize_id and canonical_text caches for this process."""
+    stats = {}
+    for name, fn in (("tokenize_id", _tokenize_id_cached), ("canonical_text", _canonical_text_cached)):
+        info = fn.cache_info()
+        total = info.hits + info.misses
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hit_rate": round(info.hits / total, 3) if total else 0.0,
+        }
+    return stats
+
+def clear_feature_caches() -> None:
+    _tokenize_id_cached.cache_clear()
+    _canonical_text_cached.cache_clear()
+
 def text_similarity(a: Optional[str], b: Optional[str]) -> float:
     """
     Combined similarity using token_set_ratio, partial_ratio, and subset-Jaccard.
@@ -269,18 +302,257 @@ def text_contribution(q: OneQuestionModelV3, ms: IngestedMarkSchemeModel) -> Tup
     contrib = (current_weights.get("text", 0) * s_text) / total_w
     return s_text, contrib
 
+# ───────────────────────── vectorised scoring ────────────────────
+# Worker threads for rapidfuzz.process.cdist/cpdist (-1 = all cores)
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", "-1"))
+
+
+def _incidence(sets: List[set], vocab: Dict[Any, int]) -> sparse.csr_matrix:
+    """Sparse binary item x vocabulary matrix; products of two of these count set intersections."""
+    rows, cols = [], []
+    for row, items in enumerate(sets):
+        for item in items:
+            rows.append(row)
+            cols.append(vocab[item])
+    data = np.ones(len(rows), dtype=np.float64)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(sets), max(1, len(vocab))))
+
+
+class _MatchFeatures:
+    """
+    Features of every question and mark scheme, extracted once and encoded against
+    shared vocabularies, so any signal can be evaluated for all pairs (dense) or for
+    an arbitrary list of (question, mark scheme) index pairs (sparse/blocked).
+    """
+
+    def __init__(self, questions_list: List[OneQuestionModelV3], mark_schemes_list: List[IngestedMarkSchemeModel]):
+        q_tokens = [tokenize_id(q.question_id) for q in questions_list]
+        ms_tokens = [tokenize_id(ms.question_number) for ms in mark_schemes_list]
+        q_texts = [q.question.strip() if q.question else "" for q in questions_list]
+        ms_texts = [(ms.question_text or ms.mark_scheme_information or "").strip() for ms in mark_schemes_list]
+
+        # Token sequences, roots and individual tokens share one vocabulary each
+        seq_vocab: Dict[Any, int] = {}
+        self.q_seq = np.array([seq_vocab.setdefault(tuple(t), len(seq_vocab)) for t in q_tokens], dtype=np.int64)
+        self.ms_seq = np.array([seq_vocab.setdefault(tuple(t), len(seq_vocab)) for t in ms_tokens], dtype=np.int64)
+
+        root_vocab: Dict[Any, int] = {}
+        self.q_root = np.array([root_vocab.setdefault(t[0], len(root_vocab)) if t and t[0].isdigit() else -1 for t in q_tokens], dtype=np.int64)
+        self.ms_root = np.array([root_vocab.setdefault(t[0], len(root_vocab)) if t and t[0].isdigit() else -1 for t in ms_tokens], dtype=np.int64)
+
+        tok_vocab: Dict[str, int] = {}
+        max_len = max([len(t) for t in q_tokens + ms_tokens] + [1])
+        self.q_pad = np.full((len(q_tokens), max_len), -1, dtype=np.int64)    # different pad values so
+        self.ms_pad = np.full((len(ms_tokens), max_len), -2, dtype=np.int64)  # padding never matches
+        for row, toks in enumerate(q_tokens):
+            self.q_pad[row, :len(toks)] = [tok_vocab.setdefault(t, len(tok_vocab)) for t in toks]
+        for row, toks in enumerate(ms_tokens):
+            self.ms_pad[row, :len(toks)] = [tok_vocab.setdefault(t, len(tok_vocab)) for t in toks]
+        self.q_len = np.array([len(t) for t in q_tokens], dtype=float)
+        self.ms_len = np.array([len(t) for t in ms_tokens], dtype=float)
+        self.q_tok_inc = _incidence([set(t) for t in q_tokens], tok_vocab)
+        self.ms_tok_inc = _incidence([set(t) for t in ms_tokens], tok_vocab)
+
+        # Text
+        self.q_has_text = np.array([bool(t) for t in q_texts], dtype=bool)
+        self.ms_has_text = np.array([bool(t) for t in ms_texts], dtype=bool)
+        self.q_canonical = [canonical_text(t) if t else "" for t in q_texts]
+        self.ms_canonical = [canonical_text(t) if t else "" for t in ms_texts]
+        self.q_has_canonical = np.array([bool(c) for c in self.q_canonical], dtype=bool)
+        self.ms_has_canonical = np.array([bool(c) for c in self.ms_canonical], dtype=bool)
+        q_words = [set(c.split()) for c in self.q_canonical]
+        ms_words = [set(c.split()) for c in self.ms_canonical]
+        self.word_vocab: Dict[str, int] = {}
+        for word_set in q_words + ms_words:
+            for word in word_set:
+                self.word_vocab.setdefault(word, len(self.word_vocab))
+        self.q_word_inc = _incidence(q_words, self.word_vocab)
+        self.ms_word_inc = _incidence(ms_words, self.word_vocab)
+
+        # Marks: NaN where mark_proximity would return 0 (missing, or 0 marks on the mark scheme)
+        self.q_marks = np.array([np.nan if q.total_marks_available is None else float(q.total_marks_available) for q in questions_list], dtype=float)
+        self.ms_marks = np.array([np.nan if not ms.marks_available else float(ms.marks_available) for ms in mark_schemes_list], dtype=float)
+
+        self.q_is_mc = np.array([q.question_type == "multiple_choice" for q in questions_list], dtype=bool)
+        self.ms_is_generic = np.array([ms.type == "generic" for ms in mark_schemes_list], dtype=bool)
+
+    # ---- dense: every question against every mark scheme ----
+    def dense_signals(self, workers: int = MATCH_WORKERS) -> Dict[str, np.ndarray]:
+        exact = (self.q_seq[:, None] == self.ms_seq[None, :]).astype(float)
+        root = ((self.q_root[:, None] == self.ms_root[None, :]) & (self.q_root[:, None] >= 0)).astype(float)
+
+        lcp = np.zeros((len(self.q_seq), len(self.ms_seq)), dtype=float)
+        still_equal = np.ones(lcp.shape, dtype=bool)
+        for k in range(self.q_pad.shape[1]):
+            still_equal &= self.q_pad[:, k][:, None] == self.ms_pad[:, k][None, :]
+            lcp += still_equal
+        prefix = lcp / np.maximum(np.maximum(self.q_len[:, None], self.ms_len[None, :]), 1.0)
+
+        tok_inter = (self.q_tok_inc @ self.ms_tok_inc.T).toarray()
+        tok_q = np.asarray(self.q_tok_inc.sum(axis=1))
+        tok_ms = np.asarray(self.ms_tok_inc.sum(axis=1)).T
+        jaccard = tok_inter / np.maximum(1.0, tok_q + tok_ms - tok_inter)
+
+        tsr = cdist(self.q_canonical, self.ms_canonical, scorer=token_set_ratio, dtype=np.float64, workers=workers) / 100.0
+        pr = cdist(self.q_canonical, self.ms_canonical, scorer=partial_ratio, dtype=np.float64, workers=workers) / 100.0
+        word_inter = (self.q_word_inc @ self.ms_word_inc.T).toarray()
+        words_q = np.asarray(self.q_word_inc.sum(axis=1))
+        words_ms = np.asarray(self.ms_word_inc.sum(axis=1)).T
+
+        return {
+            "exact": exact, "root": root, "prefix": prefix, "jaccard": jaccard,
+            "tsr": tsr, "pr": pr, "word_inter": word_inter, "words_q": words_q, "words_ms": words_ms,
+            "has_canonical": self.q_has_canonical[:, None] & self.ms_has_canonical[None, :],
+            "has_text": self.q_has_text[:, None] & self.ms_has_text[None, :],
+            "q_marks": self.q_marks[:, None], "ms_marks": self.ms_marks[None, :],
+            "type_hint": (self.q_is_mc[:, None] & self.ms_is_generic[None, :]).astype(float),
+        }
+
+    # ---- sparse: only the given (question, mark scheme) index pairs ----
+    def pair_signals(self, qi: np.ndarray, mj: np.ndarray, workers: int = MATCH_WORKERS) -> Dict[str, np.ndarray]:
+        exact = (self.q_seq[qi] == self.ms_seq[mj]).astype(float)
+        root = ((self.q_root[qi] == self.ms_root[mj]) & (self.q_root[qi] >= 0)).astype(float)
+
+        eq = self.q_pad[qi] == self.ms_pad[mj]
+        lcp = np.cumprod(eq, axis=1).sum(axis=1).astype(float)
+        prefix = lcp / np.maximum(np.maximum(self.q_len[qi], self.ms_len[mj]), 1.0)
+
+        tok_inter = np.asarray(self.q_tok_inc[qi].multiply(self.ms_tok_inc[mj]).sum(axis=1)).ravel()
+        tok_q = np.asarray(self.q_tok_inc.sum(axis=1)).ravel()[qi]
+        tok_ms = np.asarray(self.ms_tok_inc.sum(axis=1)).ravel()[mj]
+        jaccard = tok_inter / np.maximum(1.0, tok_q + tok_ms - tok_inter)
+
+        q_can = [self.q_canonical[i] for i in qi]
+        ms_can = [self.ms_canonical[j] for j in mj]
+        tsr = cpdist(q_can, ms_can, scorer=token_set_ratio, dtype=np.float64, workers=workers) / 100.0
+        pr = cpdist(q_can, ms_can, scorer=partial_ratio, dtype=np.float64, workers=workers) / 100.0
+        word_inter = np.asarray(self.q_word_inc[qi].multiply(self.ms_word_inc[mj]).sum(axis=1)).ravel()
+        words_q = np.asarray(self.q_word_inc.sum(axis=1)).ravel()[qi]
+        words_ms = np.asarray(self.ms_word_inc.sum(axis=1)).ravel()[mj]
+
+        return {
+            "exact": exact, "root": root, "prefix": prefix, "jaccard": jaccard,
+            "tsr": tsr, "pr": pr, "word_inter": word_inter, "words_q": words_q, "words_ms": words_ms,
+            "has_canonical": self.q_has_canonical[qi] & self.ms_has_canonical[mj],
+            "has_text": self.q_has_text[qi] & self.ms_has_text[mj],
+            "q_marks": self.q_marks[qi], "ms_marks": self.ms_marks[mj],
+            "type_hint": (self.q_is_mc[qi] & self.ms_is_generic[mj]).astype(float),
+        }
+
+
+def _combine_signals(sig: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Weighted score from raw signal arrays (any matching shapes). Evaluated in the same
+    operand order as pair_score/text_similarity, so results are bit-identical to them.
+    """
+    # text_similarity: max(token_set_ratio, partial_ratio, subset-Jaccard), 0 if a canonical text is empty
+    words_q, words_ms = sig["words_q"], sig["words_ms"]
+    subset_jaccard = np.where(
+        (words_q > 0) & (words_ms > 0),
+        sig["word_inter"] / np.maximum(1.0, np.minimum(words_q, words_ms)),
+        0.0
+    )
+    text_sim = np.where(sig["has_canonical"], np.maximum(np.maximum(sig["tsr"], sig["pr"]), subset_jaccard), 0.0)
+
+    # mark_proximity: NaN marks (missing / zero on the mark scheme) score 0
+    with np.errstate(invalid="ignore"):
+        marks = 1.0 - np.abs(sig["q_marks"] - sig["ms_marks"]) / sig["ms_marks"]
+    marks = np.where(np.isnan(marks), 0.0, marks)
+
+    w = WEIGHTS
+    total_with_text = sum(WEIGHTS.values())
+    total_without_text = sum(v for k, v in WEIGHTS.items() if k != "text")
+
+    base = w.get("token_exact", 0) * sig["exact"] + w.get("root", 0) * sig["root"] + w.get("prefix", 0) * sig["prefix"] + w.get("jaccard", 0) * sig["jaccard"]
+    with_text = base + w.get("text", 0) * text_sim + w.get("marks", 0) * marks + w.get("type_hint", 0) * sig["type_hint"]
+    without_text = base + 0 + w.get("marks", 0) * marks + w.get("type_hint", 0) * sig["type_hint"]
+
+    return np.where(
+        sig["has_text"],
+        with_text / total_with_text if total_with_text else 0.0,
+        without_text / total_without_text if total_without_text else 0.0,
+    )
+
+
 def build_score_matrix(questions_list: List[OneQuestionModelV3], mark_schemes_list: List[IngestedMarkSchemeModel]) -> np.ndarray:
-    """Builds a matrix of pair_score between all questions and mark schemes."""
-    num_questions = len(questions_list)
-    num_mark_schemes = len(mark_schemes_list)
+    """
+    Builds a matrix of pair_score between all questions and mark schemes.
+    Features are extracted once per item and every signal is computed for all pairs
+    at once (rapidfuzz cdist for text, NumPy for the ID and marks signals).
+    """
+    if not questions_list or not mark_schemes_list:
+        return np.zeros((len(questions_list), len(mark_schemes_list)), dtype=float)
+    return _combine_signals(_MatchFeatures(questions_list, mark_schemes_list).dense_signals())
 
-    score_matrix = np.zeros((num_questions, num_mark_schemes), dtype=float)
 
-    for i, q_item in enumerate(questions_list):
-        for j, ms_item in enumerate(mark_schemes_list):
-            score_matrix[i, j] = pair_score(q_item, ms_item)
+# ───────────────────────── blocked matching ──────────────────────
+# Above this many question x mark scheme pairs, match() prunes candidates instead of scoring every pair.
+BLOCKING_MIN_PAIRS = int(os.getenv("MATCH_BLOCKING_MIN_PAIRS", "250000"))
+# Text shortlist size per question, and the share of mark schemes a word may appear in before it is ignored as too common.
+BLOCKING_TEXT_TOP_K = int(os.getenv("MATCH_BLOCKING_TEXT_TOP_K", "10"))
+BLOCKING_MAX_WORD_DF = float(os.getenv("MATCH_BLOCKING_MAX_WORD_DF", "0.05"))
+
+
+def candidate_pairs(features: _MatchFeatures, text_top_k: int = BLOCKING_TEXT_TOP_K, max_word_df: float = BLOCKING_MAX_WORD_DF) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Plausible (question, mark scheme) pairs:
+      * same root ID token (e.g. all of question 7's parts against all of mark scheme 7's),
+      * identical token sequences (covers non-numeric IDs, which have no root),
+      * each question's top-k mark schemes by shared distinctive words (IDF-weighted,
+        ignoring words found in more than max_word_df of mark schemes).
+    Cost is proportional to the number of candidates rather than n x m.
+    """
+    pairs = set()
+
+    for ids_q, ids_ms, skip in ((features.q_root, features.ms_root, -1), (features.q_seq, features.ms_seq, None)):
+        by_key: Dict[int, List[int]] = {}
+        for j, key in enumerate(ids_ms.tolist()):
+            if key != skip:
+                by_key.setdefault(key, []).append(j)
+        for i, key in enumerate(ids_q.tolist()):
+            if key != skip:
+                pairs.update((i, j) for j in by_key.get(key, ()))
+
+    num_ms = features.ms_word_inc.shape[0]
+    if text_top_k > 0 and num_ms:
+        doc_freq = np.asarray((features.ms_word_inc > 0).sum(axis=0)).ravel()
+        max_df = max(1, int(max_word_df * num_ms))
+        idf = np.where((doc_freq > 0) & (doc_freq <= max_df), np.log((1 + num_ms) / (1 + doc_freq)) + 1.0, 0.0)
+        overlap = (features.q_word_inc @ sparse.diags(idf) @ features.ms_word_inc.T).tocsr()
+        for i in range(overlap.shape[0]):
+            row_start, row_end = overlap.indptr[i], overlap.indptr[i + 1]
+            if row_start == row_end:
+                continue
+            cols = overlap.indices[row_start:row_end]
+            vals = overlap.data[row_start:row_end]
+            top = cols[np.argsort(-vals, kind="stable")[:text_top_k]]
+            pairs.update((i, int(j)) for j in top)
+
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    qi, mj = zip(*sorted(pairs))
+    return np.array(qi, dtype=np.int64), np.array(mj, dtype=np.int64)
+
+
+def _blocked_assignment(qi: np.ndarray, mj: np.ndarray, scores: np.ndarray, num_q: int, num_ms: int, threshold: float) -> Dict[int, int]:
+    """
+    Max-score one-to-one assignment over the candidate pairs only, via
+    scipy.sparse.csgraph.min_weight_full_bipartite_matching. Every question also gets a
+    private dummy column, so a full matching always exists. The dummy costs slightly
+    more than a pair scoring exactly `threshold`, so at-threshold pairs stay matched
+    (the final `score >= threshold` check accepts them). Returns {question index: mark
+    scheme index} for real assignments.
+    """
+    # Costs are shifted by +1 because explicit zeros would be dropped from the sparse graph;
+    # every row is matched exactly once, so a constant shift doesn't change the optimum.
+    dummy_cost = (1.0 - threshold) + 1e-6
+    rows = np.concatenate([qi, np.arange(num_q)])
+    cols = np.concatenate([mj, num_ms + np.arange(num_q)])
+    costs = np.concatenate([1.0 - scores, np.full(num_q, dummy_cost)]) + 1.0
+    graph = sparse.csr_matrix((costs, (rows, cols)), shape=(num_q, num_ms + num_q))
+    row_ind, col_ind = min_weight_full_bipartite_matching(graph)
+    return {int(r): int(c) for r, c in zip(row_ind, col_ind) if c < num_ms}
 
-    return score_matrix
 
 def pad_with_dummies(score_matrix: np.ndarray, threshold_value: float) -> Tuple[np.ndarray, int, int]:
     """Pads the score matrix to be square for the assignment algorithm, using a low dummy score."""
@@ -305,41 +577,61 @@ def match(
     mark_schemes_list: List[IngestedMarkSchemeModel],
     threshold: float = 0.60,
     top_k: int = 3,
-    verbose: bool = True
+    verbose: bool = True,
+    blocking: Optional[bool] = None
 ) -> List[Dict[str, Any]]:
     """
     Core matching logic. Returns a list of match dictionaries.
     If verbose=True, prints detailed scoring tables to the log.
+    blocking=True scores only candidate_pairs() and solves a sparse assignment;
+    None (default) enables it once there are BLOCKING_MIN_PAIRS or more pairs.
     """
     if not questions_list or not mark_schemes_list:
         log.info("Empty questions list or mark schemes list provided for matching.")
         return []
 
-    log.info(f"Starting matching: {len(questions_list)} questions, {len(mark_schemes_list)} mark schemes. Threshold={threshold}")
+    num_q, num_ms = len(questions_list), len(mark_schemes_list)
+    if blocking is None:
+        blocking = num_q * num_ms >= BLOCKING_MIN_PAIRS
+    log.info(f"Starting matching: {num_q} questions, {num_ms} mark schemes. Threshold={threshold}, blocking={blocking}")
+
+    features = _MatchFeatures(questions_list, mark_schemes_list)
+    if blocking:
+        # Scores exist only for candidate pairs, grouped by question (candidate_pairs sorts by question index)
+        cand_q, cand_ms = candidate_pairs(features)
+        cand_scores = _combine_signals(features.pair_signals(cand_q, cand_ms)) if cand_q.size else np.zeros(0)
+        bounds = np.searchsorted(cand_q, np.arange(num_q + 1))
+        log.info(f"Blocking kept {cand_q.size} of {num_q * num_ms} question/mark scheme pairs.")
+
+        def row_scores(i: int) -> Tuple[np.ndarray, np.ndarray]:
+            return cand_ms[bounds[i]:bounds[i + 1]], cand_scores[bounds[i]:bounds[i + 1]]
+    else:
+        score_matrix = _combine_signals(features.dense_signals())
+        all_cols = np.arange(num_ms)
 
-    score_matrix = build_score_matrix(questions_list, mark_schemes_list)
+        def row_scores(i: int) -> Tuple[np.ndarray, np.ndarray]:
+            return all_cols, score_matrix[i, :]
 
     if verbose and log.isEnabledFor(logging.INFO): # Use INFO for table output if verbose
         log.info("\n=== Top candidate scores per question (before assignment) ===")
         for i, q_item in enumerate(questions_list):
-            # Get top_k scores and their original indices for this question row
-            if score_matrix.shape[1] == 0: # No mark schemes
-                log.info(f"\nQuestion {q_item.question_id}: No mark schemes to compare against.")
+            cols, scores = row_scores(i)
+            if scores.size == 0: # No mark schemes / candidates
+                log.info(f"\nQuestion {q_item.question_id}: No {'candidate ' if blocking else ''}mark schemes to compare against.")
                 continue
 
-            top_indices = np.argsort(score_matrix[i, :])[::-1][:top_k] # Sort descending
+            top_indices = np.argsort(scores)[::-1][:top_k] # Sort descending
 
             table_rows = []
-            for j_idx in top_indices:
-                if j_idx < len(mark_schemes_list): # Ensure index is valid
-                    ms_item = mark_schemes_list[j_idx]
-                    s_text_val, d_text_val = text_contribution(q_item, ms_item)
-                    table_rows.append([
-                        ms_item.question_number,
-                        f"{score_matrix[i, j_idx]:.3f}",
-                        f"{s_text_val:.3f}",
-                        f"{d_text_val:.3f}"
-                    ])
+            for k in top_indices:
+                ms_item = mark_schemes_list[cols[k]]
+                s_text_val, d_text_val = text_contribution(q_item, ms_item)
+                table_rows.append([
+                    ms_item.question_number,
+                    f"{scores[k]:.3f}",
+                    f"{s_text_val:.3f}",
+                    f"{d_text_val:.3f}"
+                ])
             if table_rows:
                 log.info(f"\nQuestion {q_item.question_id} (Text: '{canonical_text(q_item.question)[:50]}...')")
                 log.info(tabulate(
@@ -351,49 +643,60 @@ def match(
                  log.info(f"\nQuestion {q_item.question_id}: No valid candidates to display.")
 
 
-    # Hungarian algorithm for optimal assignment
-    # We want to maximize scores, so we use (1.0 - score) for cost minimization.
-    cost_matrix, num_q_orig, num_ms_orig = pad_with_dummies(1.0 - score_matrix, 1.0 - threshold)
-    row_indices, col_indices = linear_sum_assignment(cost_matrix)
+    # Optimal assignment. We want to maximize scores, so we use (1.0 - score) for cost minimization.
+    assignments: List[Tuple[int, int, float]] = []
+    if blocking:
+        if cand_q.size:
+            assigned = _blocked_assignment(cand_q, cand_ms, cand_scores, num_q, num_ms, threshold)
+            for r_idx, c_idx in assigned.items():
+                cols, scores = row_scores(r_idx)
+                assignments.append((r_idx, c_idx, float(scores[np.searchsorted(cols, c_idx)])))
+    else:
+        # Hungarian algorithm on the dense matrix, padded square with dummies
+        cost_matrix, num_q_orig, num_ms_orig = pad_with_dummies(1.0 - score_matrix, 1.0 - threshold)
+        row_indices, col_indices = linear_sum_assignment(cost_matrix)
+        for r_idx, c_idx in zip(row_indices, col_indices):
+            # Only consider assignments within the original matrix dimensions
+            if r_idx < num_q_orig and c_idx < num_ms_orig:
+                assignments.append((r_idx, c_idx, score_matrix[r_idx, c_idx]))
 
     final_matches: List[Dict[str, Any]] = []
     assigned_question_indices = set()
 
-    for r_idx, c_idx in zip(row_indices, col_indices):
-        # Only consider assignments within the original matrix dimensions
-        if r_idx < num_q_orig and c_idx < num_ms_orig:
-            original_score = score_matrix[r_idx, c_idx]
-            if original_score >= threshold:
-                final_matches.append({
-                    "question_id": questions_list[r_idx].question_id,
-                    "mark_scheme_question_number": mark_schemes_list[c_idx].question_number,
-                    "score": round(original_score, 3)
-                })
-                assigned_question_indices.add(r_idx)
-            # else: assignment below threshold, will be handled as unmatched
+    for r_idx, c_idx, original_score in assignments:
+        if original_score >= threshold:
+            final_matches.append({
+                "question_id": questions_list[r_idx].question_id,
+                "mark_scheme_question_number": mark_schemes_list[c_idx].question_number,
+                "score": round(original_score, 3)
+            })
+            assigned_question_indices.add(r_idx)
+        # else: assignment below threshold, will be handled as unmatched
 
     # Handle questions not assigned an above-threshold match by the algorithm
     for i, q_item in enumerate(questions_list):
         if i not in assigned_question_indices:
             # Find the best possible score for this unmatched question, even if below threshold
-            if score_matrix.shape[1] > 0: # If there are mark schemes to compare against
-                best_ms_idx, best_score_for_q = get_best_col_and_score(score_matrix[i, :])
+            cols, scores = row_scores(i)
+            if scores.size > 0: # If there are mark schemes to compare against
+                best_k, best_score_for_q = get_best_col_and_score(scores)
                 note = "no match ≥ threshold" if best_score_for_q < threshold else "optimal assignment was lower priority"
                 final_matches.append({
                     "question_id": q_item.question_id,
-                    "mark_scheme_question_number": mark_schemes_list[best_ms_idx].question_number if best_ms_idx != -1 else None, # Best attempt
+                    "mark_scheme_question_number": mark_schemes_list[cols[best_k]].question_number if best_k != -1 else None, # Best attempt
                     "score": round(best_score_for_q, 3),
                     "note": note
                 })
-            else: # No mark schemes at all
+            else: # No mark schemes at all (or, when blocking, no plausible candidates)
                  final_matches.append({
                     "question_id": q_item.question_id,
                     "mark_scheme_question_number": None,
                     "score": 0.0,
-                    "note": "no mark schemes to match against"
+                    "note": "no mark schemes to match against" if not blocking else "no candidate mark schemes"
                 })
 
     log.info(f"Matching process completed. Found {len([m for m in final_matches if m.get('note') is None])} confident matches.")
+    log.debug(f"Feature cache stats: {feature_cache_stats()}")
     return final_matches
 
 # ─────────────────────────── public API (modified for Flask) ──────────────────────────
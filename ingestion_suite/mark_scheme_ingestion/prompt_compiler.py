@@ -0,0 +1,60 @@
+"""
+prompt_compiler.py
+------------------
+Renders the static parts of the mark scheme prompts once, at import time.
+
+`compile_prompt(template, **static_fields)` substitutes the static fields (the
+few-shot examples, JSON-dumped once) and keeps any remaining `{field}`s as slots.
+`CompiledPrompt.render(**fields)` then only joins precomputed strings, and gives
+exactly what `template.format(**static_fields, **fields)` would.
+
+A prompt with no slots left is the same string on every call, so it forms an
+identical request prefix that the provider's prompt cache can reuse.
+"""
+
+import json
+from string import Formatter
+from typing import Any, List, Tuple
+
+
+class CompiledPrompt:
+    def __init__(self, parts: List[Tuple[str, str]]):
+        # (literal text, slot name or "") pairs, in template order
+        self._parts = parts
+        self.slots = tuple(name for _, name in parts if name)
+        self.static_text = "".join(literal for literal, _ in parts) if not self.slots else None
+
+    def render(self, **fields: Any) -> str:
+        if self.static_text is not None:
+            return self.static_text
+        missing = [name for name in self.slots if name not in fields]
+        if missing:
+            raise KeyError(f"Missing prompt fields: {', '.join(missing)}")
+        return "".join(literal + (str(fields[name]) if name else "") for literal, name in self._parts)
+
+
+def render_example(example: Any) -> str:
+    """Few-shot example as it appears in the prompts."""
+    return json.dumps(example, indent=2)
+
+
+def compile_prompt(template: str, **static_fields: Any) -> CompiledPrompt:
+    """
+    Pre-renders `template` with `static_fields`. Fields not given stay as slots for
+    CompiledPrompt.render. Only plain `{name}` fields are supported (no format specs).
+    """
+    parts: List[Tuple[str, str]] = []
+    literal = ""
+    for text, field_name, format_spec, conversion in Formatter().parse(template):
+        literal += text  # Formatter.parse has already turned '{{' / '}}' into '{' / '}'
+        if field_name is None:
+            continue
+        if format_spec or conversion:
+            raise ValueError(f"Unsupported format field '{{{field_name}}}' in prompt template")
+        if field_name in static_fields:
+            literal += str(static_fields[field_name])
+        else:
+            parts.append((literal, field_name))
+            literal = ""
+    parts.append((literal, ""))
+    return CompiledPrompt(parts)
@@ -1,21 +1,54 @@
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from .infer_openai import invoke_openai
 from .helpers import pdf_to_images, fetch_test_file_path, load_image_as_data_url, collapse_entries
-from typing import List
+from typing import Iterable, List, Optional
 from pathlib import Path
 from azure.ai.inference.models import ImageContentItem, ImageUrl, UserMessage
 from .prompt_lib import extract_mark_schemes_from_image_and_classify_prompt
 from .output import ExtractedMarkSchemesInformationWrapper
 from .few_shot_examples import extract_mark_schemes_from_image_and_classify_example_output_1, extract_mark_schemes_from_image_and_classify_example_output_2
 
-def extract_mark_scheme_information_from_images_openai(images: List[Path], prompt: str, model_name: str) -> ExtractedMarkSchemesInformationWrapper:
-    all_mark_schemes = []
-    for image in images:
-        data_url = load_image_as_data_url(image)
+# Max number of page images sent to the LLM at once. 1 keeps the old serial behaviour.
+PAGE_EXTRACTION_CONCURRENCY = int(os.getenv("MARK_SCHEME_PAGE_CONCURRENCY", "8"))
 
-        user_message = UserMessage(content=[ImageContentItem(image_url=ImageUrl(url=data_url))])
-        extracted_markscheme_json = json.loads(invoke_openai(prompt, model_name, output_format=ExtractedMarkSchemesInformationWrapper, payload=[user_message]))
-        all_mark_schemes.extend(extracted_markscheme_json["mark_schemes"])
+
+def _extract_mark_schemes_from_page(image: Path, prompt: str, model_name: str) -> List[dict]:
+    """Runs the extraction/classification prompt on a single page image."""
+    data_url = load_image_as_data_url(image, model_name=model_name) # prepared (cropped/downscaled) for the model
+
+    user_message = UserMessage(content=[ImageContentItem(image_url=ImageUrl(url=data_url))])
+    extracted_markscheme_json = json.loads(invoke_openai(prompt, model_name, output_format=ExtractedMarkSchemesInformationWrapper, payload=[user_message]))
+    return extracted_markscheme_json["mark_schemes"]
+
+
+def extract_mark_scheme_information_from_images_openai(
+    images: Iterable[Path],
+    prompt: str,
+    model_name: str,
+    max_workers: Optional[int] = None
+) -> ExtractedMarkSchemesInformationWrapper:
+    """
+    Extracts raw mark scheme entries from each page image, running up to `max_workers`
+    pages concurrently (defaults to MARK_SCHEME_PAGE_CONCURRENCY).
+    `images` may be a generator (e.g. helpers.iter_pdf_to_images): each page is submitted
+    as soon as it is yielded, so extraction overlaps with rendering of later pages.
+    Per-page results are kept in page order so collapse_entries can merge 'previous' items.
+    """
+    workers = max(1, max_workers or PAGE_EXTRACTION_CONCURRENCY)
+
+    if workers == 1:
+        per_page_results = [_extract_mark_schemes_from_page(image, prompt, model_name) for image in images]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ms-page") as executor:
+            # Futures are collected in page order regardless of completion order
+            futures = [executor.submit(_extract_mark_schemes_from_page, image, prompt, model_name) for image in images]
+            per_page_results = [future.result() for future in futures]
+
+    all_mark_schemes = []
+    for page_mark_schemes in per_page_results:
+        all_mark_schemes.extend(page_mark_schemes)
     return collapse_entries(all_mark_schemes)
 
 
@@ -0,0 +1,189 @@
+import os
+import socket
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from job_store import JobStore
+from worker_pool import WorkerPool, PRIORITY_NORMAL
+
+# Identifies this process in the job store; the random part tells a restarted process
+# apart from its predecessor even when it gets the same pid (e.g. pid 1 in a container)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable[..., Any], status_field: str,
+                 depends_on: Sequence[str] = (), priority: int = PRIORITY_NORMAL,
+                 resume_args: Optional[Callable[[str], Optional[Tuple[Any, ...]]]] = None):
+        self.name = name
+        self.fn = fn                      # called as fn(job_id, *args); records its own status
+        self.status_field = status_field  # job store field: pending -> queued -> processing -> completed / error: ...
+        self.depends_on = tuple(depends_on)
+        self.priority = priority
+        self.resume_args = resume_args    # rebuilds args after a restart; None result = inputs are gone
+        self.owner_field = f"{name}_owner"  # INSTANCE_ID of the process that claimed the stage
+
+
+def _owner_alive(owner: Optional[str]) -> bool:
+    """Whether the process that claimed a stage may still be running it."""
+    if not owner:
+        return False
+    host, _, rest = owner.partition(':')
+    pid, _, _ = rest.partition(':')
+    if host != socket.gethostname():
+        return False  # the SQLite store is per host, so this is an earlier container/machine
+    if owner == INSTANCE_ID:
+        return True
+    if not pid.isdigit() or int(pid) == os.getpid():
+        return False  # an earlier process that had our pid
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobPipeline:
+    """
+    A small DAG of job stages run on the worker pool. When a stage finishes, every
+    dependent whose inputs are all 'completed' is queued straight away, so nothing
+    depends on a browser polling /status. Claiming a stage is a compare-and-set
+    (pending -> queued) in the job store, so it can only be started once, even
+    with several threads or worker processes racing.
+
+    Stages left queued or processing by a process that has died are picked up
+    again by recover_interrupted_jobs() at start-up.
+    """
+
+    def __init__(self, job_store: JobStore, worker_pool: WorkerPool):
+        self.job_store = job_store
+        self.worker_pool = worker_pool
+        self.stages: Dict[str, Stage] = {}
+
+    def add_stage(self, name: str, fn: Callable[..., Any], status_field: str,
+                  depends_on: Sequence[str] = (), priority: int = PRIORITY_NORMAL,
+                  resume_args: Optional[Callable[[str], Optional[Tuple[Any, ...]]]] = None) -> None:
+        for dep in depends_on:
+            if dep not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self.stages[name] = Stage(name, fn, status_field, depends_on, priority, resume_args)
+
+    def initial_statuses(self) -> Dict[str, str]:
+        return {stage.status_field: 'pending' for stage in self.stages.values()}
+
+    def start(self, job_id: str, stage_args: Optional[Dict[str, Tuple[Any, ...]]] = None) -> None:
+        """
+        Queues every root stage (no dependencies), all at once or none of them: if the
+        worker pool can't take them all, the claimed stages go back to 'pending' and
+        QueueFullError is raised.
+        """
+        stage_args = stage_args or {}
+        claimed = [stage for stage in self.stages.values() if not stage.depends_on and self._claim(job_id, stage)]
+        try:
+            self.worker_pool.submit_many([
+                (self._run_stage, (job_id, stage.name, stage_args.get(stage.name, ())), stage.priority)
+                for stage in claimed
+            ])
+        except Exception:
+            for stage in claimed:
+                self._unclaim(job_id, stage)
+            raise
+        for stage in claimed:
+            print(f"Job {job_id}: Queued stage '{stage.name}'.")
+
+    def _dependents(self, name: str) -> List[Stage]:
+        return [stage for stage in self.stages.values() if name in stage.depends_on]
+
+    def _claim(self, job_id: str, stage: Stage) -> bool:
+        """pending -> queued, recording this process as the owner in the same write."""
+        return self.job_store.compare_and_set(job_id, stage.status_field, 'pending', 'queued',
+                                              **{stage.owner_field: INSTANCE_ID})
+
+    def _unclaim(self, job_id: str, stage: Stage) -> None:
+        self.job_store.compare_and_set(job_id, stage.status_field, 'queued', 'pending', **{stage.owner_field: None})
+
+    def _schedule(self, job_id: str, stage: Stage, args: Tuple[Any, ...] = (), bypass_limit: bool = False) -> bool:
+        if not self._claim(job_id, stage):
+            return False  # already claimed elsewhere
+        try:
+            self.worker_pool.submit(self._run_stage, job_id, stage.name, args,
+                                    priority=stage.priority, bypass_limit=bypass_limit)
+        except Exception:
+            self._unclaim(job_id, stage)
+            raise
+        print(f"Job {job_id}: Queued stage '{stage.name}'.")
+        return True
+
+    def _run_stage(self, job_id: str, name: str, args: Tuple[Any, ...]) -> None:
+        stage = self.stages[name]
+        try:
+            stage.fn(job_id, *args)
+        except Exception as e:
+            # Stage functions normally record their own errors; this covers anything that escaped
+            print(f"Job {job_id}: Stage '{name}' raised: {e}")
+            self.job_store.update(job_id, **{stage.status_field: f'error: {str(e)}'})
+        self._advance(job_id, stage)
+
+    def _advance(self, job_id: str, finished: Stage) -> None:
+        job = self.job_store.get(job_id) or {}
+        if job.get(finished.status_field) != 'completed':
+            self._fail_downstream(job_id, finished)
+            return
+        for dependent in self._dependents(finished.name):
+            if all(job.get(self.stages[dep].status_field) == 'completed' for dep in dependent.depends_on):
+                # The job was admitted already, so its follow-up stages skip the queue limit
+                self._schedule(job_id, dependent, bypass_limit=True)
+
+    def _fail_downstream(self, job_id: str, failed: Stage) -> None:
+        pending = self._dependents(failed.name)
+        while pending:
+            stage = pending.pop()
+            if self.job_store.compare_and_set(job_id, stage.status_field, 'pending',
+                                              f"error: upstream stage '{failed.name}' failed"):
+                pending.extend(self._dependents(stage.name))
+        self.job_store.update(job_id, status='error')
+
+    def recover_interrupted_jobs(self) -> int:
+        """
+        Start-up sweep. Stages left 'queued' or 'processing' by a dead process are
+        re-queued (the assignment stage resumes from its checkpoints), or marked as
+        errors if their inputs can't be rebuilt; stages whose inputs all completed but
+        were never queued are queued. Returns the number of stages queued.
+        """
+        queued = 0
+        for job_id in self.job_store.job_ids():
+            try:
+                queued += self._recover_job(job_id)
+            except Exception as e:
+                print(f"Job {job_id}: Could not recover after restart: {e}")
+        if queued:
+            print(f"Re-queued {queued} interrupted stage(s) after restart.")
+        return queued
+
+    def _recover_job(self, job_id: str) -> int:
+        job = self.job_store.get(job_id) or {}
+        queued = 0
+        for stage in self.stages.values():
+            state = job.get(stage.status_field)
+            if state not in ('queued', 'processing') or _owner_alive(job.get(stage.owner_field)):
+                continue
+            if not self.job_store.compare_and_set(job_id, stage.status_field, state, 'pending'):
+                continue  # changed since we looked
+            args = stage.resume_args(job_id) if stage.resume_args else ()
+            if args is None:
+                self.job_store.update(job_id, **{stage.status_field: 'error: interrupted by a restart and its inputs are no longer available'})
+                print(f"Job {job_id}: Stage '{stage.name}' was interrupted and cannot be resumed.")
+                self._fail_downstream(job_id, stage)
+                continue
+            print(f"Job {job_id}: Resuming stage '{stage.name}' interrupted by a restart.")
+            queued += self._schedule(job_id, stage, args, bypass_limit=True)
+
+        # A process can also die between a stage completing and its dependents being queued
+        job = self.job_store.get(job_id) or {}
+        for stage in self.stages.values():
+            if stage.depends_on and job.get(stage.status_field) == 'pending' and \
+                    all(job.get(self.stages[dep].status_field) == 'completed' for dep in stage.depends_on):
+                queued += self._schedule(job_id, stage, bypass_limit=True)
+        return queued
@@ -0,0 +1,189 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from utils import INGESTED_DATA_FOLDER
+
+JOB_STORE_BACKEND = os.getenv('JOB_STORE_BACKEND', 'sqlite').lower()
+JOB_STORE_PATH = Path(os.getenv('JOB_STORE_PATH', str(INGESTED_DATA_FOLDER / 'jobs.sqlite3')))
+
+
+class JobStore:
+    """
+    Stores the status dict of each job. Jobs are read and written as whole dicts;
+    update() merges fields so concurrent stages don't overwrite each other's keys.
+    """
+
+    def create(self, job_id: str, fields: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, **fields: Any) -> Dict[str, Any]:
+        """Merges fields into the job and returns the updated status dict."""
+        raise NotImplementedError
+
+    def compare_and_set(self, job_id: str, field: str, expected: Any, new: Any, **also: Any) -> bool:
+        """
+        Atomically sets job[field] = new only if it currently equals expected, merging
+        `also` into the job in the same write. Returns True if set.
+        """
+        raise NotImplementedError
+
+    def delete(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    def job_ids(self) -> List[str]:
+        raise NotImplementedError
+
+
+class InMemoryJobStore(JobStore):
+    """Process-local store (the old job_statuses dict). Jobs do not survive a restart."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self._jobs[job_id] = dict(fields)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id: str, **fields: Any) -> Dict[str, Any]:
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {})
+            job.update(fields)
+            return dict(job)
+
+    def compare_and_set(self, job_id: str, field: str, expected: Any, new: Any, **also: Any) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.get(field) != expected:
+                return False
+            job[field] = new
+            job.update(also)
+            return True
+
+    def delete(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def job_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._jobs)
+
+
+class SqliteJobStore(JobStore):
+    """
+    Durable store shared by every worker process on the host. Each operation opens a
+    short-lived connection; updates run in an IMMEDIATE transaction so concurrent
+    read-modify-write cycles from different threads/processes are serialised.
+    """
+
+    def __init__(self, db_path: Path = JOB_STORE_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' job_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+
+    def create(self, job_id: str, fields: Dict[str, Any]) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, data, updated_at) VALUES (?, ?, ?)',
+                (job_id, json.dumps(fields), time.time())
+            )
+        finally:
+            conn.close()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id: str, **fields: Any) -> Dict[str, Any]:
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else {}
+            job.update(fields)
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, data, updated_at) VALUES (?, ?, ?)',
+                (job_id, json.dumps(job), time.time())
+            )
+            conn.execute('COMMIT')
+            return job
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def compare_and_set(self, job_id: str, field: str, expected: Any, new: Any, **also: Any) -> bool:
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else None
+            if job is None or job.get(field) != expected:
+                conn.execute('ROLLBACK')
+                return False
+            job[field] = new
+            job.update(also)
+            conn.execute(
+                'UPDATE jobs SET data = ?, updated_at = ? WHERE job_id = ?',
+                (json.dumps(job), time.time(), job_id)
+            )
+            conn.execute('COMMIT')
+            return True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def delete(self, job_id: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+        finally:
+            conn.close()
+
+    def job_ids(self) -> List[str]:
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT job_id FROM jobs')]
+        finally:
+            conn.close()
+
+
+def create_job_store(backend: str = JOB_STORE_BACKEND) -> JobStore:
+    """Builds the configured backend ('sqlite' or 'memory')."""
+    if backend == 'memory':
+        return InMemoryJobStore()
+    if backend == 'sqlite':
+        return SqliteJobStore(JOB_STORE_PATH)
+    raise ValueError(f"Unknown JOB_STORE_BACKEND: {backend}")
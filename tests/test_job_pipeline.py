@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from job_pipeline import INSTANCE_ID, JobPipeline
+from job_store import InMemoryJobStore
+from worker_pool import QueueFullError, WorkerPool
+
+
+def _pipeline(max_queued):
+    store = InMemoryJobStore()
+    pool = WorkerPool(max_workers=1, max_queued=max_queued)
+    pipeline = JobPipeline(store, pool)
+    return store, pool, pipeline
+
+
+def test_start_queues_no_root_stage_when_they_do_not_all_fit():
+    store, pool, pipeline = _pipeline(max_queued=1)
+    ran = []
+    pipeline.add_stage('assignment', lambda job_id: ran.append('assignment'), 'assignment_status')
+    pipeline.add_stage('mark_scheme', lambda job_id: ran.append('mark_scheme'), 'mark_scheme_status')
+    store.create('job', pipeline.initial_statuses())
+
+    with pytest.raises(QueueFullError):
+        pipeline.start('job')
+    pool.shutdown()
+
+    job = store.get('job')
+    assert ran == []
+    assert job['assignment_status'] == job['mark_scheme_status'] == 'pending'
+    assert job['assignment_owner'] is None and job['mark_scheme_owner'] is None
+
+
+def test_claim_records_the_owner_with_the_status():
+    store, pool, pipeline = _pipeline(max_queued=4)
+    release = threading.Event()
+    pipeline.add_stage('assignment', lambda job_id: release.wait(5), 'assignment_status')
+    store.create('job', pipeline.initial_statuses())
+
+    pipeline.start('job')
+    job = store.get('job')
+    release.set()
+    pool.shutdown()
+
+    assert job['assignment_status'] == 'queued'
+    assert job['assignment_owner'] == INSTANCE_ID
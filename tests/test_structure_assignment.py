@@ -0,0 +1,67 @@
+import pytest
+
+for dependency in ("structlog", "mistralai", "langchain", "langchain_openai", "langchain_community"):
+    pytest.importorskip(dependency)
+
+from ingestion_suite.assignment_ingestion import new_assessment_ingestion_v2 as ingestion
+from ingestion_suite.assignment_ingestion.checkpoints import StageCheckpoints
+
+CHUNKS = ["question 1", "question 2", "question 3"]
+
+
+@pytest.fixture(autouse=True)
+def one_chunk_per_question(monkeypatch):
+    monkeypatch.setattr(ingestion, "split_markdown_into_chunks", lambda markdown, max_chars: markdown.split("|"))
+
+
+def _fake_llm(monkeypatch, failures):
+    """invoke_llm that fails `failures[chunk]` times (retried from its budget) before answering."""
+    calls = []
+
+    def invoke_llm(assignment_text, retry_budget, **kwargs):
+        calls.append(assignment_text)
+
+        def attempt():
+            if failures.get(assignment_text, 0) > 0:
+                failures[assignment_text] -= 1
+                raise RuntimeError("transient")
+            return {"questions": [{"question_id": assignment_text, "question": assignment_text}]}
+
+        try:
+            return retry_budget.run("llm_structuring", attempt, initial_wait=0, max_wait=0, jitter=0)
+        except RuntimeError:
+            return None
+
+    monkeypatch.setattr(ingestion, "invoke_llm", invoke_llm)
+    return calls
+
+
+def _question_ids(result):
+    return [q["question_id"] for q in result["questions"]]
+
+
+def test_failed_chunk_fails_the_stage(monkeypatch, tmp_path):
+    _fake_llm(monkeypatch, {"question 2": 99})
+    checkpoints = StageCheckpoints(tmp_path)
+    with pytest.raises(RuntimeError, match="chunk\\(s\\) 2 of 3"):
+        ingestion.structure_assignment("|".join(CHUNKS), model_name="test", max_retries=1, checkpoints=checkpoints)
+    assert checkpoints.load("structured") is None
+
+
+def test_rerun_only_structures_missing_chunks(monkeypatch, tmp_path):
+    checkpoints = StageCheckpoints(tmp_path)
+    _fake_llm(monkeypatch, {"question 2": 99})
+    with pytest.raises(RuntimeError):
+        ingestion.structure_assignment("|".join(CHUNKS), model_name="test", max_retries=0, checkpoints=checkpoints)
+
+    calls = _fake_llm(monkeypatch, {})
+    result = ingestion.structure_assignment("|".join(CHUNKS), model_name="test", checkpoints=checkpoints)
+    assert calls == ["question 2"]
+    assert _question_ids(result) == CHUNKS
+
+
+def test_each_chunk_has_its_own_retries(monkeypatch):
+    # Together these need more retries than one chunk's budget; each alone fits in it
+    _fake_llm(monkeypatch, {chunk: 2 for chunk in CHUNKS})
+    result = ingestion.structure_assignment("|".join(CHUNKS), model_name="test", max_retries=2)
+    assert _question_ids(result) == CHUNKS
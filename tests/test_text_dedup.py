@@ -0,0 +1,39 @@
+import pytest
+
+from ingestion_suite.assignment_ingestion.text_dedup import TextDedupIndex
+
+PASSAGE = (
+    "A cyclist travels along a straight road. At the start of the interval the velocity is {} m/s "
+    "and the cyclist accelerates uniformly for the next twenty seconds until reaching the junction."
+)
+
+
+def _same_key(a, b):
+    index = TextDedupIndex()
+    return index.key_for("text", a) == index.key_for("text", b)
+
+
+def test_formatting_variants_are_merged():
+    variant = PASSAGE.format("5").upper().replace(".", " .").replace("  ", " ")
+    index = TextDedupIndex()
+    key, _ = index.lookup("text", PASSAGE.format("5"))
+    other_key, similarity = index.lookup("text", variant.replace("A CYCLIST", "A cyclist, "))
+    assert other_key == key and similarity is not None
+
+
+@pytest.mark.parametrize("a, b", [
+    ("5", "-5"),
+    ("+5", "-5"),
+    ("5", "+5"),
+    ("1.5", "1,5"),
+    ("2.5", "2·5"),
+    ("5", "6"),
+    ("at most 5", "at least 5"),
+    ("< 5", "> 5"),
+])
+def test_changed_numbers_signs_and_words_are_not_merged(a, b):
+    assert not _same_key(PASSAGE.format(a), PASSAGE.format(b))
+
+
+def test_unicode_minus_is_the_same_sign():
+    assert _same_key(PASSAGE.format("−5"), PASSAGE.format("-5"))
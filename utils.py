@@ -2,7 +2,6 @@ import uuid
 import os
 from pathlib import Path
 from werkzeug.utils import secure_filename
-from pdf2image import pdfinfo_from_path # For page count
 
 UPLOAD_FOLDER = Path('uploads')
 INGESTED_DATA_FOLDER = Path('ingested_data')
@@ -79,6 +78,7 @@ def get_page_count_or_image_num(file_paths: list[Path]) -> int:
     if first_file.suffix.lower() == '.pdf':
         try:
             # Ensure POPPLER_PATH is set in your .env if poppler is not in system PATH
+            from pdf2image import pdfinfo_from_path # For page count; imported here to keep app start-up light
             poppler_path = os.getenv('POPPLER_PATH')
             info = pdfinfo_from_path(first_file, poppler_path=poppler_path)
             return info.get('Pages', 1) # Default to 1 if 'Pages' key is missing
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from ingestion_suite.assignment_ingestion.component_images import externalise_component_images
+
+VIEW_MODEL_FILENAME = 'view_model.json'
+VIEW_MODEL_CACHE_SIZE = int(os.getenv('VIEW_MODEL_CACHE_SIZE', '32'))
+
+
+
+def _load_json(path: Optional[str], default: Any = None, required: bool = False) -> Any:
+    if not path or not Path(path).exists():
+        if required:
+            raise FileNotFoundError(f"{path or 'Ingested data file'} not found.")
+        print(f"Warning: {path or 'Ingested data file'} not found or not specified")
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _component_reference(component_id: str, component: Dict[str, Any]) -> Dict[str, Any]:
+    """Common component as rendered; stored images are marked with an image_ref for the image route."""
+    ref = dict(component)
+    if component.get('image_file'):
+        ref['image_ref'] = component_id
+    return ref
+
+
+def build_view_model(assessment_path: str, common_components_path: str,
+                     mark_scheme_path: Optional[str], matched_data_path: Optional[str]) -> Dict[str, Any]:
+    """
+    Joins the ingested assessment, common components, mark schemes and matches into
+    everything assessment_view.html renders:
+      * assessment        – the assessment with each question's matched mark scheme,
+                            match score and note attached, in paper order
+      * common_components – only the components the questions reference; images carry
+                            an 'image_ref' to their file instead of base64 data
+    """
+    assessment_data = _load_json(assessment_path, required=True)
+    # Older jobs stored images inline; this writes their files (once) and drops the base64
+    common_components = externalise_component_images(
+        _load_json(common_components_path, required=True), Path(common_components_path).parent
+    )
+    mark_scheme_data = _load_json(mark_scheme_path, default={"mark_schemes": []})
+    matched_data = _load_json(matched_data_path, default=[])
+
+    mark_schemes_lookup = {ms.get('question_number'): ms for ms in mark_scheme_data.get('mark_schemes', [])}
+    matches_by_question: Dict[str, Dict[str, Any]] = {}
+    for m in matched_data:
+        matches_by_question.setdefault(m.get('question_id'), m)  # first match wins, as before
+
+    processed_questions = []
+    used_components: Dict[str, Dict[str, Any]] = {}
+    for q_data in assessment_data.get('questions', []):
+        q_id = q_data.get('question_id')
+        match_info = matches_by_question.get(q_id)
+
+        q_data_copy = q_data.copy()
+        if match_info and match_info.get('mark_scheme_question_number'):
+            q_data_copy['matched_mark_scheme'] = mark_schemes_lookup.get(match_info.get('mark_scheme_question_number'))
+            q_data_copy['match_score'] = match_info.get('score')
+        else:
+            q_data_copy['matched_mark_scheme'] = None
+            q_data_copy['match_score'] = match_info.get('score') if match_info else None
+            if match_info and match_info.get('note'):
+                q_data_copy['match_note'] = match_info.get('note')
+
+        for ctx_wrapper in q_data.get('question_context') or []:
+            ref = ((ctx_wrapper or {}).get('component') or {}).get('reference')
+            if ref in common_components and ref not in used_components:
+                used_components[ref] = _component_reference(ref, common_components[ref])
+
+        processed_questions.append(q_data_copy)
+
+    return {
+        'assessment': {**assessment_data, 'questions': processed_questions},
+        'common_components': used_components,
+    }
+
+
+def save_view_model(view_model: Dict[str, Any], path: Path) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(view_model, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, path)
+
+
+class ViewModelCache:
+    """
+    In-process LRU of parsed view models keyed by job. An entry is reused while the
+    file's mtime and size are unchanged, so a rebuilt view model is picked up on the
+    next request without any explicit invalidation.
+    """
+
+    def __init__(self, max_entries: int = VIEW_MODEL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, Tuple[Tuple[int, int], Dict[str, Any]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_id: str, path: Path) -> Dict[str, Any]:
+        """Returns the view model at path, parsing it only if it changed. Raises FileNotFoundError."""
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(job_id)
+                return entry[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            view_model = json.load(f)
+        with self._lock:
+            self._entries[job_id] = (version, view_model)
+            self._entries.move_to_end(job_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return view_model
+
+    def invalidate(self, job_id: str) -> None:
+        with self._lock:
+            self._entries.pop(job_id, None)
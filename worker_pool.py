@@ -0,0 +1,99 @@
+import itertools
+import os
+import queue
+import threading
+import traceback
+from typing import Any, Callable, List, Tuple
+
+MAX_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+MAX_QUEUED_TASKS = int(os.getenv('JOB_QUEUE_SIZE', '32'))
+
+# Lower number runs first. Matching is quick and completes a job, so it jumps the queue.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+
+
+class QueueFullError(Exception):
+    """Raised by WorkerPool.submit when the queue is at capacity (backpressure)."""
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads pulling tasks from a bounded priority queue.
+    Tasks with equal priority run in submission order.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_queued: int = MAX_QUEUED_TASKS):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+            for i in range(max_workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def can_accept(self, n: int = 1) -> bool:
+        with self._lock:
+            return not self._shutdown and self._queued + n <= self.max_queued
+
+    def submit(self, fn: Callable[..., Any], *args: Any, priority: int = PRIORITY_NORMAL, bypass_limit: bool = False) -> None:
+        """
+        Queues fn(*args). Raises QueueFullError at capacity unless bypass_limit is set,
+        which is meant for follow-up stages of jobs that were already admitted.
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Worker pool is shut down.')
+            if not bypass_limit and self._queued >= self.max_queued:
+                raise QueueFullError(f'Job queue is full ({self.max_queued} tasks waiting).')
+            self._queued += 1
+        self._queue.put((priority, next(self._seq), fn, args))
+
+    def submit_many(self, tasks: List[Tuple[Callable[..., Any], Tuple[Any, ...], int]], bypass_limit: bool = False) -> None:
+        """
+        Queues every (fn, args, priority) task, or none of them: raises QueueFullError
+        if they don't all fit (unless bypass_limit is set).
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Worker pool is shut down.')
+            if not bypass_limit and self._queued + len(tasks) > self.max_queued:
+                raise QueueFullError(f'Job queue is full ({self.max_queued} tasks waiting).')
+            self._queued += len(tasks)
+        for fn, args, priority in tasks:
+            self._queue.put((priority, next(self._seq), fn, args))
+
+    def queued_count(self) -> int:
+        with self._lock:
+            return self._queued
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops accepting tasks; workers exit after draining what is already queued."""
+        with self._lock:
+            self._shutdown = True
+        for _ in self._threads:
+            # Sentinels sort after every real task
+            self._queue.put((float('inf'), next(self._seq), None, ()))
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker(self):
+        while True:
+            _, _, fn, args = self._queue.get()
+            if fn is None:
+                return
+            with self._lock:
+                self._queued -= 1
+            try:
+                fn(*args)
+            except Exception as e:
+                # Task functions record their own errors in the job store; this is a last resort
+                print(f"Unhandled error in worker task {getattr(fn, '__name__', fn)}: {e}")
+                traceback.print_exc()